@@ -116,7 +116,6 @@ except ImportError:
     print "mpi4py not found.  Using a single processor."
     mpirank = 0
     mpisize = 1
-    import pdb; pdb.set_trace()
 if mpisize > 1:
     # each processor gets 1/n_processors of the temperatures, in order
     # If you want to run in parallel with just 1 temperature, 
@@ -4,6 +4,9 @@
 import math
 import os
 import time
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from radex_engine import RadexError
 #
 # Run a series of Radex models to estimate temperature & density
 # from observed ratios of H2CO 1-1/2-2, 1-1/3-3, and 2-2/3-3 lines
@@ -203,8 +206,7 @@ for iact,act in enumerate(acts):
         if verbose > 0: print "Processor %i: Starting radex code." % mpirank
         status = os.system('%s < radex.inp > /dev/null' % executable)
         if status != 0:
-            print "Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status)
-            import pdb; pdb.set_trace()
+            raise RadexError("Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status))
         if verbose > 0: print "Processor %i: Finished Radex." % mpirank
 
     if verbose > 0: print "Processor %i: Beginning output parsing." % mpirank
@@ -130,7 +130,7 @@ def plot_radex(filename,ngridpts=100,ncontours=50,plottype='ratio',
 
 def gridcube(filename, outfilename, var1="density", var2="column",
              var3="temperature", var4=None, plotvar="tau1", zerobads=True,
-             ratio_type='flux', round=2):
+             ratio_type='flux', round=2, shape=None, axes=None):
     """
     Reads in a radex_grid.py generated .dat file and turns it into a .fits data cube.
     filename - input .dat filename
@@ -138,10 +138,15 @@ def gridcube(filename, outfilename, var1="density", var2="column",
     var1/var2/var3 - which variable will be used along the x/y/z axis?
     plotvar - which variable will be the value in the data cube?
     zerobads - set inf/nan values in plotvar to be zero
+    shape - number of points along each grid axis, e.g. (ntemp,ndens,ncol).
+        radex_engine writes the rows in grid order, so with shape the cube
+        is a reshape of the file: no rounding, unique() or interpolation
+    axes - names of the grid axes in the order of shape; defaults to
+        temperature, (var4,) density, column
     """
 
     names,props = readcol(filename,twod=False,names=True)
-    if round:
+    if round and shape is None:
         for ii,name in enumerate(names):
             if name in ('Temperature','log10(dens)','log10(col)','opr'):
                 props[ii] = np.round(props[ii],round)
@@ -149,7 +154,8 @@ def gridcube(filename, outfilename, var1="density", var2="column",
         temperature,density,column,tex1,tex2,tau1,tau2,tline1,tline2,flux1,flux2 = props
     else:
         temperature,density,column,opr,tex1,tex2,tau1,tau2,tline1,tline2,flux1,flux2 = props
-        opr = np.floor(opr*100)/100.
+        if shape is None:
+            opr = np.floor(opr*100)/100.
     if ratio_type == 'flux':
         ratio = flux1 / flux2
     else:
@@ -172,6 +178,32 @@ def gridcube(filename, outfilename, var1="density", var2="column",
     if var4 is not None:
         vardict['opr'] = opr
 
+    if zerobads:
+        pv = vardict[plotvar]
+        pv[pv!=pv] = 0.0
+        pv[isinf(pv)] = 0.0
+
+    if shape is not None:
+        if axes is None:
+            if var4 is None:
+                axes = ('temperature','density','column')
+            else:
+                axes = ('temperature',var4,'density','column')
+        def axis_values(name):
+            # values along one axis, at index 0 of all the others
+            index = [0]*len(shape)
+            index[list(axes).index(name)] = slice(None)
+            return vardict[name].reshape(shape)[tuple(index)]
+        cubevars = [var1,var2,var3] if var4 is None else [var1,var2,var3,var4]
+        xarr,yarr,zarr = axis_values(var1),axis_values(var2),axis_values(var3)
+        if var4 is not None:
+            warr = axis_values(var4)
+        newarr = vardict[plotvar].reshape(shape).transpose([list(axes).index(v) for v in reversed(cubevars)])
+        print "Cube shape will be ",newarr.shape
+        write_cube(newarr, outfilename, plotvar, xarr, yarr, zarr,
+                   warr if var4 is not None else None)
+        return
+
     nx = len(unique(vardict[var1]))
     ny = len(unique(vardict[var2]))
     nz = len(unique(vardict[var3]))
@@ -190,11 +222,6 @@ def gridcube(filename, outfilename, var1="density", var2="column",
         newarr = zeros([nw,nz,ny,nx])
     print "Cube shape will be ",newarr.shape
 
-    if zerobads:
-        pv = vardict[plotvar]
-        pv[pv!=pv] = 0.0
-        pv[isinf(pv)] = 0.0
-
     if var4 is None:
         for ival,val in enumerate(unique(vardict[var3])):
           varfilter = vardict[var3]==val
@@ -214,8 +241,15 @@ def gridcube(filename, outfilename, var1="density", var2="column",
                                                              vardict[plotvar][varfilter],
                                                              tuple(np.meshgrid(xarr,yarr)) )
 
+    write_cube(newarr, outfilename, plotvar, xarr, yarr, zarr,
+               warr if var4 is not None else None)
+
+def write_cube(newarr, outfilename, plotvar, xarr, yarr, zarr, warr=None):
+    """
+    Write a gridcube cube to a .fits file with its axes in the header
+    """
     newfile = fits.PrimaryHDU(newarr)
-    if var4 is not None:
+    if warr is not None:
         newfile.header.update('CRVAL4' ,  (min(warr)) )
         newfile.header.update('CRPIX4' ,  1 )
         newfile.header.update('CTYPE4' ,  'NLIN-OPR' )
@@ -265,6 +299,7 @@ if __name__ == "__main__":
     parser.add_option("--var4",help="Is the grid 4-dimensional (default is 3)? If yes, this should be a variable name.",default=None)
     parser.add_option("--plottype",help="If you're plotting, what do you want to plot?",default='ratio')
     parser.add_option("--cutnumber",help="Specifies a 'slice' location along the third dimension",default=0)
+    parser.add_option("--shape",help="Comma-separated number of points along each grid axis (e.g. 11,201,201), for .dat files written in grid order by radex_engine; the cubes are then made without interpolation",default=None)
     parser.set_usage("%prog filename.dat [options]")
     parser.set_description(
     """
@@ -284,15 +319,18 @@ if __name__ == "__main__":
     # Users, change this code to fit your needs!
     if options.script:
         prefix = filename.replace(".dat","")
-        gridcube(prefix+'.dat',prefix+'_tau1.fits',plotvar='tau1',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_tau2.fits',plotvar='tau2',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_tex1.fits',plotvar='tex1',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_tex2.fits',plotvar='tex2',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_tline1.fits',plotvar='tline1',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_tline2.fits',plotvar='tline2',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_flux1.fits',plotvar='flux1',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_flux2.fits',plotvar='flux2',var4=options.var4)
-        gridcube(prefix+'.dat',prefix+'_ratio.fits',plotvar='ratio',var4=options.var4)
+        shape = None
+        if options.shape is not None:
+            shape = tuple([int(n) for n in options.shape.split(',')])
+        gridcube(prefix+'.dat',prefix+'_tau1.fits',plotvar='tau1',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_tau2.fits',plotvar='tau2',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_tex1.fits',plotvar='tex1',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_tex2.fits',plotvar='tex2',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_tline1.fits',plotvar='tline1',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_tline2.fits',plotvar='tline2',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_flux1.fits',plotvar='flux1',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_flux2.fits',plotvar='flux2',var4=options.var4,shape=shape)
+        gridcube(prefix+'.dat',prefix+'_ratio.fits',plotvar='ratio',var4=options.var4,shape=shape)
       
 
     else:
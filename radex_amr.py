@@ -0,0 +1,356 @@
+"""
+Adaptive mesh refinement of RADEX grids over two axes (usually density and
+column).
+
+Line ratios change sharply in only a few parts of a density/column plane,
+so most of a uniform 201x201 grid is spent where a much coarser grid would
+do.  run_amr computes a coarse grid first.  A cell of the plane is split in
+four when, between its corners, the line ratio (FluxLow/FluxUpp),
+tau or Tex of any act changes by more than tol (relative to the largest
+value at the corners, plus atol).  A cell is split at the geometric mean of
+its corners along a log-spaced axis (density, column) and at the arithmetic
+mean along a linear one (temperature).  Each level of new points is one
+run_grid call, so it is scheduled, cached and deduplicated like any grid,
+under MPI or not; the radex.out of every level is collected in
+radex.out.amr, which becomes radex.out at the end.
+
+The results go to a hierarchical store, radex_amr<suffix>.json: a line of
+metadata, then one line per point [i, j, point, results], where i and j are
+the point's coordinates on the finest lattice (the coarse axes subdivided
+2**levels times; a coarse point k sits at k*2**levels) and results are the
+read_model results for every act.  A cell was refined if and only if its
+centre is in the store.  resample_amr interpolates the store (bilinearly,
+in the finest cell around each point) onto a regular cube and writes
+ordinary .dat files, for plot_grids.gridcube(shape=...).
+
+With observed ratios (targets), the refinement is spent only where the
+predicted ratios can match the observations within nsigma sigma, up to a
+budget of points: a sparse grid, fine only where it matters for a source.
+
+The refinement criteria read read_radex_acts results (the default
+read_model): Tex at 3 and 4, tau at 5 and 6, fluxes at 9 and 10.
+"""
+from __future__ import print_function
+import json
+import math
+import os
+import sys
+import radex_engine
+
+# positions of the refinement quantities in a read_radex_acts result
+QUANTITIES = {'tex':(3,4), 'tau':(5,6)}
+
+def lattice_value(axis, scale, i, logscale=True):
+    """
+    Value of a refined axis at finest-lattice coordinate i (which may be
+    fractional): interpolated between the coarse values around it, in log
+    space if logscale, linearly otherwise
+    """
+    k = min(int(math.floor(i / float(scale))), len(axis)-2)
+    fraction = (i - k*scale) / float(scale)
+    if fraction == 0:
+        return axis[k]
+    if fraction == 1:
+        return axis[k+1]
+    if not logscale:
+        return axis[k] + fraction*(axis[k+1]-axis[k])
+    return 10**(math.log10(axis[k]) + fraction*(math.log10(axis[k+1])-math.log10(axis[k])))
+
+def make_point(outer, refine, values):
+    """
+    Put the two refined coordinates (values) back between the other ones
+    """
+    point = list(outer)
+    for position,value in sorted(zip(refine, values)):
+        point.insert(position, value)
+    return tuple(point)
+
+def other_axes(axes, refine):
+    return [axis for ii,axis in enumerate(axes) if ii not in refine]
+
+def point_quantities(results, quantities):
+    values = []
+    for result in results:
+        if 'ratio' in quantities:
+            values.append(flux_ratio(result))
+        for name in quantities:
+            if name != 'ratio':
+                values.extend([result[jj] for jj in QUANTITIES[name]])
+    return values
+
+def needs_refinement(corners, quantities, tol, atol):
+    """
+    True if any quantity differs between the corner results by more than
+    tol times its largest magnitude plus atol (NaN corners never count)
+    """
+    columns = zip(*[point_quantities(results, quantities) for results in corners])
+    for values in columns:
+        values = [value for value in values if value == value and abs(value) != float('inf')]
+        if len(values) < 2:
+            continue
+        if max(values)-min(values) > tol*max([abs(value) for value in values]) + atol:
+            return True
+    return False
+
+def flux_ratio(result):
+    return result[9]/result[10] if result[10] else float('nan')
+
+def target_score(corners, targets, nsigma):
+    """
+    None if the cell with these corner results cannot match the observed
+    ratios: for some target (act index, ratio, sigma), the range of the
+    act's flux ratio over the corners stays more than nsigma sigma away
+    from the ratio.  Otherwise the largest distance, in sigma, between the
+    mean of the corner ratios and an observed ratio (0 is a perfect match).
+    """
+    score = 0
+    for iact,ratio,sigma in targets:
+        values = [flux_ratio(results[iact]) for results in corners]
+        values = [value for value in values if value == value and abs(value) != float('inf')]
+        if not values:
+            return None
+        if max(values) < ratio-nsigma*sigma or min(values) > ratio+nsigma*sigma:
+            return None
+        score = max(score, abs(sum(values)/len(values)-ratio)/sigma)
+    return score
+
+def read_store(filename):
+    """
+    Returns (metadata, {(outer, i, j): results}) of an AMR store
+    """
+    known = {}
+    storefile = open(filename)
+    metadata = json.loads(storefile.readline())
+    refine = metadata['refine']
+    for line in storefile:
+        try:
+            i,j,point,results = json.loads(line)
+        except ValueError:
+            # truncated by a killed run
+            continue
+        outer = tuple(value for ii,value in enumerate(point) if ii not in refine)
+        known[outer,i,j] = [tuple(result) for result in results]
+    storefile.close()
+    return metadata,known
+
+def store_name(suffix):
+    return "radex_amr%s.json" % suffix
+
+def run_amr(axes, refine, acts, write_input, output_row, header, levels=3,
+            logscale=(True,True), tol=0.05, atol=1e-3, quantities=('ratio','tau','tex'), fields=(1,2),
+            targets=None, nsigma=3.0, budget=None, suffix='', resume=False,
+            log=sys.stdout, verbose=1, **options):
+    """
+    Compute an adaptively refined grid and store it (see the module
+    docstring).  Returns the name of the store.
+
+    axes - parameter axes in point order, as for radex_engine.grid_points;
+        every combination of the axes not in refine gets its own plane
+    refine - positions (in the point tuple) of the two axes to refine;
+        their values are the coarse grid
+    levels - number of times a cell can be split
+    logscale - for each refined axis, whether cells are split in log space
+        (log-spaced axes) or linearly (e.g. temperature)
+    tol, atol - refinement threshold (see needs_refinement)
+    quantities - any of 'ratio', 'tau', 'tex'
+    fields - positions of the two refined parameters in the read_model
+        results (density and column in read_radex_acts results), which
+        resample_amr sets to the exact values of the regular grid
+    targets - observed line ratios [(act index, ratio, sigma), ...]; if
+        given, a cell is refined when, for every target, the range of the
+        act's flux ratio at its corners reaches within nsigma sigma of the
+        observed ratio (see target_score), whatever tol says
+    budget - maximum number of points in the store; once it would be
+        exceeded no more cells are refined (with targets, the cells whose
+        ratios are closest to the observations go first)
+    resume - keep the points of an earlier run in the store, and those
+        its interrupted level had checkpointed
+    Other options (executable, slots, cachedir, ...) go to run_grid; write_input,
+    output_row and header are as for run_grid.
+    """
+    try:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    except ImportError:
+        comm = None
+    mpirank = comm.rank if comm is not None else 0
+    order = sorted(range(len(refine)), key=lambda kk: refine[kk])
+    refine = [refine[kk] for kk in order]
+    logscale = [bool(logscale[kk]) for kk in order]
+    scale = 2**levels
+    raxes = [axes[position] for position in refine]
+    outers = radex_engine.grid_points(*other_axes(axes, refine))
+    storename = store_name(suffix)
+
+    def point(outer, i, j):
+        return make_point(outer, refine, (lattice_value(raxes[0], scale, i, logscale[0]),
+                                          lattice_value(raxes[1], scale, j, logscale[1])))
+
+    known = {}
+    storefile = None
+    if mpirank == 0:
+        if resume and os.path.exists(storename):
+            metadata,known = read_store(storename)
+            if ([metadata['axes'],metadata['refine'],metadata['levels'],metadata.get('logscale',[True,True])]
+                    != json.loads(json.dumps([axes,refine,levels,logscale]))):
+                # a different grid; start again
+                known = {}
+        if known:
+            if verbose > 0: print("AMR: resuming with %i points from %s" % (len(known),storename), file=log)
+            storefile = open(storename,'a')
+            # a finished run has already renamed its collected models
+            if not os.path.exists("radex.out.amr") and os.path.exists("radex.out"):
+                os.rename("radex.out","radex.out.amr")
+        else:
+            storefile = open(storename,'w')
+            storefile.write(json.dumps({'axes':axes, 'refine':refine, 'levels':levels,
+                                        'logscale':logscale, 'fields':list(fields),
+                                        'acts':acts, 'header':header})+'\n')
+            open("radex.out.amr",'w').close()
+
+    new = [(outer,i*scale,j*scale) for outer in outers
+           for i in range(len(raxes[0])) for j in range(len(raxes[1]))]
+    cells = [(outer,i*scale,j*scale,scale) for outer in outers
+             for i in range(len(raxes[0])-1) for j in range(len(raxes[1])-1)]
+    ncomputed = 0
+    for level in range(levels+1):
+        if mpirank == 0:
+            new = [key for key in new if key not in known]
+        if comm is not None and comm.size > 1:
+            new = comm.bcast(new, root=0)
+        if new:
+            points = [point(*key) for key in new]
+            levelsuffix = "%s_amr%i" % (suffix,level)
+            if verbose > 0 and mpirank == 0: print("AMR level %i: computing %i points" % (level,len(points)), file=log)
+            radex_engine.run_grid(points, acts, write_input, output_row, header,
+                                  suffix=levelsuffix, resume=resume,
+                                  keep_checkpoints=True, log=log, verbose=verbose,
+                                  **options)
+            if mpirank == 0:
+                cpprefix = radex_engine.checkpoint_name(levelsuffix)
+                done = radex_engine.read_checkpoints(cpprefix, points, len(acts))
+                for index,key in enumerate(new):
+                    known[key] = done[index]
+                    outer,i,j = key
+                    storefile.write(json.dumps([i, j, list(points[index]),
+                                                [list(result) for result in done[index]]])+'\n')
+                storefile.flush()
+                radex_engine.remove_checkpoints(cpprefix)
+                for gfil in radex_engine.output_filenames(acts, levelsuffix):
+                    os.remove(gfil)
+                radex_engine.collect_radex_out("radex.out.amr")
+                ncomputed += len(new)
+        if level == levels:
+            break
+        new = []
+        children = []
+        if mpirank == 0:
+            candidates = []
+            for cell in cells:
+                outer,i,j,size = cell
+                corners = [known[outer,ii,jj] for ii in (i,i+size) for jj in (j,j+size)]
+                if targets:
+                    score = target_score(corners, targets, nsigma)
+                    if score is not None:
+                        candidates.append((score,cell))
+                elif needs_refinement(corners, quantities, tol, atol):
+                    candidates.append((0,cell))
+            # closest to the observations first, in case the budget runs out
+            candidates.sort()
+            refined = set()
+            for score,(outer,i,j,size) in candidates:
+                half = size//2
+                cellnew = set([(outer,ii,jj) for ii in (i,i+half,i+size)
+                               for jj in (j,j+half,j+size)]) - refined
+                cellnew = [key for key in cellnew if key not in known]
+                if budget is not None and len(known)+len(refined)+len(cellnew) > budget:
+                    if verbose > 0: print("AMR level %i: budget of %i points reached" % (level,budget), file=log)
+                    break
+                refined.update(cellnew)
+                children.extend([(outer,ii,jj,half) for ii in (i,i+half) for jj in (j,j+half)])
+            new = sorted(refined)
+            if verbose > 0: print("AMR level %i: refining %i of %i cells" % (level,len(children)//4,len(cells)), file=log)
+        cells = children
+        if comm is not None and comm.size > 1:
+            cells = comm.bcast(cells, root=0)
+        if not cells:
+            break
+
+    if mpirank == 0:
+        storefile.close()
+        radex_engine.restore_radex_out("radex.out.amr")
+        if verbose > 0:
+            uniform = len(outers)*((len(raxes[0])-1)*scale+1)*((len(raxes[1])-1)*scale+1)
+            print("AMR: %i points in %s (computed %i now) instead of %i for the uniform grid"
+                  % (len(known),storename,ncomputed,uniform), file=log)
+    return storename
+
+def interpolate(known, outer, scale, shape, u, v):
+    """
+    Bilinear interpolation of the store at fractional lattice coordinates
+    (u, v), in the finest cell that contains them
+    """
+    i = min(int(u // scale), shape[0]-2)*scale
+    j = min(int(v // scale), shape[1]-2)*scale
+    size = scale
+    while size > 1 and (outer,i+size//2,j+size//2) in known:
+        size //= 2
+        if u >= i+size:
+            i += size
+        if v >= j+size:
+            j += size
+    fu = (u-i)/float(size)
+    fv = (v-j)/float(size)
+    weights = [((i,j),(1-fu)*(1-fv)), ((i+size,j),fu*(1-fv)),
+               ((i,j+size),(1-fu)*fv), ((i+size,j+size),fu*fv)]
+    nacts = len(known[outer,i,j])
+    model_rows = []
+    for iact in range(nacts):
+        corners = [(known[(outer,)+corner][iact],weight) for corner,weight in weights if weight]
+        model_rows.append([sum([result[kk]*weight for result,weight in corners])
+                           for kk in range(len(corners[0][0]))])
+    return model_rows
+
+def resample_amr(storename, output_row, shape=None, suffix='', log=sys.stdout, verbose=1):
+    """
+    Write the .dat files of the regular grid that has the store's other axes
+    and shape[0] x shape[1] points (default: the finest lattice) along the
+    refined axes, interpolating the store.  Returns the full shape of the
+    grid, in axis order, for plot_grids.gridcube(shape=...).
+    """
+    metadata,known = read_store(storename)
+    axes,refine,levels = metadata['axes'],metadata['refine'],metadata['levels']
+    logscale = metadata.get('logscale', [True,True])
+    acts,header,fields = metadata['acts'],metadata['header'],metadata['fields']
+    scale = 2**levels
+    raxes = [axes[position] for position in refine]
+    lattice = [(len(axis)-1)*scale+1 for axis in raxes]
+    if shape is None:
+        shape = lattice
+    # positions of the regular grid on the lattice
+    targets = [[(lattice[kk]-1)*ii/float(shape[kk]-1) for ii in range(shape[kk])]
+               for kk in range(2)]
+    outers = radex_engine.grid_points(*other_axes(axes, refine))
+    npoints = len(outers)*shape[0]*shape[1]
+    gfils = radex_engine.output_filenames(acts, suffix)
+    writer = radex_engine.GridWriter(gfils, header, output_row, npoints)
+    index = 0
+    # grid order: the refined coordinates take their places among the others
+    order = radex_engine.grid_points(*[range(len(axis)) if ii not in refine else
+                                       range(shape[refine.index(ii)])
+                                       for ii,axis in enumerate(axes)])
+    for indices in order:
+        outer = tuple(axes[ii][kk] for ii,kk in enumerate(indices) if ii not in refine)
+        u = targets[0][indices[refine[0]]]
+        v = targets[1][indices[refine[1]]]
+        model_rows = interpolate(known, outer, scale, [len(axis) for axis in raxes], u, v)
+        for result in model_rows:
+            result[fields[0]] = lattice_value(raxes[0], scale, u, logscale[0])
+            result[fields[1]] = lattice_value(raxes[1], scale, v, logscale[1])
+        writer.add(index, [tuple(result) for result in model_rows])
+        index += 1
+    writer.close()
+    fullshape = [len(axis) if ii not in refine else shape[refine.index(ii)]
+                 for ii,axis in enumerate(axes)]
+    if verbose > 0: print("Resampled %s onto %s: %s" % (storename,'x'.join([str(n) for n in fullshape]),', '.join(gfils)), file=log)
+    return fullshape
@@ -0,0 +1,330 @@
+"""
+The programs that compute a grid's models, behind one interface.
+
+The executable name given to run_grid (or "solver" and "geometry" in a
+grid spec) selects the backend:
+    radex_lvg, radex_sphere, radex_slab - the RADEX binaries, run as
+        subprocesses (so is any other program name or path)
+    native_<geometry> - the in-process numpy solver (see radex_native)
+    pyradex_<geometry> - pyradex.Radex, RADEX's Fortran wrapped for python
+    fjdu_<geometry> - pyradex.fjdu.Fjdu, Fujun Du's myRadex
+Every backend turns the radex.inp records write_input produces into
+radex.out-style text, so the cache, checkpoints, radex.out and
+read_radex_acts work the same whichever computed the models.
+
+compare runs two backends on the same points at once, on a local process
+pool, and reports statistics of their differences as the chunks come in,
+without writing either set of results anywhere.
+
+Dependencies:
+    numpy (for every backend but the RADEX binaries)
+    pyradex (optional; for the pyradex and fjdu backends)
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import radex_engine
+
+# solvers run in-process; anything else is a program for the subprocess backend
+SOLVERS = ('radex', 'native', 'pyradex', 'fjdu')
+GEOMETRIES = ('lvg', 'sphere', 'slab')
+
+def executable_name(solver, geometry):
+    return '%s_%s' % (solver, geometry)
+
+def split_executable(executable):
+    """
+    (solver, geometry) of an executable name; ('radex', None) for a
+    program that is not one of the in-process solvers
+    """
+    solver,sep,geometry = executable.partition('_')
+    if solver in SOLVERS and solver != 'radex' and geometry in GEOMETRIES:
+        return solver,geometry
+    return 'radex',None
+
+def in_process(executable):
+    return split_executable(executable)[0] != 'radex'
+
+def run_models(chunk, write_input, executable, radexpath='.'):
+    """
+    Compute a chunk of grid points with an in-process backend, yielding each
+    model's radex.out text in order.  Failures are raised as RadexError, so
+    radex_engine.isolate_failures handles them as for the binaries.
+    """
+    solver,geometry = split_executable(executable)
+    if solver == 'native':
+        import radex_native
+        return radex_native.run_models(chunk, write_input, executable=executable,
+                                       radexpath=radexpath)
+    return run_pyradex(chunk, write_input, solver, geometry, radexpath=radexpath)
+
+# the pyradex object of this process for each solver, with what it was made
+# for: (geometry, radexpath, molfile), object.  Radex and Fjdu keep their
+# state (molecular data, geometry) in Fortran module globals, so a second
+# object in the same process would overwrite the first one's; there is only
+# ever one per solver, made again when the data file or geometry changes.
+_pyradex = {}
+
+def pyradex_object(solver, geometry, radexpath, params):
+    """
+    The pyradex.Radex or Fjdu object for a point's molecular data file and
+    geometry, made with the parameters of the first point it is used for
+    """
+    key = (geometry, radexpath, params['molfile'])
+    if solver not in _pyradex or _pyradex[solver][0] != key:
+        import pyradex
+        import radex_native
+        # drop the old object first, so only one ever holds the Fortran state
+        _pyradex.pop(solver, None)
+        species = os.path.splitext(params['molfile'])[0]
+        colliders = dict((radex_native.PRINTED_NAMES[name],density)
+                         for name,density in params['colliders'].items())
+        if solver == 'pyradex':
+            radex = pyradex.Radex(species=species, datapath=radexpath,
+                                  escapeProbGeom=geometry,
+                                  collider_densities=colliders,
+                                  temperature=params['tkin'],
+                                  column=params['column'],
+                                  deltav=params['deltav'],
+                                  tbackground=params['tbg'])
+        else:
+            import pyradex.fjdu
+            # Fjdu keeps only the directory part of datapath
+            radex = pyradex.fjdu.Fjdu(species=species,
+                                      datapath=os.path.join(radexpath, ''),
+                                      escapeProbGeom=geometry,
+                                      collider_densities=colliders,
+                                      temperature=params['tkin'],
+                                      column=params['column'],
+                                      deltav=params['deltav'],
+                                      tbg=params['tbg'])
+        _pyradex[solver] = (key, radex)
+    return _pyradex[solver][1]
+
+def unitless(value):
+    import numpy as np
+    return np.asarray(getattr(value, 'value', value), dtype=float)
+
+def run_pyradex(chunk, write_input, solver, geometry, radexpath='.'):
+    """
+    Run pyradex.Radex or Fjdu on each point of a chunk, yielding radex.out
+    text (see radex_native.format_model)
+
+    Written against the pyradex 0.4.2dev source and tested against stand-in
+    Radex and Fjdu classes (tests/test_backend.py), not yet run with pyradex
+    itself: check a few points with compare (e.g. radex_lvg against
+    pyradex_lvg) before trusting a grid.  density is set after temperature
+    (the thermal ortho/para split of H2 depends on it) and before
+    column_per_bin, so that Radex's column/abundance locking never changes
+    the column.
+    """
+    import numpy as np
+    import radex_native
+    for point in chunk:
+        params = radex_native.parse_input(radex_engine.input_record(write_input, point))
+        molecule = radex_native.load_molecule(params['molfile'], radexpath)
+        try:
+            radex = pyradex_object(solver, geometry, radexpath, params)
+            radex.temperature = params['tkin']
+            radex.density = dict((radex_native.PRINTED_NAMES[name],density)
+                                 for name,density in params['colliders'].items())
+            radex.column_per_bin = params['column']
+            radex.deltav = params['deltav']
+            radex.tbg = params['tbg']
+            niter = radex.run_radex()
+            # both report every line of the data file, in its order
+            pops = unitless(radex.level_population)[:molecule.nlevels]
+            trad = unitless(radex.T_B)
+            if len(trad) != molecule.nlines:
+                raise ValueError("%i lines instead of the %i of %s" % (len(trad),molecule.nlines,params['molfile']))
+            result = {'tex':unitless(radex.tex)[None,:], 'tau':unitless(radex.tau)[None,:],
+                      'trad':trad[None,:], 'flux':(1.0645*params['deltav']*trad)[None,:],
+                      'popup':pops[molecule.upper][None,:],
+                      'poplow':pops[molecule.lower][None,:],
+                      'niter':np.array([niter or 0])}
+        except Exception as error:
+            raise radex_engine.RadexError("%s failed: %s" % (solver,error))
+        yield radex_native.format_model(params, molecule, geometry, result, 0,
+                                        version=solver)
+
+# Differences compare: the read_radex_acts fields and the line ratio
+COMPARED = (('TexLow',3), ('TexUpp',4), ('TauLow',5), ('TauUpp',6),
+            ('TrotLow',7), ('TrotUpp',8), ('FluxLow',9), ('FluxUpp',10),
+            ('Ratio',None))
+# bins of the relative difference histogram: decades from 1e-8 to 1 in quarters
+HISTOGRAM_EDGES = [10**(-8+0.25*ii) for ii in range(33)]
+
+def relative_difference(a, b):
+    """
+    |a-b| relative to the larger of |a| and |b|, None if either is NaN
+    """
+    if a != a or b != b:
+        return None
+    scale = max(abs(a), abs(b))
+    return abs(a-b)/scale if scale > 0 else 0.0
+
+class DiffStats(object):
+    """
+    Running statistics of the relative differences of one quantity: count,
+    mean, maximum (and the point it occurred at), the number of points
+    only one backend computed, and a histogram for the percentiles
+    """
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.worst = None
+        self.missing = 0
+        self.histogram = [0]*(len(HISTOGRAM_EDGES)+1)
+
+    def add(self, point, diff):
+        if diff is None:
+            self.missing += 1
+            return
+        self.n += 1
+        self.total += diff
+        if diff > self.max or self.worst is None:
+            self.max,self.worst = diff,point
+        ibin = 0
+        while ibin < len(HISTOGRAM_EDGES) and diff > HISTOGRAM_EDGES[ibin]:
+            ibin += 1
+        self.histogram[ibin] += 1
+
+    @property
+    def mean(self):
+        return self.total/self.n if self.n else float('nan')
+
+    def percentile(self, q):
+        """
+        Upper edge of the histogram bin holding the q-th percentile (at
+        most the maximum)
+        """
+        if not self.n:
+            return float('nan')
+        count = 0
+        for ibin,nbin in enumerate(self.histogram):
+            count += nbin
+            if count >= q/100.0*self.n:
+                return min(HISTOGRAM_EDGES[ibin], self.max) if ibin < len(HISTOGRAM_EDGES) else self.max
+        return self.max
+
+def ratio(row):
+    return row[9]/row[10] if row[10] else float('nan')
+
+def add_differences(stats, points, results_a, results_b):
+    """
+    Add one chunk's results (lists with one list of rows per act) to stats
+    ({(act index, quantity): DiffStats})
+    """
+    for iact,(rows_a,rows_b) in enumerate(zip(results_a, results_b)):
+        for point,row_a,row_b in zip(points, rows_a, rows_b):
+            for name,field in COMPARED:
+                if field is None:
+                    a,b = ratio(row_a),ratio(row_b)
+                else:
+                    a,b = row_a[field],row_b[field]
+                if a == a or b == b:
+                    # (a line neither backend has is no difference)
+                    stats[iact,name].add(point, relative_difference(a, b))
+
+def print_differences(stats, acts, log=sys.stdout):
+    for iact,act in enumerate(acts):
+        print("%s:" % act[2], file=log)
+        print("  %-8s %9s %9s %9s %9s %8s  worst at" % ('', 'mean', 'median', '99%', 'max', 'missing'), file=log)
+        for name,field in COMPARED:
+            entry = stats[iact,name]
+            print("  %-8s %9.2e %9.2e %9.2e %9.2e %8i  %s" % (name, entry.mean, entry.percentile(50),
+                                                           entry.percentile(99), entry.max,
+                                                           entry.missing, entry.worst), file=log)
+
+# Grid description shared with the comparison workers (filled in before the
+# pool forks, as radex_engine._pool_state)
+_compare_state = {}
+
+def _compare_init(dirqueue):
+    workdir = dirqueue.get()
+    os.mkdir(workdir)
+    _compare_state['workdir'] = workdir
+    _compare_state['radexlog'] = open(os.devnull, 'w')
+
+def _compare_work(task):
+    executable,start,stop = task
+    state = _compare_state
+    results = radex_engine.run_chunk(state['points'][start:stop], state['acts'],
+                                     state['write_input'], state['read_model'],
+                                     executable=executable, timeout=state['timeout'],
+                                     workdir=state['workdir'], radexlog=state['radexlog'],
+                                     radexpath=state['radexpath'])
+    return executable,start,stop,results
+
+def compare(points, acts, write_input, executables, read_model=None, bw=0.01,
+            nprocs=None, minchunk=1, timeout=None, radexpath='.',
+            log=sys.stdout, verbose=1):
+    """
+    Run the two backends of executables (e.g. ("radex_lvg", "pyradex_lvg"))
+    on the same points concurrently and report the relative differences of
+    every act's fields (see COMPARED) as each chunk of points comes in.
+    Nothing is cached or written; RADEX binaries run in temporary
+    directories.  Returns {(act index, quantity): DiffStats}.
+
+    nprocs - local processes shared by the two backends (default: one per
+        core, at least two)
+    """
+    import functools
+    if read_model is None:
+        read_model = functools.partial(radex_engine.read_radex_acts, bw=bw)
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = max(nprocs, 2)
+    stats = dict(((iact,name),DiffStats()) for iact in range(len(acts)) for name,field in COMPARED)
+    chunks = list(radex_engine.guided_chunks(len(points), max(nprocs//2, 1), minchunk=minchunk))
+    # both backends get each chunk, one after the other, so their results
+    # for a chunk arrive together
+    tasks = [(executable,start,stop) for start,stop in chunks for executable in executables]
+    if verbose > 0: print("Comparing %s with %s on %i points" % (executables[0],executables[1],len(points)), file=log)
+    _compare_state.update(points=points, acts=acts, write_input=write_input,
+                          read_model=read_model, timeout=timeout,
+                          radexpath=os.path.abspath(radexpath))
+    tmpdir = tempfile.mkdtemp(prefix='radex_compare_')
+    dirqueue = multiprocessing.Queue()
+    for ii in range(nprocs):
+        dirqueue.put(os.path.join(tmpdir, "radex_temp_%02i" % ii))
+    pool = multiprocessing.Pool(nprocs, _compare_init, (dirqueue,))
+    try:
+        results = pool.imap(_compare_work, tasks)
+        ndone = 0
+        while True:
+            try:
+                first = results.next(1)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            while True:
+                try:
+                    second = results.next(1)
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+            executable,start,stop,results_a = first
+            results_b = second[3]
+            add_differences(stats, points[start:stop], results_a, results_b)
+            ndone += stop-start
+            if verbose > 1:
+                worst = max(stats, key=lambda key: stats[key].max)
+                print("Compared %i of %i points; largest difference %.2e (%s %s at %s)" % (
+                    ndone, len(points), stats[worst].max, acts[worst[0]][2], worst[1],
+                    stats[worst].worst), file=log)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _compare_state.clear()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if verbose > 0: print_differences(stats, acts, log=log)
+    return stats
@@ -0,0 +1,184 @@
+"""
+Content-addressed cache of RADEX results, shared between grid directories.
+
+Each cached entry is the radex.out text of one model.  The key is a hash of
+everything that determines that text: the contents of the molecular data
+file, the RADEX executable (and so the geometry it was compiled with), and
+the rest of the input record (frequency range, tkin, collider densities,
+tbg, column and dv).  The output file name is not part of the key.
+
+Entries live in <cachedir>/ab/abcdef...; a hit refreshes the file's mtime and
+evict() removes the least recently used entries once the cache is bigger
+than maxsize bytes.  New entries are written to a temporary file and renamed
+into place, so several processes (or grids) can share one cache.
+"""
+import hashlib
+import os
+import tempfile
+
+# Shared by every grid unless run_grid is given another cachedir
+DEFAULT_CACHEDIR = os.environ.get('RADEX_CACHE', os.path.expanduser('~/.radex_cache'))
+
+def file_hash(filename):
+    sha = hashlib.sha1()
+    infile = open(filename,'rb')
+    block = infile.read(1<<20)
+    while block:
+        sha.update(block)
+        block = infile.read(1<<20)
+    infile.close()
+    return sha.hexdigest()
+
+def find_executable(executable):
+    """
+    Full path of an executable, searching $PATH like the shell does
+    """
+    if os.path.dirname(executable):
+        return executable if os.path.exists(executable) else None
+    for path in os.environ.get('PATH','').split(os.pathsep):
+        candidate = os.path.join(path, executable)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def normalize(word):
+    """
+    Write numbers the same way whatever formatting write_input used
+    """
+    try:
+        return repr(float(word))
+    except ValueError:
+        return word
+
+def canonical_record(input_record):
+    """
+    The parts of a RADEX input record that determine the result, as one
+    string: the molecular data file name and every later word, with numbers
+    normalized.  Line 1, the output file name, does not change the result.
+    """
+    lines = input_record.split('\n')
+    words = [normalize(word) for line in lines[2:] for word in line.split()]
+    return ' '.join([lines[0].strip()]+words)
+
+class RadexCache(object):
+    """
+    cachedir - directory holding the cache (created if needed)
+    maxsize - size in bytes above which evict() drops old entries
+    radexpath - directory in which RADEX looks for molecular data files
+    """
+    def __init__(self, cachedir, maxsize=10e9, radexpath='.'):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.radexpath = radexpath
+        self._hashes = {}
+        if not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # another process made it first
+                pass
+
+    def moldata_hash(self, molfile):
+        """
+        Hash of a molecular data file's contents, or None if the file cannot
+        be found (results for it are then never cached)
+        """
+        if molfile not in self._hashes:
+            filename = os.path.join(self.radexpath, molfile)
+            if os.path.exists(filename):
+                self._hashes[molfile] = file_hash(filename)
+            else:
+                self._hashes[molfile] = None
+        return self._hashes[molfile]
+
+    def executable_hash(self, executable):
+        if ('exe',executable) not in self._hashes:
+            path = find_executable(executable)
+            if path is None:
+                self._hashes['exe',executable] = executable
+            else:
+                self._hashes['exe',executable] = file_hash(path)
+        return self._hashes['exe',executable]
+
+    def key(self, executable, input_record):
+        """
+        Cache key of one RADEX input record (the text write_input produces),
+        or None if the molecular data file cannot be found
+        """
+        molfile,_,record = canonical_record(input_record).partition(' ')
+        molhash = self.moldata_hash(molfile)
+        if molhash is None:
+            return None
+        sha = hashlib.sha1()
+        sha.update(' '.join([molhash, self.executable_hash(executable), record]).encode('ascii'))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def get(self, key):
+        """
+        Cached radex.out text for key, or None
+        """
+        if key is None:
+            return None
+        filename = self.path(key)
+        try:
+            cachefile = open(filename)
+        except IOError:
+            return None
+        model = cachefile.read()
+        cachefile.close()
+        try:
+            # mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return model
+
+    def contains(self, key):
+        """
+        Whether key is cached, without reading the entry or marking it used
+        """
+        return key is not None and os.path.exists(self.path(key))
+
+    def put(self, key, model):
+        if key is None:
+            return
+        filename = self.path(key)
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.mkdir(dirname)
+            except OSError:
+                pass
+        fd,tmpname = tempfile.mkstemp(dir=dirname)
+        tmpfile = os.fdopen(fd,'w')
+        tmpfile.write(model)
+        tmpfile.close()
+        os.rename(tmpname, filename)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in maxsize
+        """
+        entries = []
+        total = 0
+        for dirpath,dirnames,filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                fullname = os.path.join(dirpath,filename)
+                try:
+                    stat = os.stat(fullname)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,fullname))
+                total += stat.st_size
+        entries.sort()
+        for mtime,size,fullname in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(fullname)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,116 @@
+"""
+Runtime cost model of a RADEX grid, fitted to a pilot sample.
+
+RADEX's run time per point varies by orders of magnitude across a grid:
+optically thick, high density models need many more iterations than thin
+ones.  Cost is placed by (tkin, log10 density, log10 N/dv), the parameters
+RADEX's work depends on, read from each point's input record
+(point_coordinates).  run_grid(pilot=N) first runs about N points spread
+over the box of those coordinates (spread_sample) and times them.
+CostModel then predicts the cost of every other point from the pilot points
+nearest to it.  Points the result cache already holds are neither piloted
+nor charged.
+
+The prediction gives the expected core-hours and wall time before the full
+run starts.  radex_engine.next_chunk uses it to size chunks by predicted
+seconds instead of by number of points, so expensive regions are handed
+out in smaller pieces and the workers finish together.
+"""
+import bisect
+import math
+
+def point_coordinates(record):
+    """
+    (tkin, log10 total collider density, log10 N/dv) of a radex.inp record
+    """
+    lines = record.split('\n')
+    ncoll = int(lines[4])
+    density = sum([float(word) for word in lines[6:6+2*ncoll:2]])
+    column,deltav = float(lines[6+2*ncoll]),float(lines[7+2*ncoll])
+    return (float(lines[3]), math.log10(density), math.log10(column/deltav))
+
+def spread_sample(coordinates, candidates, nsample):
+    """
+    About nsample of the positions candidates, spread over the box their
+    coordinates span: for each of the first nsample points of a Sobol
+    sequence, the candidate nearest to it.  Each coordinate is first
+    snapped to the nearest value the candidates have, so on a cartesian
+    grid the candidate is found without a search.
+    """
+    import radex_sample
+    if not candidates:
+        return []
+    lookup = dict((coordinates[pos],pos) for pos in candidates)
+    axes = [sorted(set(axis)) for axis in zip(*lookup)]
+    scales = [(values[-1]-values[0]) or 1.0 for values in axes]
+    chosen = set()
+    for unit in radex_sample.sobol_points(min(nsample, len(candidates)), len(axes)):
+        target = tuple([min(values, key=lambda value: abs(value-values[0]-u*(values[-1]-values[0])))
+                        for values,u in zip(axes, unit)])
+        if target not in lookup:
+            target = min(lookup, key=lambda coords: sum([((a-b)/scale)**2 for a,b,scale in zip(coords, target, scales)]))
+        chosen.add(lookup[target])
+    return sorted(chosen)
+
+class CostModel(object):
+    """
+    coordinates - point_coordinates of the pilot points
+    seconds - time each pilot point took
+    neighbours - number of nearest pilot points a prediction averages
+    """
+    def __init__(self, coordinates, seconds, neighbours=4):
+        if not coordinates:
+            raise ValueError("A cost model needs at least one pilot point")
+        self.coordinates = [tuple(coords) for coords in coordinates]
+        # averaged in log: costs span orders of magnitude
+        self.logs = [math.log(max(value, 1e-6)) for value in seconds]
+        self.neighbours = neighbours
+
+    def point_cost(self, coords, scales):
+        """
+        Predicted seconds for a point: the geometric mean of the nearest
+        pilot points weighted by inverse squared distance, each coordinate
+        measured in units of scales (the grid's extent along it)
+        """
+        distances = sorted([(sum([((a-b)/scale)**2 for a,b,scale in zip(coords, pilot, scales)]), logcost)
+                            for pilot,logcost in zip(self.coordinates, self.logs)])
+        nearest = distances[:self.neighbours]
+        if nearest[0][0] == 0:
+            return math.exp(nearest[0][1])
+        weights = [1/distance for distance,logcost in nearest]
+        return math.exp(sum([weight*logcost for weight,(distance,logcost) in zip(weights, nearest)])/sum(weights))
+
+    def predict(self, coordinates):
+        """
+        Predicted seconds for each of a list of point_coordinates
+        """
+        scales = []
+        for axis in zip(*(list(coordinates)+self.coordinates)):
+            scales.append((max(axis)-min(axis)) or 1.0)
+        return [self.point_cost(coords, scales) for coords in coordinates]
+
+def cumulative(costs):
+    """
+    Running total of a list of costs, starting at 0 (so the cost of points
+    start:stop is total[stop]-total[start])
+    """
+    total = [0.0]
+    for cost in costs:
+        total.append(total[-1]+cost)
+    return total
+
+def chunk_stop(total, start, target, minchunk=1):
+    """
+    End of the chunk starting at start whose predicted cost is (just over)
+    target seconds, given the running total of the costs
+    """
+    npoints = len(total)-1
+    stop = bisect.bisect_left(total, total[start]+target, start+1)
+    return min(npoints, max(stop, start+minchunk, start+1))
+
+def format_duration(seconds):
+    hours,seconds = divmod(int(round(seconds)), 3600)
+    minutes,seconds = divmod(seconds, 60)
+    if hours:
+        return "%ih%02im" % (hours,minutes)
+    return "%im%02is" % (minutes,seconds)
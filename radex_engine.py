@@ -0,0 +1,1634 @@
+"""
+Shared execution engine for the radex_grid*.py scripts.
+
+The grid scripts only describe the grid (the parameter axes, write_input
+and the output columns).  This module flattens the whole grid into
+a list of points and hands out chunks of that list to RADEX workers on demand,
+so the wall time tracks the total work divided by the number of cores instead
+of the size of the biggest temperature slice.
+
+Without mpi4py the same chunks are farmed out to a pool of local processes
+(multiprocessing), each running RADEX in its own radex_temp_XX directory.
+An MPI rank can also keep several RADEX processes running at once
+(run_concurrent), so one rank per node is enough to use every core.
+
+Dependencies:
+    mpi4py (optional; without it the grid runs on a local process pool)
+    numpy, pyradex (optional; only for the in-process backends, see radex_backend)
+"""
+from __future__ import print_function
+import functools
+import glob
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import radex_backend
+import radex_cache
+import radex_cost
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# MPI message tags used by the coordinator/worker scheduler
+READY_TAG = 1
+WORK_TAG  = 2
+STOP_TAG  = 3
+
+def grid_points(*axes):
+    """
+    Flatten the cartesian product of the parameter axes into a list of points.
+    The order is the same as the nested for loops the scripts used to have
+    (last axis varies fastest).
+    """
+    return list(itertools.product(*axes))
+
+def next_chunk(start, npoints, nworkers, minchunk=1, chunk_factor=2, cost=None):
+    """
+    Guided self-scheduling: each request gets 1/(chunk_factor*nworkers) of the
+    remaining points, so chunks start large (few RADEX start-ups) and shrink
+    towards the end of the grid (no stragglers).
+    cost is the running total of the predicted seconds per point
+    (radex_cost.cumulative); with it, the chunks get that share of the
+    remaining predicted time instead of the remaining points.
+
+    Returns the (start, stop) slice of the flattened point list.
+    """
+    if cost is not None and cost[npoints] > cost[start]:
+        target = (cost[npoints]-cost[start]) / (chunk_factor*nworkers)
+        return start, radex_cost.chunk_stop(cost, start, target, minchunk=minchunk)
+    remaining = npoints - start
+    size = int(math.ceil(remaining / float(chunk_factor*nworkers)))
+    size = max(size, minchunk)
+    return start, min(npoints, start+size)
+
+def guided_chunks(npoints, nworkers, minchunk=1, cost=None):
+    """
+    The full sequence of (start, stop) slices next_chunk hands out
+    """
+    chunks = []
+    start = 0
+    while start < npoints:
+        start,stop = next_chunk(start, npoints, nworkers, minchunk=minchunk, cost=cost)
+        chunks.append((start,stop))
+        start = stop
+    return chunks
+
+def output_filenames(acts, suffix):
+    """
+    Names of the .dat grid files, one per act
+    """
+    return [act[2].replace(".dat",suffix+".dat") for act in acts]
+
+def output_format(header):
+    """
+    Fixed-width format string used for every line of the .dat files
+    """
+    return ' '.join(['%10.3e']*len(header)) + ' \n'
+
+def write_header(gfil, header):
+    grid = open(gfil,'w')
+    grid.write(output_format(header).replace('.3e','s') % tuple(header))
+    grid.close()
+
+def write_chunk_input(infile, chunk, write_input):
+    """
+    Write the RADEX input for every point in the chunk, with "1"
+    continuation records between them and a "0" at the end, then close infile
+    """
+    try:
+        for ii,point in enumerate(chunk):
+            write_input(infile,*point)
+            if ii == len(chunk)-1:
+                infile.write('0\n')
+            else:
+                infile.write('1\n')
+        infile.close()
+    except IOError:
+        # RADEX died and closed its stdin; follow_radex reports the failure
+        pass
+
+class RadexError(RuntimeError):
+    """
+    Raised when a RADEX process exits with an error
+    """
+
+class PointFailed(RadexError):
+    """
+    Raised when RADEX exits while computing a known point: the first one
+    of the chunk that was not yielded
+    """
+
+def radex_failed(command, status, error=RadexError):
+    raise error("Command %s failed with exit status %i" % (command,status))
+
+# RADEX processes currently running, so a terminated grid can kill them
+# (and start no new ones while it shuts down)
+_running = set()
+_terminated = threading.Event()
+
+def kill_running():
+    _terminated.set()
+    for proc in list(_running):
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+class Watchdog(object):
+    """
+    Kills a process once timeout seconds have passed since it was started
+    or last reset, i.e. since it started its current model
+    """
+    def __init__(self, proc, timeout):
+        self.proc = proc
+        self.timeout = timeout
+        self.fired = False
+        self.deadline = time.time()+timeout
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reset(self):
+        self.deadline = time.time()+self.timeout
+
+    def watch(self):
+        while not self.stopped.is_set():
+            remaining = self.deadline-time.time()
+            if remaining <= 0:
+                self.fired = True
+                try:
+                    self.proc.kill()
+                except OSError:
+                    # already gone
+                    pass
+                return
+            self.stopped.wait(remaining)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def start_watchdog(proc, timeout):
+    """
+    Kill proc if one of its models takes more than timeout seconds (None:
+    never); call reset_watchdog whenever it starts a new model
+    """
+    if timeout is None:
+        return None
+    return Watchdog(proc, timeout)
+
+def reset_watchdog(watchdog):
+    if watchdog is not None:
+        watchdog.reset()
+
+def stop_watchdog(watchdog):
+    if watchdog is not None:
+        watchdog.stop()
+
+def check_watchdog(watchdog, executable, timeout, error=RadexError):
+    if watchdog is not None and watchdog.fired:
+        raise error("Command %s killed after %g seconds on one model" % (executable,timeout))
+
+# RADEX prints this on stdout once a model has been written to radex.out
+RADEX_PROMPT = "Another calculation"
+
+def stream_radex(chunk, write_input, executable="radex_lvg", outfile='radex.out',
+                 cwd=None, timeout=None):
+    """
+    Run RADEX as a coprocess over a chunk of grid points, feeding the
+    parameter blocks through its stdin instead of a radex.inp file.
+
+    Yields the radex.out text of each model, in order, as soon as RADEX has
+    finished it.  The next parameter block is written before the previous
+    model is handed back, so RADEX never waits for the parser.
+    outfile must be the output file name write_input puts in each block.
+    RADEX runs in directory cwd (default: the current one) and is killed
+    if one model takes more than timeout seconds.
+    """
+    if cwd is not None:
+        outfile = os.path.join(cwd, outfile)
+    # gfortran buffers output to pipes and files; without this the prompt
+    # and the model would only show up when the buffers fill
+    env = dict(os.environ, GFORTRAN_UNBUFFERED_ALL='y')
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    if _terminated.is_set():
+        raise SystemExit("Terminated")
+    proc = subprocess.Popen([executable], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, env=env, cwd=cwd,
+                            universal_newlines=True)
+    _running.add(proc)
+    watchdog = start_watchdog(proc, timeout)
+    radexfile = None
+    finished = False
+    # RADEX writes its prompts without a newline (Fortran '(A,$)'), so
+    # stdout is read as it comes rather than by lines
+    pending = ''
+    try:
+        write_input(proc.stdin,*chunk[0])
+        proc.stdin.flush()
+        for ii in range(len(chunk)):
+            while RADEX_PROMPT not in pending:
+                data = os.read(proc.stdout.fileno(), 4096)
+                if not data:
+                    break
+                pending += data.decode('latin-1')
+            if RADEX_PROMPT not in pending:
+                # RADEX exited (or was killed) before finishing the model
+                check_watchdog(watchdog, executable, timeout, PointFailed)
+                radex_failed("%s (coprocess)" % executable, proc.wait(), PointFailed)
+                return
+            pending = pending[pending.index(RADEX_PROMPT)+len(RADEX_PROMPT):]
+            # RADEX is now waiting for its next parameters, so radex.out
+            # ends exactly at the end of this model
+            if radexfile is None:
+                radexfile = open(outfile)
+            position = radexfile.tell()
+            size = os.fstat(radexfile.fileno()).st_size
+            if ii+1 < len(chunk):
+                proc.stdin.write('1\n')
+                write_input(proc.stdin,*chunk[ii+1])
+            else:
+                proc.stdin.write('0\n')
+                finished = True
+            proc.stdin.flush()
+            reset_watchdog(watchdog)
+            # seeking clears the end-of-file flag left by the previous read
+            radexfile.seek(position)
+            yield radexfile.read(size-position)
+    finally:
+        stop_watchdog(watchdog)
+        if radexfile is not None:
+            radexfile.close()
+        proc.stdin.close()
+        proc.stdout.close()
+        if not finished and proc.poll() is None:
+            proc.kill()
+        status = proc.wait()
+        _running.discard(proc)
+    check_watchdog(watchdog, executable, timeout)
+    if status != 0:
+        radex_failed("%s (coprocess)" % executable, status)
+
+# First line of every model RADEX writes to radex.out
+RADEX_HEADER = "* Radex version"
+
+def follow_radex(chunk, write_input, executable="radex_lvg",
+                 outfile='radex.out', poll=0.05, cwd=None, timeout=None):
+    """
+    Run RADEX on a chunk without waiting for it to finish: a writer thread
+    generates the input records straight into RADEX's stdin while this
+    generator tails radex.out.  A model is yielded as soon as the next one
+    has started (or RADEX has exited), so parsing overlaps the run and
+    there is no radex.inp file and no parsing tail.
+    cwd and timeout are as for stream_radex.
+    """
+    if cwd is not None:
+        outfile = os.path.join(cwd, outfile)
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    if _terminated.is_set():
+        raise SystemExit("Terminated")
+    devnull = open(os.devnull,'w')
+    proc = subprocess.Popen([executable], stdin=subprocess.PIPE, cwd=cwd,
+                            stdout=devnull, universal_newlines=True)
+    _running.add(proc)
+    watchdog = start_watchdog(proc, timeout)
+    writer = threading.Thread(target=write_chunk_input,
+                              args=(proc.stdin, chunk, write_input))
+    writer.daemon = True
+    writer.start()
+
+    radexfile = None
+    buffer = ''
+    try:
+        while True:
+            exited = proc.poll() is not None
+            if radexfile is None and os.path.exists(outfile):
+                radexfile = open(outfile)
+            data = ''
+            if radexfile is not None:
+                # seeking clears the end-of-file flag left by the previous read
+                radexfile.seek(radexfile.tell())
+                data = radexfile.read()
+            buffer += data
+            # every model but the last one in the buffer is complete
+            start = buffer.find(RADEX_HEADER)
+            next_start = buffer.find(RADEX_HEADER, start+1)
+            while start >= 0 and next_start > 0:
+                reset_watchdog(watchdog)
+                yield buffer[start:next_start]
+                start = next_start
+                next_start = buffer.find(RADEX_HEADER, start+1)
+            buffer = buffer[max(start,0):]
+            if exited:
+                break
+            if not data:
+                time.sleep(poll)
+        if proc.returncode != 0:
+            check_watchdog(watchdog, executable, timeout)
+            radex_failed("%s < (input pipe) > /dev/null" % executable, proc.returncode)
+            return
+        if buffer:
+            yield buffer
+    finally:
+        stop_watchdog(watchdog)
+        if radexfile is not None:
+            radexfile.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        devnull.close()
+        _running.discard(proc)
+
+# Sometimes, fortran outputs things like "1.404+106" instead of "1.404E+106"
+bad_exp = re.compile("([0-9])([+-][0-9])")
+
+def radex_float(word):
+    try:
+        return float(word)
+    except ValueError:
+        return float(bad_exp.sub("\\1E\\2",word))
+
+def parse_radex_model(model):
+    """
+    Parse the text of one radex.out model in a single pass.
+
+    Returns (params, lines): params is a dict with tkin, tbg, column, deltav
+    and a "density" dict keyed by collider name as RADEX prints it (H2, pH2,
+    oH2, ...); lines is a list of (freq, tex, tau, trot, flux) tuples, flux
+    in K km/s, in the order RADEX printed them.
+    """
+    params = {'density':{}}
+    lines = []
+    for line in model.splitlines():
+        words = line.split()
+        if ' -- ' in line:
+            # level names may contain spaces, so count from the end:
+            # E_UP FREQ WAVEL T_EX TAU T_R POP_UP POP_LOW FLUX(K km/s) FLUX(erg)
+            numbers = words[-10:]
+            lines.append((radex_float(numbers[1]), radex_float(numbers[3]),
+                          radex_float(numbers[4]), radex_float(numbers[5]),
+                          radex_float(numbers[8])))
+        elif line.startswith('*'):
+            if words[1] == 'T(kin)':
+                params['tkin'] = radex_float(words[-1])
+            elif words[1] == 'T(background)':
+                params['tbg'] = radex_float(words[-1])
+            elif words[1] == 'Density':
+                params['density'][words[3]] = radex_float(words[-1])
+            elif words[1] == 'Column':
+                params['column'] = radex_float(words[-1])
+            elif words[1] == 'Line':
+                params['deltav'] = radex_float(words[-1])
+    return params,lines
+
+def find_line(lines, freq, bw=0.01):
+    """
+    First line within the fractional bandwidth bw of freq, or None
+    """
+    for line in lines:
+        if freq*(1-bw) <= line[0] <= freq/(1-bw):
+            return line
+    return None
+
+def read_radex_acts(model, acts, bw=0.01, deltav=False):
+    """
+    Extract every act's pair of lines from one radex.out model, parsing the
+    model only once.
+
+    Returns one tuple per act:
+    (tkin, dens, col, TexLow, TexUpp, TauLow, TauUpp, TrotLow, TrotUpp,
+     FluxLow, FluxUpp, opr)
+    where dens is the total H2 density and opr the ortho/para H2 ratio (0 if
+    RADEX was given a single collider).  Lines that are not in the model
+    are reported as NaN.  With deltav=True the line width (km/s) is added
+    at the end, for grids with a line width axis.
+    """
+    params,lines = parse_radex_model(model)
+    density = params['density']
+    dens = density.get('H2',0.0) + density.get('oH2',0.0) + density.get('pH2',0.0)
+    if density.get('oH2') and density.get('pH2'):
+        opr = density['oH2']/density['pH2']
+    else:
+        opr = 0.0
+    nan = float('nan')
+    results = []
+    for act in acts:
+        low = find_line(lines, act[0], bw) or (None,nan,nan,nan,nan)
+        upp = find_line(lines, act[1], bw) or (None,nan,nan,nan,nan)
+        results.append((params['tkin'], dens, params['column'],
+                        low[1], upp[1], low[2], upp[2], low[3], upp[3],
+                        low[4], upp[4], opr))
+    if deltav:
+        results = [result+(params['deltav'],) for result in results]
+    return results
+
+def input_record(write_input, point):
+    """
+    The text write_input produces for one grid point
+    """
+    record = StringIO()
+    write_input(record,*point)
+    return record.getvalue()
+
+def deduplicate(points, todo, done, write_input):
+    """
+    Run each distinct RADEX input once.  Points are compared by their
+    input record, canonicalized as for the cache key (radex_cache), so
+    e.g. two parameter combinations that write_input turns into the same
+    collider densities count as one model.  Points of todo that match a
+    done point get its results in done; of the others only the first of
+    each set of identical points is kept.
+    Returns (todo, copies): the points to run and a dict mapping each of
+    those to the later points that take its results.
+    """
+    def key(index):
+        return radex_cache.canonical_record(input_record(write_input, points[index]))
+    first = {}
+    for index in sorted(done):
+        first.setdefault(key(index), index)
+    unique = []
+    copies = {}
+    for index in todo:
+        record = key(index)
+        if record not in first:
+            first[record] = index
+            unique.append(index)
+        elif first[record] in done:
+            done[index] = done[first[record]]
+        else:
+            copies.setdefault(first[record], []).append(index)
+    return unique,copies
+
+def run_models(chunk, write_input, executable="radex_lvg", stream=True,
+               workdir=None, timeout=None, radexpath='.'):
+    """
+    Run RADEX once on a chunk, in directory workdir, yielding each model's
+    radex.out text.  RADEX is killed if one model takes more than timeout
+    seconds.
+    The in-process backends (native_*, pyradex_*, fjdu_*; see
+    radex_backend) compute the chunk in this process instead, reading the
+    molecular data from radexpath.
+    """
+    if radex_backend.in_process(executable):
+        return radex_backend.run_models(chunk, write_input, executable,
+                                        radexpath=radexpath)
+    if stream:
+        return stream_radex(chunk, write_input, executable=executable,
+                            cwd=workdir, timeout=timeout)
+    else:
+        return follow_radex(chunk, write_input, executable=executable,
+                            cwd=workdir, timeout=timeout)
+
+# Marks the stand-in model of a grid point RADEX could not compute
+FAILED_MARKER = "* RADEX failed"
+
+# collider names in RADEX input -> as printed in radex.out
+COLLIDERS = {'H2':'H2', 'p-H2':'pH2', 'o-H2':'oH2', 'e':'e', 'H':'H',
+             'He':'He', 'H+':'H+'}
+
+def failed_model(record, error):
+    """
+    Stand-in model text for a point RADEX failed on: the parameters from
+    the input record, a FAILED_MARKER line, and no lines, so read_model
+    reports NaN for every act.  It goes to read_model only, never to
+    radex.out: the point shows up as NaN in the .dat files and checkpoints.
+    """
+    words = record.split('\n')
+    ncoll = int(words[4])
+    colliders = words[5:5+2*ncoll]
+    tbg,column,deltav = words[5+2*ncoll:8+2*ncoll]
+    model = [RADEX_HEADER+"        : failed",
+             FAILED_MARKER+": %s" % error,
+             "* T(kin)            [K]: %s" % words[3].strip()]
+    for name,density in zip(colliders[::2],colliders[1::2]):
+        model.append("* Density of %s [cm-3]: %s" % (COLLIDERS.get(name.strip(),name.strip()),density.strip()))
+    model += ["* T(background)     [K]: %s" % tbg.strip(),
+              "* Column density [cm-2]: %s" % column.strip(),
+              "* Line width     [km/s]: %s" % deltav.strip()]
+    return '\n'.join(model)+'\n'
+
+def isolate_failures(chunk, write_input, executable="radex_lvg", stream=True,
+                     workdir=None, timeout=None, radexpath='.'):
+    """
+    run_models, but if RADEX fails (or times out) the point it failed on
+    gets a failed_model, is reported on stderr, and RADEX is started again
+    on the points after it, so every other point is computed normally.
+    Where that point is not known (follow_radex) the first unfinished point
+    is run on its own to find out.  Each bad point costs one or two RADEX
+    starts, and a point that hangs one or two timeouts.
+    """
+    options = dict(executable=executable, stream=stream, workdir=workdir,
+                   timeout=timeout, radexpath=radexpath)
+    rest = list(chunk)
+    while rest:
+        ndone = 0
+        error = None
+        try:
+            for model in run_models(rest, write_input, **options):
+                ndone += 1
+                yield model
+        except RadexError as failure:
+            error = failure
+        if error is None:
+            return
+        rest = rest[ndone:]
+        if not rest:
+            # every model was written before RADEX failed (on exit, or the
+            # watchdog fired just after the last one), so they are complete
+            print("RADEX failed after its last model: %s" % error, file=sys.stderr)
+            return
+        if len(rest) > 1 and not isinstance(error, PointFailed):
+            try:
+                model = list(run_models(rest[:1], write_input, **options))[0]
+            except RadexError as failure:
+                error = failure
+            else:
+                yield model
+                rest = rest[1:]
+                continue
+        print("RADEX failed on grid point %s: %s" % (rest[0],error), file=sys.stderr)
+        yield failed_model(input_record(write_input, rest[0]), error)
+        rest = rest[1:]
+
+def cached_models(chunk, write_input, cache, executable="radex_lvg", stream=True,
+                  workdir=None, timeout=None, radexpath='.'):
+    """
+    Yield the radex.out text of each point of the chunk, taking it from the
+    cache where possible and running RADEX once on the points that miss
+    """
+    keys = [cache.key(executable, input_record(write_input, point)) for point in chunk]
+    models = [cache.get(key) for key in keys]
+    misses = [point for point,model in zip(chunk,models) if model is None]
+    fresh = iter(())
+    if misses:
+        fresh = isolate_failures(misses, write_input, executable=executable,
+                                 stream=stream, workdir=workdir, timeout=timeout,
+                                 radexpath=radexpath)
+    for key,model in zip(keys,models):
+        if model is None:
+            model = next(fresh)
+            if FAILED_MARKER not in model:
+                cache.put(key, model)
+        yield model
+    # let RADEX finish and report its exit status
+    for model in fresh:
+        pass
+
+def iter_chunk(chunk, acts, write_input, read_model, executable="radex_lvg",
+               stream=True, cache=None, workdir=None, timeout=None,
+               radexlog=None, radexpath='.'):
+    """
+    Run RADEX once on a chunk of grid points and parse each model for every
+    act as soon as RADEX has written it.  Yields, for each point in order,
+    read_model(model, acts): a list with one result per act.
+
+    With stream=True, RADEX runs as a coprocess fed one model at a time (see
+    stream_radex); otherwise all the input is piped in at once and
+    radex.out is followed while RADEX runs (see follow_radex).
+    With a radex_cache.RadexCache, points already in the cache are not run.
+    RADEX runs in workdir (default: the current directory) and is killed
+    when one model takes more than timeout seconds.  Points RADEX fails on are isolated and
+    parsed from a failed_model, so they come out as NaN (see
+    isolate_failures).
+    Every model RADEX computed is also written to radexlog (a file or
+    AsyncWriter), by default radex.out.all in workdir.
+    """
+    if cache is None:
+        models = isolate_failures(chunk, write_input, executable=executable,
+                                  stream=stream, workdir=workdir, timeout=timeout,
+                                  radexpath=radexpath)
+    else:
+        models = cached_models(chunk, write_input, cache,
+                               executable=executable, stream=stream,
+                               workdir=workdir, timeout=timeout,
+                               radexpath=radexpath)
+    # keep a copy of every model RADEX computed on this worker
+    logfile = radexlog
+    if radexlog is None:
+        logfile = open(os.path.join(workdir or '.', 'radex.out.all'),'a')
+    try:
+        for model in models:
+            if FAILED_MARKER not in model:
+                logfile.write(model)
+            yield read_model(model, acts)
+    finally:
+        if radexlog is None:
+            logfile.close()
+
+def run_chunk(chunk, acts, write_input, read_model, executable="radex_lvg",
+              stream=True, cache=None, workdir=None, timeout=None,
+              radexlog=None, radexpath='.'):
+    """
+    Run RADEX once on a chunk of grid points and parse the result for every
+    act.  Returns a list (one entry per act) of lists of read_model results.
+    """
+    results = [[] for act in acts]
+    for model_rows in iter_chunk(chunk, acts, write_input, read_model,
+                                 executable=executable, stream=stream,
+                                 cache=cache, workdir=workdir, timeout=timeout,
+                                 radexlog=radexlog, radexpath=radexpath):
+        for rows,radex_out in zip(results,model_rows):
+            rows.append(radex_out)
+    return results
+
+def run_pilot(chunk, acts, write_input, read_model, executable="radex_lvg",
+              stream=True, cache=None, timeout=None, workdir='.', radexlog=None,
+              radexpath='.'):
+    """
+    iter_chunk, timing each point.  Returns a list of (results, seconds).
+    """
+    timed = []
+    last = time.time()
+    for results in iter_chunk(chunk, acts, write_input, read_model,
+                              executable=executable, stream=stream, cache=cache,
+                              workdir=workdir, timeout=timeout, radexlog=radexlog,
+                              radexpath=radexpath):
+        now = time.time()
+        timed.append([results, now-last])
+        last = now
+    if len(timed) > 2:
+        # the first point also paid for starting RADEX, which every chunk
+        # pays once whatever its size; count it as a typical point
+        timed[0][1] = min(timed[0][1], sorted([seconds for results,seconds in timed[1:]])[(len(timed)-1)//2])
+    return [tuple(item) for item in timed]
+
+def slot_name(slot):
+    return "slot_%02i" % slot
+
+def run_concurrent(chunks, acts, write_input, read_model, nslots,
+                   executable="radex_lvg", stream=True, cache=None,
+                   timeout=None, workdir='.', radexlog=None, radexpath='.'):
+    """
+    Keep up to nslots RADEX processes running from this one process, each
+    working through the list of chunks in its own slot_XX subdirectory of
+    workdir (removed at the end, also after a failure).  The models of
+    every slot go to radexlog, which must be an AsyncWriter (by default one
+    appending to workdir/radex.out.all).
+    Yields (chunk number, run_chunk results) as each chunk finishes, in
+    whatever order they finish.  After the first failure (including a
+    timeout) no new chunks are started, and the error is raised here once the
+    running ones have stopped.
+
+    The processes are watched by one thread each; the GIL is no bottleneck
+    because the threads spend their time waiting on RADEX.
+    """
+    logfile = radexlog
+    if radexlog is None:
+        logfile = AsyncWriter(os.path.join(workdir, 'radex.out.all'))
+    tasks = queue.Queue()
+    for item in enumerate(chunks):
+        tasks.put(item)
+    finished = queue.Queue()
+    failed = threading.Event()
+
+    def slot(workdir):
+        if not os.path.exists(workdir):
+            os.mkdir(workdir)
+        while not failed.is_set():
+            try:
+                ichunk,chunk = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results = run_chunk(chunk, acts, write_input, read_model,
+                                    executable=executable, stream=stream,
+                                    cache=cache, workdir=workdir,
+                                    timeout=timeout, radexlog=logfile,
+                                    radexpath=radexpath)
+            except Exception as error:
+                failed.set()
+                finished.put((ichunk, None, error))
+                return
+            finished.put((ichunk, results, None))
+
+    threads = [threading.Thread(target=slot, args=(os.path.join(workdir, slot_name(ii)),))
+               for ii in range(min(nslots, len(chunks)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for ii in range(len(chunks)):
+            # wait in short steps, as in run_pool
+            while True:
+                try:
+                    ichunk,results,error = finished.get(timeout=1)
+                    break
+                except queue.Empty:
+                    pass
+            if error is not None:
+                raise error
+            yield ichunk,results
+    finally:
+        failed.set()
+        for thread in threads:
+            thread.join()
+        for ii in range(len(threads)):
+            shutil.rmtree(os.path.join(workdir, slot_name(ii)), ignore_errors=True)
+        if radexlog is None:
+            logfile.close()
+
+class AsyncWriter(object):
+    """
+    Appends text to a file from a background thread, so whoever calls
+    write() (RADEX slots on node-local scratch, say) does not wait for the
+    filesystem the file lives on.  Safe to share between threads.
+    """
+    def __init__(self, filename, mode='a'):
+        self.outfile = open(filename, mode)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        text = self.queue.get()
+        while text is not None:
+            self.outfile.write(text)
+            text = self.queue.get()
+        self.outfile.close()
+
+    def write(self, text):
+        self.queue.put(text)
+
+    def close(self):
+        """
+        Write out everything queued so far and close the file
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+def scratch_dir(scratch, rank):
+    """
+    A new private working directory for one RADEX worker under the scratch
+    root (e.g. /dev/shm or $TMPDIR); unique, so jobs sharing a node do not
+    collide
+    """
+    return tempfile.mkdtemp(prefix="radex_temp_%02i_" % rank, dir=scratch)
+
+class GridWriter(object):
+    """
+    Writes the .dat files of a grid in grid order, whatever order the points
+    are finished in.  Each point's rows are formatted as soon as they are
+    added and stored at the point's index in a preallocated list; the run of
+    finished points at the front of the list is written out (and dropped)
+    immediately, so the files are byte-identical however many workers ran.
+    """
+    def __init__(self, gfils, header, output_row, npoints):
+        for gfil in gfils:
+            write_header(gfil, header)
+        self.grids = [open(gfil,'a') for gfil in gfils]
+        self.fmt = output_format(header)
+        self.output_row = output_row
+        self.rows = [None]*npoints
+        self.next_index = 0
+
+    def add(self, index, model_rows):
+        """
+        Store the read_model results (one per act) of grid point index
+        """
+        self.rows[index] = [self.fmt % tuple(self.output_row(radex_out))
+                            for radex_out in model_rows]
+        while self.next_index < len(self.rows) and self.rows[self.next_index] is not None:
+            for grid,line in zip(self.grids,self.rows[self.next_index]):
+                grid.write(line)
+            self.rows[self.next_index] = None
+            self.next_index += 1
+
+    def flush(self):
+        for grid in self.grids:
+            grid.flush()
+
+    def close(self):
+        for grid in self.grids:
+            grid.close()
+
+def checkpoint_name(suffix):
+    """
+    Prefix of the checkpoint files of a grid; each process that computes
+    points appends to its own <prefix>.XX file in the submission directory
+    """
+    return "radex_grid%s.checkpoint" % suffix
+
+def write_checkpoint(cpfile, index, point, results):
+    """
+    Record one finished grid point: its index in the point list, its
+    parameters (to check the grid has not changed on --resume) and the
+    read_model results for every act
+    """
+    cpfile.write(json.dumps([index, list(point), [list(r) for r in results]])+'\n')
+
+def read_checkpoints(prefix, points, nacts):
+    """
+    Collect the valid results of earlier runs of this grid.  Returns a dict
+    {point index: list of per-act results}.  Records that are truncated (the
+    run was killed while writing), belong to a different grid or have the
+    wrong number of acts are ignored, so those points are simply recomputed.
+    """
+    done = {}
+    for filename in sorted(glob.glob(prefix+".*")):
+        cpfile = open(filename)
+        for line in cpfile:
+            try:
+                index,point,results = json.loads(line)
+            except ValueError:
+                continue
+            if (0 <= index < len(points) and list(points[index]) == point
+                    and len(results) == nacts):
+                done[index] = [tuple(r) for r in results]
+        cpfile.close()
+    return done
+
+def remove_checkpoints(prefix):
+    for filename in glob.glob(prefix+".*"):
+        os.remove(filename)
+
+def schedule(comm, npoints, work, collect=None, minchunk=1,
+             coordinator_works=False, cost=None, log=sys.stdout, verbose=1):
+    """
+    Coordinator/worker scheduler over the flattened grid.
+
+    Rank 0 is the coordinator: it waits for "ready" messages and replies with
+    the next (start, stop) slice of the point list until the grid is
+    exhausted.  Every other rank loops asking for work and calling
+    work(start, stop); whatever work returns travels back to the coordinator
+    with the rank's next "ready" message and is passed to collect there.
+    With coordinator_works, rank 0 also takes slices for itself, working on
+    them in a thread while the main thread keeps answering the other ranks
+    (only the main thread talks MPI).
+    cost (see next_chunk) sizes the slices by predicted run time.
+    Without MPI (or with a single rank) the whole grid is one chunk run in
+    this process.
+    """
+    if comm is None or comm.size == 1:
+        results = work(0, npoints)
+        if collect is not None:
+            collect(results)
+        return
+
+    from mpi4py import MPI
+    nworkers = comm.size - 1
+    if coordinator_works:
+        nworkers += 1
+    if comm.rank == 0:
+        # the next slice to hand out, shared with the local worker thread
+        state = {'start':0}
+        lock = threading.Lock()
+
+        def claim(worker):
+            with lock:
+                start = state['start']
+                if start >= npoints:
+                    return None
+                start,stop = next_chunk(start, npoints, nworkers, minchunk=minchunk, cost=cost)
+                state['start'] = stop
+            if verbose > 1: print("Coordinator: sending points %i:%i of %i to processor %i" % (start,stop,npoints,worker), file=log)
+            return start,stop
+
+        def gathered(results):
+            if results is not None and collect is not None:
+                with lock:
+                    collect(results)
+
+        def local_worker():
+            try:
+                chunk = claim(0)
+                while chunk is not None:
+                    gathered(work(*chunk))
+                    chunk = claim(0)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                comm.Abort(1)
+
+        if coordinator_works:
+            thread = threading.Thread(target=local_worker)
+            thread.daemon = True
+            thread.start()
+        status = MPI.Status()
+        nactive = comm.size - 1
+        while nactive > 0:
+            results = comm.recv(source=MPI.ANY_SOURCE, tag=READY_TAG, status=status)
+            worker = status.Get_source()
+            gathered(results)
+            chunk = claim(worker)
+            if chunk is not None:
+                comm.send(chunk, dest=worker, tag=WORK_TAG)
+            else:
+                comm.send(None, dest=worker, tag=STOP_TAG)
+                nactive -= 1
+        if coordinator_works:
+            thread.join()
+    else:
+        results = None
+        while True:
+            comm.send(results, dest=0, tag=READY_TAG)
+            chunk = comm.recv(source=0, tag=MPI.ANY_TAG)
+            if chunk is None:
+                break
+            try:
+                results = work(*chunk)
+            except Exception:
+                # the coordinator would wait for this rank forever; stop the
+                # whole job instead (finished points are in the checkpoints)
+                import traceback
+                traceback.print_exc()
+                comm.Abort(1)
+
+def merge_radex_out(ndirs):
+    """
+    Concatenate the radex.out.all files of the radex_temp_XX directories into
+    radex.out, then remove the temporary directories (also those an
+    interrupted run with more workers left)
+    """
+    # if a radex.out file exists, move it to radex.out.old
+    if os.path.exists("radex.out"):
+        os.rename("radex.out","radex.out.old")
+    radexout = open("radex.out",'w')
+    tempdirs = set(["radex_temp_%02i" % ii for ii in range(ndirs)])
+    for tempdir in sorted(tempdirs | set(glob.glob("radex_temp_[0-9][0-9]"))):
+        if os.path.exists(os.path.join(tempdir,"radex.out.all")):
+            infile = open(os.path.join(tempdir,"radex.out.all"))
+            shutil.copyfileobj(infile, radexout)
+            infile.close()
+        if os.path.exists(tempdir):
+            shutil.rmtree(tempdir)
+    radexout.close()
+
+def append_radex_out(filename):
+    """
+    Move the models in filename (e.g. those of the pilot run) to the end of
+    radex.out
+    """
+    if os.path.exists(filename):
+        radexout = open("radex.out",'a')
+        infile = open(filename)
+        shutil.copyfileobj(infile, radexout)
+        infile.close()
+        radexout.close()
+        os.remove(filename)
+
+def collect_radex_out(collected):
+    """
+    Move radex.out to the end of collected, for runs made of several
+    run_grid calls, each of which would replace the radex.out of the last
+    """
+    if os.path.exists("radex.out"):
+        outfile = open(collected,'a')
+        infile = open("radex.out")
+        shutil.copyfileobj(infile, outfile)
+        infile.close()
+        outfile.close()
+        os.remove("radex.out")
+
+def restore_radex_out(collected):
+    """
+    Make the models gathered by collect_radex_out the radex.out
+    """
+    if os.path.exists("radex.out"):
+        os.rename("radex.out","radex.out.old")
+    if os.path.exists(collected):
+        os.rename(collected,"radex.out")
+
+def model_key(params):
+    """
+    A model's parameters (as from parse_radex_model) at the precision
+    radex.out prints them, to tell which grid point a model belongs to
+    """
+    densities = sorted(["%s %.3e" % (name,density) for name,density in params['density'].items()])
+    return ("%.3f" % params['tkin'], "%.3f" % params['tbg'], "%.3e" % params['column'],
+            "%.3f" % params['deltav'], tuple(densities))
+
+def record_key(record):
+    """
+    model_key of the model RADEX writes for an input record
+    """
+    words = record.split('\n')
+    ncoll = int(words[4])
+    colliders = words[5:5+2*ncoll]
+    tbg,column,deltav = words[5+2*ncoll:8+2*ncoll]
+    density = dict((COLLIDERS.get(name.strip(),name.strip()),float(value))
+                   for name,value in zip(colliders[::2],colliders[1::2]))
+    return model_key({'tkin':float(words[3]), 'tbg':float(tbg), 'column':float(column),
+                      'deltav':float(deltav), 'density':density})
+
+def split_models(infile):
+    """
+    The models of a radex.out-style file, one text each
+    """
+    model = []
+    for line in infile:
+        if line.startswith(RADEX_HEADER) and model:
+            yield ''.join(model)
+            model = []
+        model.append(line)
+    if model:
+        yield ''.join(model)
+
+def prune_radex_logs(keys, log=sys.stdout, verbose=1):
+    """
+    Before a resumed run: keep only the models of finished grid points
+    (their record_keys) in the radex.out pieces the interrupted run left
+    (radex.out.pilot, radex.out.all, radex_temp_XX/radex.out.all).  The
+    other points are run again, so their models, and a model cut off by the
+    interruption, would otherwise end up in radex.out twice.
+    """
+    ndropped = 0
+    for filename in ["radex.out.pilot", "radex.out.all"] + glob.glob("radex_temp_[0-9][0-9]/radex.out.all"):
+        if not os.path.exists(filename):
+            continue
+        infile = open(filename)
+        outfile = open(filename+".pruned", 'w')
+        for model in split_models(infile):
+            try:
+                key = model_key(parse_radex_model(model)[0])
+            except (KeyError, ValueError, IndexError):
+                key = None
+            if key in keys:
+                outfile.write(model)
+            else:
+                ndropped += 1
+        infile.close()
+        outfile.close()
+        os.rename(filename+".pruned", filename)
+    if verbose > 0 and ndropped: print("Resuming: dropped %i models of unfinished grid points from radex.out" % ndropped, file=log)
+
+def shard_indices(npoints, ishard, nshards):
+    """
+    Indices of the grid points that belong to shard ishard (0..nshards-1).
+    Shards take every nshards-th point, so each gets a similar mix of cheap
+    and expensive models, and the split only depends on the grid.
+    """
+    return list(range(ishard, npoints, nshards))
+
+def shard_dir(ishard, nshards):
+    return "radex_shard_%i_of_%i" % (ishard,nshards)
+
+def merge_shards(points, acts, output_row, header, nshards, suffix='',
+                 log=sys.stdout, verbose=1):
+    """
+    Assemble the .dat files and radex.out of a grid run as nshards separate
+    shards (run_grid(shard=(i,N))) from their checkpoint records.  If a
+    shard is missing points, nothing is written and the incomplete shards
+    are listed so they can be rerun (with --resume to keep what they did).
+    Returns True if the grid was merged.
+    """
+    results = {}
+    incomplete = []
+    for ishard in range(nshards):
+        indices = shard_indices(len(points), ishard, nshards)
+        cpprefix = os.path.join(shard_dir(ishard, nshards), checkpoint_name(suffix))
+        done = read_checkpoints(cpprefix, [points[ii] for ii in indices], len(acts))
+        if verbose > 1: print("Shard %i of %i: %i of %i points done" % (ishard,nshards,len(done),len(indices)), file=log)
+        if len(done) < len(indices):
+            incomplete.append(ishard)
+        for local,index in enumerate(indices):
+            if local in done:
+                results[index] = done[local]
+    if incomplete:
+        print("Shards %s of %i are incomplete; rerun them with --shard i/%i --resume" % (', '.join([str(ii) for ii in incomplete]),nshards,nshards), file=log)
+        return False
+
+    gfils = output_filenames(acts, suffix)
+    writer = GridWriter(gfils, header, output_row, len(points))
+    for index in range(len(points)):
+        writer.add(index, results[index])
+    writer.close()
+
+    if os.path.exists("radex.out"):
+        os.rename("radex.out","radex.out.old")
+    radexout = open("radex.out",'w')
+    for ishard in range(nshards):
+        shardout = os.path.join(shard_dir(ishard, nshards), "radex.out")
+        if os.path.exists(shardout):
+            infile = open(shardout)
+            shutil.copyfileobj(infile, radexout)
+            infile.close()
+    radexout.close()
+    if verbose > 0: print("Merged %i shards into %s" % (nshards,', '.join(gfils)), file=log)
+    return True
+
+def parse_args(argv):
+    """
+    Split the grid options off a script's command line:
+        --resume       reuse the checkpoints of an interrupted run
+        --shard i/N    compute only shard i (0..N-1) of N
+        --merge N      assemble the .dat files of N finished shards
+    Returns (options, other arguments).
+    """
+    options = {'resume':False, 'shard':None, 'merge':None}
+    args = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--resume':
+            options['resume'] = True
+        elif arg == '--shard':
+            ishard,nshards = [int(x) for x in argv.pop(0).split('/')]
+            if not 0 <= ishard < nshards:
+                raise ValueError("--shard %i/%i: shard must be 0..%i" % (ishard,nshards,nshards-1))
+            options['shard'] = (ishard,nshards)
+        elif arg == '--merge':
+            options['merge'] = int(argv.pop(0))
+        else:
+            args.append(arg)
+    return options,args
+
+# Grid description shared with the local pool workers.  It is filled in
+# before the pool is created, so forked workers inherit it and only the
+# (start, stop) slices have to be sent to them.
+_pool_state = {}
+
+def _pool_init(dirqueue, resume=False):
+    """
+    Give each pool worker its own radex_temp_XX directory for radex.out.all
+    and its own (possibly scratch) working directory for RADEX
+    """
+    # pool.terminate() stops the workers with SIGTERM: let it kill them,
+    # rather than run_grid's handler raising SystemExit wherever they are
+    # (possibly holding a pool lock, which hangs the pool); their RADEX
+    # processes exit when their stdin closes
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logdir,workdir = dirqueue.get()
+    for newdir in (logdir,workdir):
+        if not os.path.exists(newdir):
+            os.mkdir(newdir)
+    _pool_state['workdir'] = workdir
+    _pool_state['radexlog'] = os.path.join(logdir, 'radex.out.all')
+    if os.path.exists(_pool_state['radexlog']) and not resume:
+        os.remove(_pool_state['radexlog'])
+
+def _pool_work(chunk):
+    start,stop = chunk
+    state = _pool_state
+    radexlog = open(state['radexlog'],'a')
+    try:
+        results = run_chunk(state['points'][start:stop], state['acts'],
+                            state['write_input'], state['read_model'],
+                            executable=state['executable'], stream=state['stream'],
+                            cache=state['cache'], timeout=state['timeout'],
+                            workdir=state['workdir'], radexlog=radexlog,
+                            radexpath=state['radexpath'])
+    finally:
+        radexlog.close()
+    return start,stop,results
+
+def run_pool(points, acts, write_input, read_model, nprocs,
+             executable="radex_lvg", minchunk=1, stream=True, resume=False,
+             cache=None, timeout=None, scratch=None, cost=None, radexpath='.'):
+    """
+    Run the grid on a pool of nprocs local processes.  Yields
+    (start, stop, results) for each chunk, in grid order, as soon as it (and
+    every chunk before it) is done.  The workers leave their radex.out.all in
+    radex_temp_00 .. radex_temp_<nprocs-1>.  With a scratch directory, RADEX
+    itself runs in a private directory under scratch, removed at the end.
+    cost sizes the chunks by predicted run time (see next_chunk).
+    """
+    _pool_state.update(points=points, acts=acts, write_input=write_input,
+                       read_model=read_model, executable=executable,
+                       stream=stream, cache=cache, timeout=timeout,
+                       radexpath=radexpath)
+    dirqueue = multiprocessing.Queue()
+    workdirs = []
+    for ii in range(nprocs):
+        logdir = os.path.abspath("radex_temp_%02i" % ii)
+        workdir = logdir
+        if scratch is not None:
+            workdir = scratch_dir(scratch, ii)
+            workdirs.append(workdir)
+        dirqueue.put((logdir,workdir))
+    pool = multiprocessing.Pool(nprocs, _pool_init, (dirqueue,resume))
+    try:
+        results = pool.imap(_pool_work, guided_chunks(len(points), nprocs, minchunk=minchunk, cost=cost))
+        while True:
+            # wait in short steps: a bare next() cannot be interrupted by
+            # signals under python 2
+            try:
+                result = results.next(1)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _pool_state.clear()
+        for workdir in workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def _terminate(signum, frame):
+    kill_running()
+    raise SystemExit("Terminated by signal %i" % signum)
+
+def run_grid(points, acts, write_input, output_row, header, read_model=None,
+             bw=0.01, suffix='', executable="radex_lvg", minchunk=1, nprocs=None,
+             slots=1, timeout=None, stream=True, resume=False, checkpoint_interval=60,
+             cachedir=radex_cache.DEFAULT_CACHEDIR, cachesize=10e9,
+             radexpath='.', scratch=None, pilot=0, shard=None,
+             keep_checkpoints=False, log=sys.stdout, verbose=1):
+    """
+    Run RADEX over every point of a grid and write one .dat file per act.
+
+    points - list of parameter tuples; each is passed as write_input(infile,*point)
+    acts - list of [lowfreq, uppfreq, filename] as in the grid scripts
+    write_input - function writing one model's parameters to radex.inp
+    output_row - converts one act's result into the tuple written to the .dat file
+    header - column names of the .dat file
+    read_model - function(model_text, acts) returning one result per act;
+        defaults to read_radex_acts, which parses each model once
+    bw - fractional bandwidth used to match the act frequencies
+    minchunk - smallest number of points handed to a worker at once
+    nprocs - number of local RADEX processes to use when mpi4py is not
+        available (default: one per core)
+    slots - number of RADEX processes each MPI rank (or the single process
+        of a serial run) keeps running at once (see run_concurrent); None
+        means one per core.  With more than one slot, run one MPI rank per
+        node: rank 0 then computes too, besides coordinating.
+    timeout - seconds one model may take before its RADEX process is killed;
+        the point comes out as NaN and RADEX is started again on the rest of
+        the chunk (default: no limit)
+    stream - run RADEX as a coprocess fed one model at a time through stdin
+        (see stream_radex) rather than piping in a whole chunk and following
+        radex.out (see follow_radex)
+    resume - reuse the points recorded in the checkpoint files of an
+        interrupted run of the same grid and only compute the rest
+    checkpoint_interval - seconds between flushes of the checkpoint files
+    cachedir - RADEX result cache shared between grids (None to disable);
+        models already in it are not run again (see radex_cache)
+    cachesize - size in bytes the cache is trimmed to after the run
+    radexpath - directory in which RADEX finds the molecular data files;
+        their contents are part of the cache key
+    scratch - directory (e.g. /dev/shm or $TMPDIR) under which RADEX runs,
+        in a private directory per worker, instead of in radex_temp_XX in
+        the submission directory; the models are copied back to
+        radex_temp_XX by a background thread and the scratch directories are
+        removed at the end, also when the run fails or gets SIGTERM
+    pilot - first run about this many points spread over the grid (not
+        cached ones), timing them, and fit a cost model to them (see
+        radex_cost): it predicts the core-hours and wall time of the rest,
+        which are printed before the full run starts, and sizes the chunks
+        by predicted time
+    shard - (i, N): only compute shard i of N of the grid (see shard_indices),
+        in the radex_shard_i_of_N subdirectory; merge_shards assembles the
+        .dat files once every shard is done
+    keep_checkpoints - leave the checkpoint files in place at the end (shards
+        keep them as their results)
+
+    If mpi4py is available and there is more than one rank, rank 0 acts as
+    the coordinator and ranks 1..N-1 run RADEX in radex_temp_XX
+    subdirectories, sending the parsed rows back with each request for work;
+    rank 0 writes the .dat files and, at the end, collects their radex.out.  Otherwise the
+    grid runs on a pool of nprocs local processes, producing the same .dat
+    files.
+
+    Every finished point is recorded in radex_grid<suffix>.checkpoint.XX
+    files, which are removed once the .dat files are complete.
+    Points with the same RADEX input are run once (see deduplicate), so
+    radex.out holds each distinct model once.
+    """
+    if shard is not None:
+        ishard,nshards = shard
+        sharddir = shard_dir(ishard, nshards)
+        if not os.path.exists(sharddir):
+            try:
+                os.mkdir(sharddir)
+            except OSError:
+                # another rank made it first
+                pass
+        if cachedir is not None:
+            cachedir = os.path.abspath(cachedir)
+        radexpath = os.path.abspath(radexpath)
+        if scratch is not None:
+            scratch = os.path.abspath(scratch)
+        shard_points = [points[ii] for ii in shard_indices(len(points), ishard, nshards)]
+        if verbose > 0: print("Shard %i of %i: %i of %i grid points" % (ishard,nshards,len(shard_points),len(points)), file=log)
+        pwd = os.getcwd()
+        os.chdir(sharddir)
+        try:
+            run_grid(shard_points, acts, write_input, output_row, header,
+                     read_model=read_model, bw=bw, suffix=suffix,
+                     executable=executable, minchunk=minchunk, nprocs=nprocs,
+                     slots=slots, timeout=timeout, stream=stream,
+                     resume=resume, checkpoint_interval=checkpoint_interval,
+                     cachedir=cachedir, cachesize=cachesize,
+                     radexpath=radexpath, scratch=scratch, pilot=pilot,
+                     keep_checkpoints=True, log=log, verbose=verbose)
+        finally:
+            os.chdir(pwd)
+        return
+
+    try:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    except ImportError:
+        comm = None
+    mpirank = comm.rank if comm is not None else 0
+    mpisize = comm.size if comm is not None else 1
+    # turn the batch system's SIGTERM into an exception, so the scratch
+    # directories are cleaned up on the way out
+    if (signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+            and threading.current_thread().name == 'MainThread'):
+        signal.signal(signal.SIGTERM, _terminate)
+
+    gfils = output_filenames(acts, suffix)
+    if read_model is None:
+        read_model = functools.partial(read_radex_acts, bw=bw)
+    radexpath = os.path.abspath(radexpath) # the workers run in other directories
+    cache = None
+    if cachedir is not None:
+        cache = radex_cache.RadexCache(cachedir, maxsize=cachesize,
+                                       radexpath=radexpath)
+
+    pwd = os.getcwd() # will return to PWD later
+    cpprefix = os.path.join(pwd, checkpoint_name(suffix))
+    done = {}
+    if mpirank == 0:
+        if resume:
+            done = read_checkpoints(cpprefix, points, len(acts))
+            if verbose > 0: print("Resuming: %i of %i grid points are already done" % (len(done),len(points)), file=log)
+            prune_radex_logs(set([record_key(input_record(write_input, points[index])) for index in done]),
+                             log=log, verbose=verbose)
+        else:
+            remove_checkpoints(cpprefix)
+    todo = [ii for ii in range(len(points)) if ii not in done]
+    copies = {}
+    if mpirank == 0:
+        ntodo = len(todo)
+        todo,copies = deduplicate(points, todo, done, write_input)
+        if verbose > 0 and len(todo) < ntodo:
+            print("%i of %i grid points repeat the RADEX input of another point; running %i" % (ntodo-len(todo),ntodo,len(todo)), file=log)
+
+    if comm is None and nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    if slots is None:
+        slots = multiprocessing.cpu_count()
+    cost = None
+    positions = []
+    if mpirank == 0 and pilot and len(todo) > pilot:
+        coordinates = []
+        cached = set()
+        for pos,index in enumerate(todo):
+            record = input_record(write_input, points[index])
+            coordinates.append(radex_cost.point_coordinates(record))
+            # cached models cost next to nothing: no use timing them
+            if cache is not None and cache.contains(cache.key(executable, record)):
+                cached.add(pos)
+        uncached = [pos for pos in range(len(todo)) if pos not in cached]
+        positions = radex_cost.spread_sample(coordinates, uncached, pilot)
+        if verbose > 0 and cached: print("Pilot: %i of %i grid points are cached" % (len(cached),len(todo)), file=log)
+    if positions:
+        if verbose > 0: print("Pilot: running %i of %i grid points" % (len(positions),len(todo)), file=log)
+        pilotdir = tempfile.mkdtemp(prefix="radex_pilot_", dir=scratch or pwd)
+        pilotlog = open(os.path.join(pwd, "radex.out.pilot"), 'a' if resume else 'w')
+        cpfile = open(cpprefix+".pilot", 'a')
+        pilot_start = time.time()
+        try:
+            timed = run_pilot([points[todo[pos]] for pos in positions], acts,
+                              write_input, read_model, executable=executable,
+                              stream=stream, cache=cache, timeout=timeout,
+                              workdir=pilotdir, radexlog=pilotlog,
+                              radexpath=radexpath)
+            for pos,(model_rows,seconds) in zip(positions,timed):
+                for index in [todo[pos]] + copies.pop(todo[pos], []):
+                    done[index] = model_rows
+                    write_checkpoint(cpfile, index, points[index], model_rows)
+        finally:
+            cpfile.close()
+            pilotlog.close()
+            shutil.rmtree(pilotdir, ignore_errors=True)
+        model = radex_cost.CostModel([coordinates[pos] for pos in positions],
+                                     [seconds for model_rows,seconds in timed])
+        positions = set(positions)
+        rest = [pos for pos in range(len(todo)) if pos not in positions]
+        predicted = model.predict([coordinates[pos] for pos in rest])
+        costs = [0.0 if pos in cached else seconds for pos,seconds in zip(rest, predicted)]
+        todo = [todo[pos] for pos in rest]
+        cost = radex_cost.cumulative(costs)
+        if comm is None and nprocs > 1:
+            nrunners = min(nprocs, len(todo))
+        elif mpisize > 1:
+            nrunners = (mpisize - 1 + (1 if slots > 1 else 0)) * slots
+        else:
+            nrunners = slots
+        if verbose > 0:
+            print("Pilot: %i points took %.1f s; the other %i should take %.2f core-hours, about %s on %i RADEX processes"
+                  % (len(timed), time.time()-pilot_start, len(todo),
+                     cost[-1]/3600., radex_cost.format_duration(cost[-1]/nrunners), nrunners), file=log)
+    if mpisize > 1:
+        # also makes sure stale checkpoints are gone before anyone writes
+        todo,cost = comm.bcast((todo,cost), root=0)
+    todo_points = [points[ii] for ii in todo]
+
+    def add_rows(index, model_rows, cpfile):
+        """
+        Rank 0: write the rows of a finished point and of every point that
+        shares its RADEX input (checkpointing those, so shards and resumed
+        runs have them too)
+        """
+        writer.add(index, model_rows)
+        for copy in copies.get(index, ()):
+            writer.add(copy, model_rows)
+            write_checkpoint(cpfile, copy, points[copy], model_rows)
+
+    if comm is None:
+        nprocs = max(1, min(nprocs, len(todo)))
+        print("mpi4py not found.  Using %i local processes." % nprocs, file=log)
+        if nprocs > 1:
+            writer = GridWriter(gfils, header, output_row, len(points))
+            cpfile = open(cpprefix+".00", 'a')
+            try:
+                for index in sorted(done):
+                    writer.add(index, done[index])
+                for start,stop,results in run_pool(todo_points, acts,
+                                                   write_input, read_model,
+                                                   nprocs,
+                                                   executable=executable,
+                                                   minchunk=minchunk,
+                                                   stream=stream,
+                                                   resume=resume,
+                                                   cache=cache,
+                                                   timeout=timeout,
+                                                   scratch=scratch,
+                                                   cost=cost,
+                                                   radexpath=radexpath):
+                    if verbose > 1: print("Finished points %i:%i of %i" % (start,stop,len(todo)), file=log)
+                    for ii,index in enumerate(todo[start:stop]):
+                        model_rows = [rows[ii] for rows in results]
+                        add_rows(index, model_rows, cpfile)
+                        write_checkpoint(cpfile, index, points[index], model_rows)
+                    cpfile.flush()
+            finally:
+                cpfile.close()
+                writer.close()
+            merge_radex_out(nprocs)
+            if resume:
+                # the models of an interrupted serial run of the grid
+                append_radex_out("radex.out.all")
+            append_radex_out("radex.out.pilot")
+            if not keep_checkpoints:
+                remove_checkpoints(cpprefix)
+            if cache is not None:
+                cache.evict()
+            return
+
+    # rank 0 writes every .dat file, once; MPI workers send it their rows
+    gather = mpisize > 1
+    writer = None
+    copyfile = None
+    if mpirank == 0:
+        writer = GridWriter(gfils, header, output_row, len(points))
+        for index in sorted(done):
+            writer.add(index, done[index])
+        if gather and copies:
+            # the workers checkpoint the points they ran, rank 0 the copies
+            copyfile = open(cpprefix+".copies", 'a')
+    # in hybrid mode (several slots per rank) rank 0 runs RADEX too
+    hybrid = gather and slots > 1
+    computes = not gather or mpirank > 0 or hybrid
+    logdir = pwd
+    if gather and computes:
+        # Make a separate subdirectory for each processor
+        # ("temp" means temporary, though)
+        logdir = os.path.join(pwd, "radex_temp_%02i" % mpirank)
+        try:
+            os.mkdir(logdir)
+        except OSError:
+            print("%s exists, continuing" % logdir, file=log)
+    workdir = logdir
+    if scratch is not None and computes:
+        workdir = scratch_dir(scratch, mpirank)
+    radexlog = None
+    if computes:
+        radexlog = AsyncWriter(os.path.join(logdir, 'radex.out.all'),
+                               'a' if resume else 'w')
+
+    if verbose > 0 and mpirank == 0:
+        print("Running code %s on %i grid points with %i processors" % (executable,len(todo),mpisize), file=log)
+        if slots > 1: print("Each processor runs %i RADEX processes at once" % slots, file=log)
+
+    def collect(results):
+        for index,model_rows in results:
+            add_rows(index, model_rows, copyfile)
+
+    def work(start, stop):
+        """
+        Run points start:stop of the todo list.  In a serial run the rows go
+        to the .dat files as RADEX produces them, so the files and the
+        progress messages follow the run; MPI workers return
+        [(index, model_rows)] for the coordinator to write.
+        """
+        if verbose > 1: print("Processor %i: running points %i:%i" % (mpirank,start,stop), file=log)
+        finished = []
+        cpfile = open(cpprefix+".%02i" % mpirank, 'a')
+        report = max(1, (stop-start)//10)
+        last_flush = time.time()
+
+        def record(index, model_rows):
+            if gather:
+                finished.append((index, model_rows))
+            else:
+                add_rows(index, model_rows, cpfile)
+            write_checkpoint(cpfile, index, points[index], model_rows)
+
+        try:
+            if slots > 1:
+                subcost = None
+                if cost is not None:
+                    subcost = [total-cost[start] for total in cost[start:stop+1]]
+                chunks = [(start+first,start+last) for first,last in
+                          guided_chunks(stop-start, slots, minchunk=minchunk, cost=subcost)]
+                ndone = 0
+                for ichunk,results in run_concurrent([todo_points[first:last] for first,last in chunks],
+                                                     acts, write_input, read_model, slots,
+                                                     executable=executable, stream=stream,
+                                                     cache=cache, timeout=timeout,
+                                                     workdir=workdir,
+                                                     radexlog=radexlog,
+                                                     radexpath=radexpath):
+                    first,last = chunks[ichunk]
+                    for ii,index in enumerate(todo[first:last]):
+                        record(index, [rows[ii] for rows in results])
+                    cpfile.flush()
+                    ndone += last-first
+                    if verbose > 1: print("Processor %i: %i of points %i:%i done" % (mpirank,ndone,start,stop), file=log)
+            else:
+                for ii,model_rows in enumerate(iter_chunk(todo_points[start:stop], acts,
+                                                          write_input, read_model,
+                                                          executable=executable,
+                                                          stream=stream, cache=cache,
+                                                          timeout=timeout,
+                                                          workdir=workdir,
+                                                          radexlog=radexlog,
+                                                          radexpath=radexpath)):
+                    record(todo[start+ii], model_rows)
+                    if time.time() - last_flush > checkpoint_interval:
+                        cpfile.flush()
+                        last_flush = time.time()
+                    if verbose > 1 and (ii+1) % report == 0:
+                        if writer is not None:
+                            writer.flush()
+                        print("Processor %i: %i of points %i:%i done" % (mpirank,ii+1,start,stop), file=log)
+        finally:
+            cpfile.close()
+        if verbose > 1: print("Processor %i: finished points %i:%i" % (mpirank,start,stop), file=log)
+        return finished
+
+    try:
+        if todo:
+            schedule(comm, len(todo), work, collect=collect, minchunk=minchunk,
+                     coordinator_works=hybrid, cost=cost, log=log, verbose=verbose)
+    finally:
+        if writer is not None:
+            writer.close()
+        if copyfile is not None:
+            copyfile.close()
+        if radexlog is not None:
+            radexlog.close()
+        if workdir != logdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if gather:
+        comm.Barrier()
+        if mpirank == 0:
+            if verbose > 0: print("Processor %i: Starting cleanup" % mpirank, file=log)
+            merge_radex_out(mpisize)
+            if resume:
+                append_radex_out("radex.out.all")
+            append_radex_out("radex.out.pilot")
+            if not keep_checkpoints:
+                remove_checkpoints(cpprefix)
+            if verbose > 0: print("Processor %i: Cleanup completed" % mpirank, file=log)
+    else:
+        if os.path.exists('radex.out.all'):
+            os.rename('radex.out.all','radex.out')
+        if resume:
+            # the models of an interrupted pool or MPI run of the grid
+            for tempdir in sorted(glob.glob("radex_temp_[0-9][0-9]")):
+                append_radex_out(os.path.join(tempdir, "radex.out.all"))
+                shutil.rmtree(tempdir)
+        append_radex_out("radex.out.pilot")
+        if not keep_checkpoints:
+            remove_checkpoints(cpprefix)
+    if cache is not None and mpirank == 0:
+        cache.evict()
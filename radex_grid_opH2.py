@@ -30,6 +30,13 @@ sys.path.append('/duanestorage/home/student/silvia/local/x86_64/lib/python2.6/si
 #
 # The code creates (# processors) subdirectories, reformats that data, and
 # removes the temporary subdirectories.
+#
+# Finished points are checkpointed as the grid runs.  If the job dies, run
+# the same command with --resume to compute only the missing points.
+#
+# Without MPI, the grid can also be split into N independent jobs (e.g. an
+# array job): run the script with --shard i/N for i = 0..N-1, then once they
+# have all finished run it with --merge N to write the .dat files.
 
 # Grid boundaries
 #
@@ -65,9 +72,10 @@ dv    = 1.0          # line width (km/s)
 
 mole = 'o-h2co_troscompt'  # molecular data name
 
-import sys
-if len(sys.argv) > 1:
-    orthopararatio = sys.argv[1] 
+import radex_engine
+options,args = radex_engine.parse_args(sys.argv[1:])
+if len(args) > 0:
+    orthopararatio = args[0]
 else:
     orthopararatio = 1e-3 # H2 ortho-to-para ratio
 
@@ -83,9 +91,34 @@ bw    = 0.01   # "bandwidth": free spectral range around line (used to say which
 # can run sphere or lvg
 # (note that you must generate these executables and name them yourself,
 # and they must be in your path or you can specify the full path)
+# native_lvg, pyradex_lvg and fjdu_lvg (or _sphere, _slab) compute the
+# models in-process instead (see radex_backend)
 executable = "radex_lvg"
 # executable = "radex_sphere"
 
+# Models are cached in ~/.radex_cache (or $RADEX_CACHE), shared by every grid,
+# so repeated or overlapping grids only run new models.  The cache key includes
+# the molecular data file, which RADEX reads from radexpath.
+radexpath = os.environ.get('RADEX_DATA', '.')
+
+# number of local RADEX processes to use when mpi4py is not available
+# (None = one per core)
+nprocs = None
+# number of RADEX processes each MPI processor keeps running at once.
+# On a cluster of multi-core nodes, run one MPI processor per node with
+# slots = None (one per core): fewer processors, temporary directories and
+# merges, and processor 0 computes too.
+slots = 1
+# directory for RADEX's working files, ideally node-local (e.g. '/dev/shm' or
+# os.environ.get('TMPDIR')); None = subdirectories of this directory
+scratch = None
+# time this many points spread over the grid first, to predict the run time
+# (printed before the full run starts) and size the chunks by it (0 = no pilot)
+pilot = 20
+# give up on a RADEX run that takes longer than this many seconds per model
+# (None = wait forever)
+timeout = None
+
 # verbosity
 # 2 = output 1 line for every RADEX run (redirect to log file!)
 # 1 = just output major statements (OK to print to screen)
@@ -112,179 +145,40 @@ def write_input(infile,tkin,nh2,cdmol=cdmol_default):
     infile.write(str(cdmol)+'\n')
     infile.write(str(dv)+'\n')
 
-def read_radex(file,flow,fupp,bw=bw):
-    """ 
-    less hack-ey way to read radex.out files
-    """
-    line = file.readline()
-    if line == '':
-        return 0
-    words = line.split()
-    freq = 0
-    while len(words) > 1 and words[1] == '--': # this case should never have to happen....
-        line = file.readline()
-        words = line.split()
-    while not(freq*(1-bw) < flow < freq*(1+bw)):
-        if words[1] == 'T(kin)':
-            tkin = float(words[3])
-        elif line.find("Density of H2") != -1:
-            dens = float(words[5])
-        elif line.find("Density of pH2") != -1:
-            pdens = float(words[5])
-        elif line.find("Density of oH2") != -1:
-            odens = float(words[5])
-        elif line.find("Column density") != -1:
-            col = float(words[4])
-        line = file.readline()
-        words = line.split()
-        if words[1] == '--':
-            freq = float(words[4])
-    TexLow   = float(words[6])
-    TauLow   = float(words[7])
-    TrotLow  = float(words[8])
-    FluxLow  = float(words[11])
-    line = file.readline()
-    words = line.split()
-    while  not(freq*(1-bw) < flow < freq*(1+bw)):
-        line = file.readline()
-        words = line.split()
-        if words[1] == '--':
-            freq = float(words[4])
-    TexUpp   = float(words[6])
-    TauUpp   = float(words[7])
-    TrotUpp  = float(words[8])
-    FluxUpp  = float(words[11])
-    while len(words) > 1 and words[1] == '--':
-        line = file.readline()
-        words = line.split()
-    return tkin,dens,col,TexLow,TexUpp,TauLow,TauUpp,TrotLow,TrotUpp,FluxLow,FluxUpp
- 
 # Begin main program
 
-start = time.time()
-
-# Allow for parallel running.  If mpirun is not used, will operate in
-# single-processor mode
-try:
-    from mpi4py import MPI
-    mpirank = MPI.COMM_WORLD.rank  # processor ID
-    mpisize = MPI.COMM_WORLD.size  # number of processors
-except ImportError:
-    print "mpi4py not found.  Using a single processor."
-    mpirank = 0
-    mpisize = 1
-if mpisize > 1:
-    # each processor gets 1/n_processors of the temperatures, in order
-    # If you want to run in parallel with just 1 temperature, 
-    # these lines need to be changed
-    splits = [ int( math.floor(ii / float(mpisize) * ntemp) ) for ii in range(mpisize+1) ] 
-    temperatures = temperatures[splits[mpirank]:splits[mpirank+1]]
-
-    # Make a separate subdirectory for each temperature
-    # ("temp" means temporary, though)
-    newdir = "radex_temp_%02i" % mpirank
-    pwd = os.getcwd() # will return to PWD later
-    try:
-        os.mkdir(newdir)
-    except OSError:
-        print "%s exists, continuing" % newdir
-    os.chdir(newdir)
-
-if verbose > 0: print "Running code ",executable," with temperatures ",temperatures," densities ",densities," and columns ",columns
-
-for iact,act in enumerate(acts):
-    lowfreq = act[0]
-    uppfreq = act[1]
-    gfil = act[2].replace(".dat",suffix+".dat")
-    
-    infile = open('radex.inp','w')
-    if verbose > 0: print "Processor %i: Starting " % mpirank,gfil
-
-    for temp in temperatures:
-        for dens in densities:
-            for col in columns:
-
-                write_input(infile,temp,dens,col)
-                if (temp == temperatures[-1] and dens == densities[-1] and col == columns[-1]):
-                    infile.write('0\n')
-                    infile.close()
-                else:
-                    infile.write('1\n')
-
-                # DEBUG logging
-                if verbose > 1: print "Processor %i " % mpirank,
-                if verbose > 1: print "temp : %g" % (temp),
-                if verbose > 1: print "Column : %g" % (col),
-                if verbose > 1: print "dens : %g" % (dens)
-
-    if verbose > 0: print "Processor %i: Finished writing infiles." % mpirank
-    if iact == 0:
-        if verbose > 0: print "Processor %i: Starting radex code." % mpirank
-        status = os.system('%s < radex.inp > /dev/null' % executable)
-        if status != 0:
-            print "Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status)
-            import pdb; pdb.set_trace()
-        
-        if verbose > 0: print "Processor %i: Finished Radex." % mpirank
-
-    if verbose > 0: print "Processor %i: Beginning output parsing." % mpirank
-    if verbose > 1: print "Processor %i: Printing to file %s." % (mpirank,gfil)
-    grid = open(gfil,'w')
-    fmt  = '%10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e \n'
-    grid.write(fmt.replace('.3e','s') % ("Temperature","log10(dens)",
-        "log10(col)","Tex_low","Tex_hi","TauLow","TauUpp","TrotLow","TrotUpp","FluxLow","FluxUpp"))
+def output_row(radex_out):
+    """
+    Convert a radex_engine.read_radex_acts result into a row of the .dat file
+    """
+    temp,dens,col,tlow,tupp,taulow,tauupp,trotlow,trotupp,fluxlow,fluxupp,opr = radex_out
+    return (temp, math.log10(dens), math.log10(col),
+            tlow, tupp, taulow, tauupp, trotlow,trotupp,fluxlow,fluxupp)
 
-    radexfile  = open('radex.out')
+header = ("Temperature","log10(dens)","log10(col)","Tex_low","Tex_hi",
+          "TauLow","TauUpp","TrotLow","TrotUpp","FluxLow","FluxUpp")
 
-    rmin = 100
-    rmax = 0.1
+start = time.time()
 
-    while(1):
-        radex_out = read_radex(radexfile,lowfreq,uppfreq)
-        if radex_out == 0:
-            break
-        else:
-            temp,dens,col,tlow,tupp,taulow,tauupp,trotlow,trotupp,fluxlow,fluxupp = radex_out
+# Every grid point goes into one flat list; radex_engine hands chunks of it
+# to the MPI processors on demand.
+# If mpirun is not used, will operate in single-processor mode
+points = radex_engine.grid_points(temperatures, densities, columns)
 
-        grid.write(fmt %(temp, math.log10(dens), math.log10(col),
-            tlow, tupp, taulow, tauupp, trotlow,trotupp,fluxlow,fluxupp))
+if verbose > 0: print "Running code ",executable," with temperatures ",temperatures," densities ",densities," and columns ",columns
 
-    grid.close()
-    radexfile.close()
-    if verbose > 1: print "Processor %i: Completed output parsing.  Wrote %i temperatures, %i densities, %i columns." % \
-            (mpirank,len(temperatures),len(densities),len(columns))
+if options['merge']:
+    radex_engine.merge_shards(points, acts, output_row, header, options['merge'],
+                              suffix=suffix, verbose=verbose)
+else:
+    radex_engine.run_grid(points, acts, write_input, output_row, header,
+                          bw=bw, suffix=suffix, executable=executable,
+                          radexpath=radexpath,
+                          nprocs=nprocs, slots=slots, timeout=timeout,
+                          scratch=scratch, pilot=pilot,
+                          resume=options['resume'], shard=options['shard'],
+                          verbose=verbose)
 
 stop = time.time()
 dure = stop - start
-if verbose > 0: print "Processor %i Run time = %f seconds" % (mpirank,dure)
-if mpisize > 1:
-    os.chdir(pwd)
-
-MPI.COMM_WORLD.Barrier()
-if mpisize > 1 and mpirank == 0:
-    if verbose > 0: print "Processor %i: Starting cleanup" % mpirank
-    import glob
-    filelist = glob.glob("radex_temp_00/*.dat")
-    for file in filelist:
-        status = os.system("cp %s %s" % (file,file.replace("radex_temp_00/","") ) )
-        if status != 0:
-            print "Processor %i: " % mpirank,"Command ",("cp %s %s" % (file,file.replace("radex_temp_00/","") ) )," failed with status ",status
-        for ii in xrange(1,mpisize):
-            if verbose > 1: 
-                wc = os.popen('wc %s' % file.replace("_00","_%02i" % ii)).readline().split()[0]
-                print "Processor %i merging file %s with length %s onto %s" % (mpirank, 
-                        file.replace("_00","_%02i" % ii),wc,file.replace("radex_temp_00/",""))
-            status = os.system("tail -n +2 %s >> %s" % (file.replace("_00","_%02i" % ii),file.replace("radex_temp_00/","") ) )
-            if status != 0:
-                print "Processor %i: " % mpirank,"Command ",("tail -n +2 %s >> %s" % (file.replace("_00","_%02i" % ii),file.replace("radex_temp_00/","") ) )," failed with status ",status
-    radexoutlist = glob.glob("radex_temp_*/radex.out")
-    try:
-        # if a radex.out file exists, move it to radex.out.old
-        os.system("mv radex.out radex.out.old")
-        os.system("touch radex.out")
-    except OSError:
-        pass
-    for file in radexoutlist:
-        os.system("cat %s >> radex.out" % file)
-    os.system("rm -r radex_temp_*")
-    if verbose > 0: print "Processor %i: " % mpirank,"Cleanup completed"
+if verbose > 0: print "Run time = %f seconds" % (dure)
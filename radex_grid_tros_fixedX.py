@@ -5,6 +5,7 @@
 import math
 import os
 import time
+import sys
 #
 # Run a series of Radex models to estimate temperature & density
 # from observed ratios of H2CO 1-1/2-2, 1-1/3-3, and 2-2/3-3 lines
@@ -29,6 +30,13 @@ import time
 #
 # The code creates (# processors) subdirectories, reformats that data, and
 # removes the temporary subdirectories.
+#
+# Finished points are checkpointed as the grid runs.  If the job dies, run
+# the same command with --resume to compute only the missing points.
+#
+# Without MPI, the grid can also be split into N independent jobs (e.g. an
+# array job): run the script with --shard i/N for i = 0..N-1, then once they
+# have all finished run it with --merge N to write the .dat files.
 
 # Grid boundaries
 #
@@ -76,9 +84,34 @@ bw    = 0.01   # "bandwidth": free spectral range around line (used to say which
 # can run sphere or lvg
 # (note that you must generate these executables and name them yourself,
 # and they must be in your path or you can specify the full path)
+# native_lvg, pyradex_lvg and fjdu_lvg (or _sphere, _slab) compute the
+# models in-process instead (see radex_backend)
 executable = "radex_lvg"
 # executable = "radex_sphere"
 
+# Models are cached in ~/.radex_cache (or $RADEX_CACHE), shared by every grid,
+# so repeated or overlapping grids only run new models.  The cache key includes
+# the molecular data file, which RADEX reads from radexpath.
+radexpath = os.environ.get('RADEX_DATA', '.')
+
+# number of local RADEX processes to use when mpi4py is not available
+# (None = one per core)
+nprocs = None
+# number of RADEX processes each MPI processor keeps running at once.
+# On a cluster of multi-core nodes, run one MPI processor per node with
+# slots = None (one per core): fewer processors, temporary directories and
+# merges, and processor 0 computes too.
+slots = 1
+# directory for RADEX's working files, ideally node-local (e.g. '/dev/shm' or
+# os.environ.get('TMPDIR')); None = subdirectories of this directory
+scratch = None
+# time this many points spread over the grid first, to predict the run time
+# (printed before the full run starts) and size the chunks by it (0 = no pilot)
+pilot = 20
+# give up on a RADEX run that takes longer than this many seconds per model
+# (None = wait forever)
+timeout = None
+
 # verbosity
 # 2 = output 1 line for every RADEX run (redirect to log file!)
 # 1 = just output major statements (OK to print to screen)
@@ -106,169 +139,44 @@ def write_input(infile,tkin,nh2,cdmol=cdmol_default):
     infile.write(str(cdmol)+'\n')
     infile.write(str(dv)+'\n')
 
-def read_radex(outfile,flow,fupp):
+# Begin main program
+
+def output_row(radex_out):
     """
-    A hack-ey means of reading a radex.out file.  
-    Cycles through it based on fixed format
+    Convert a radex_engine.read_radex_acts result into a row of the .dat file
     """
-    line  = outfile.readline()
-    words = line.split()
-    while (words[1] != "T(kin)"):
-        line  = outfile.readline()
-        words = line.split()
-    temp  = float(words[-1])
-    line  = outfile.readline()
-    words = line.split()
-    dens  = float(words[-1])
-    line = outfile.readline()
-    line = outfile.readline()
-    words = line.split()
-    col  = float(words[-1])
-    while (words[-1] != "FLUX"):
-        line  = outfile.readline()
-        words = line.split()
-    line  = outfile.readline()
-    line  = outfile.readline()
-    words = line.split()
-    ftmp  = float(words[4])
-    while ((ftmp < flow*(1-bw)) or (ftmp > flow/(1-bw))):
-        line  = outfile.readline()
-        words = line.split()
-        ftmp  = float(words[4])
-    low   = float(words[-2])
-    TexLow   = float(words[6])
-    TauLow   = float(words[7])
-    TrotLow  = float(words[8])
-    FluxLow  = float(words[11])
-    line  = outfile.readline()
-    words = line.split()
-    ftmp  = float(words[4])
-    while ((ftmp < fupp*(1-bw)) or (ftmp > fupp/(1-bw))):
-        line  = outfile.readline()
-        words = line.split()
-        ftmp  = float(words[4])
-    upp   = float(words[-2])
-    TexUpp   = float(words[6])
-    TauUpp   = float(words[7])
-    TrotUpp  = float(words[8])
-    FluxUpp  = float(words[11])
-    return temp,dens,col,TexLow,TexUpp,TauLow,TauUpp,TrotLow,TrotUpp,FluxLow,FluxUpp
- 
-# Begin main program
+    temp,dens,col,tlow,tupp,taulow,tauupp,trotlow,trotupp,fluxlow,fluxupp,opr = radex_out
+    return (temp, math.log10(dens), math.log10(col),
+            tlow, tupp, taulow, tauupp, trotlow,trotupp,fluxlow,fluxupp)
 
-start = time.time()
+header = ("Temperature","log10(dens)","log10(col)","Tex_low","Tex_hi",
+          "TauLow","TauUpp","TrotLow","TrotUpp","FluxLow","FluxUpp")
 
-# Allow for parallel running.  If mpirun is not used, will operate in
-# single-processor mode
-try:
-    from mpi4py import MPI
-    mpirank = MPI.COMM_WORLD.rank  # processor ID
-    mpisize = MPI.COMM_WORLD.size  # number of processors
-except ImportError:
-    print "mpi4py not found.  Using a single processor."
-    mpirank = 0
-    mpisize = 1
-if mpisize > 1:
-    # each processor gets 1/n_processors of the densities AND columns, in order
-    # If you want to run in parallel with just 1 temperature, 
-    # these lines need to be changed
-    splits = [ int( math.floor(ii / float(mpisize) * ndens) ) for ii in range(mpisize+1) ] 
-    densities = densities[splits[mpirank]:splits[mpirank+1]]
-    columns = columns[splits[mpirank]:splits[mpirank+1]]
+start = time.time()
 
-    # Make a separate subdirectory for each temperature
-    # ("temp" means temporary, though)
-    newdir = "radex_temp_%02i" % mpirank
-    pwd = os.getcwd() # will return to PWD later
-    try:
-        os.mkdir(newdir)
-    except OSError:
-        print "%s exists, continuing" % newdir
-    os.chdir(newdir)
+# Every grid point goes into one flat list; radex_engine hands chunks of it
+# to the MPI processors on demand.
+# If mpirun is not used, will operate in single-processor mode
+import radex_engine
+options,args = radex_engine.parse_args(sys.argv[1:])
+# this is a linear grid: density and column vary together
+points = [(temp,dens,col) for temp in temperatures
+          for dens,col in zip(densities,columns)]
 
 if verbose > 0: print "Running code ",executable," with temperatures ",temperatures," densities ",densities," and columns ",columns
 
-for iact,act in enumerate(acts):
-    lowfreq = act[0]
-    uppfreq = act[1]
-    gfil = act[2].replace(".dat",suffix+".dat")
-    
-    infile = open('radex.inp','w')
-    if verbose > 0: print "Processor %i: Starting " % mpirank,gfil
-
-    for temp in temperatures:
-        for dens,col in zip(densities,columns):
-
-            write_input(infile,temp,dens,col)
-            if (temp == temperatures[-1] and dens == densities[-1] and col == columns[-1]):
-                infile.write('0\n')
-                infile.close()
-            else:
-                infile.write('1\n')
-
-            # DEBUG logging
-            if verbose > 1: print "Processor %i " % mpirank,
-            if verbose > 1: print "temp : %g" % (temp),
-            if verbose > 1: print "Column : %g" % (col),
-            if verbose > 1: print "dens : %g" % (dens)
-
-    if verbose > 0: print "Processor %i: Finished writing infiles." % mpirank
-    if iact == 0:
-        if verbose > 0: print "Processor %i: Starting radex code." % mpirank
-        status = os.system('%s < radex.inp > /dev/null' % executable)
-        if status != 0:
-            print "Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status)
-            import pdb; pdb.set_trace()
-        if verbose > 0: print "Processor %i: Finished Radex." % mpirank
-
-    if verbose > 0: print "Processor %i: Beginning output parsing." % mpirank
-    grid = open(gfil,'w')
-    fmt  = '%10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e %10.3e \n'
-    grid.write(fmt.replace('.3e','s') % ("Temperature","log10(dens)",
-        "log10(col)","Tex_low","Tex_hi","TauLow","TauUpp","TrotLow","TrotUpp","FluxLow","FluxUpp"))
-
-    outfile  = open('radex.out')
-
-    rmin = 100
-    rmax = 0.1
-
-    for temp in temperatures:
-        for dens in densities:
-            for col in columns:
-
-                temp,dens,col,tlow,tupp,taulow,tauupp,trotlow,trotupp,fluxlow,fluxupp = read_radex(outfile,lowfreq,uppfreq)
-                if temp < 0 or dens < 0 or col < 0:
-                    raise ValueError("One of the parameters is negative.  Temperature: %g  Density: %g  Column: %g" % (temp, dens, col))
-
-                grid.write(fmt %(temp, math.log10(dens), math.log10(col),
-                    tlow, tupp, taulow, tauupp, trotlow,trotupp,fluxlow,fluxupp))
-
-    grid.close()
-    outfile.close()
+if options['merge']:
+    radex_engine.merge_shards(points, acts, output_row, header, options['merge'],
+                              suffix=suffix, verbose=verbose)
+else:
+    radex_engine.run_grid(points, acts, write_input, output_row, header,
+                          bw=bw, suffix=suffix, executable=executable,
+                          radexpath=radexpath,
+                          nprocs=nprocs, slots=slots, timeout=timeout,
+                          scratch=scratch, pilot=pilot,
+                          resume=options['resume'], shard=options['shard'],
+                          verbose=verbose)
 
 stop = time.time()
 dure = stop - start
-if verbose > 0: print "Processor %i Run time = %f seconds" % (mpirank,dure)
-if mpisize > 1:
-    os.chdir(pwd)
-
-MPI.COMM_WORLD.Barrier()
-if mpisize > 1 and mpirank == 0:
-    if verbose > 0: print "Starting cleanup"
-    import glob
-    filelist = glob.glob("radex_temp_00/*.dat")
-    for file in filelist:
-        os.system("cp %s %s" % (file,file.replace("radex_temp_00/","") ) )
-        for ii in xrange(1,mpisize):
-            os.system("tail -n +2 %s >> %s" % (file.replace("_00","_%02i" % ii),file.replace("radex_temp_00/","") ) )
-    radexoutlist = glob.glob("radex_temp_*/radex.out")
-    try:
-        # if a radex.out file exists, move it to radex.out.old
-        os.system("mv radex.out radex.out.old")
-        os.system("touch radex.out")
-    except OSError:
-        pass
-    for file in radexoutlist:
-        os.system("cat %s >> radex.out" % file)
-    os.system("rm -r radex_temp_*")
-    if verbose > 0: print "Cleanup completed"
+if verbose > 0: print "Run time = %f seconds" % (dure)
@@ -0,0 +1,232 @@
+"""
+Reader for LAMDA molecular data files (the o-h2co.dat, ph2co-h2.dat, ...
+files RADEX reads; format described at
+http://home.strw.leidenuniv.nl/~moldata/).
+
+read_lamda returns a Molecule holding the levels, radiative transitions
+and collision rate tables as numpy arrays, with levels numbered from 0.
+
+load_lamda does the same but parses each file only once: the arrays are
+saved to a binary sidecar, <file>.<sha1 of the file>.npz next to it (or
+under cachedir if given), which later loads read instead of the text.  An
+edited data file has another hash, so a stale sidecar is never used.
+
+Molecule.collision_rates(tkin) returns the collision rate matrices of a
+batch of temperatures.  The matrices (per unit density of each partner,
+upward rates included) are computed once for each distinct temperature and
+kept, so tabulate() on a grid's temperature axis leaves the points of the
+grid only an array lookup.
+
+Dependencies:
+    numpy
+"""
+import os
+import tempfile
+import numpy as np
+import radex_cache
+
+# LAMDA collision partner codes -> RADEX collider names (as in radex.inp)
+PARTNERS = {1:'H2', 2:'p-H2', 3:'o-H2', 4:'e', 5:'H', 6:'He', 7:'H+'}
+# h c / k (cm K), with RADEX's constants
+FK = 6.6260963e-27*2.99792458e10/1.3806505e-16
+
+class Molecule(object):
+    """
+    name, weight - molecule name and molecular weight (amu)
+    energies, weights, levels - level energies (cm^-1), statistical weights
+        and quantum numbers (strings)
+    upper, lower, aeinst, freq, eup - for each radiative transition, the
+        upper and lower level, Einstein A (s^-1), frequency (GHz) and upper
+        level energy (K)
+    partners - {partner code: (temperatures, upper, lower, rates)}: the
+        collisional transitions of each partner and their downward rates
+        (cm^3 s^-1), one row per transition, one column per temperature
+    """
+    def __init__(self, name, weight, energies, weights, levels, upper, lower,
+                 aeinst, freq, eup, partners):
+        self.name = name
+        self.weight = weight
+        self.energies = energies
+        self.weights = weights
+        self.levels = levels
+        self.upper = upper
+        self.lower = lower
+        self.aeinst = aeinst
+        self.freq = freq
+        self.eup = eup
+        self.partners = partners
+        # collision matrices tabulated so far, temperatures sorted
+        self._temperatures = np.zeros(0)
+        self._rates = dict((code,np.zeros((0,self.nlevels,self.nlevels))) for code in partners)
+
+    @property
+    def nlevels(self):
+        return len(self.energies)
+
+    @property
+    def nlines(self):
+        return len(self.aeinst)
+
+    def rate_matrices(self, code, tkin):
+        """
+        Collision rates (s^-1 per cm^-3 of partner code) at the temperatures
+        tkin as a (len(tkin), nlevels, nlevels) array, element [to, from].
+        The tabulated rates are interpolated linearly in temperature and
+        held constant beyond the table, as RADEX does, and upward rates
+        follow from detailed balance.
+        """
+        temperatures,upper,lower,table = self.partners[code]
+        matrices = np.zeros((len(tkin), self.nlevels, self.nlevels))
+        if len(temperatures) == 1:
+            down = np.repeat(table[:,:1].T, len(tkin), axis=0)
+        else:
+            index = np.clip(np.searchsorted(temperatures, tkin)-1, 0, len(temperatures)-2)
+            t0,t1 = temperatures[index],temperatures[index+1]
+            fraction = np.clip((tkin-t0)/(t1-t0), 0, 1)
+            down = (table[:,index]*(1-fraction) + table[:,index+1]*fraction).T
+        # RADEX fills in the upward rates of every level pair by energy,
+        # which zeroes the rates the file lists from a level to one above
+        # it (there are some in e.g. the H2CS files) and leaves those
+        # between degenerate levels one-way
+        ediff = self.energies[upper]-self.energies[lower]
+        down = down[:,ediff >= 0]
+        up = (down[:,ediff[ediff >= 0] > 0]*(self.weights[upper]/self.weights[lower])[ediff > 0]
+              *np.exp(-FK*ediff[ediff > 0]/tkin[:,None]))
+        np.add.at(matrices, (slice(None), lower[ediff >= 0], upper[ediff >= 0]), down)
+        np.add.at(matrices, (slice(None), upper[ediff > 0], lower[ediff > 0]), up)
+        return matrices
+
+    def tabulate(self, tkin):
+        """
+        Compute and keep the rate matrices of the temperatures tkin (e.g. a
+        grid's temperature axis) that are not tabulated yet
+        """
+        tkin = np.unique(np.asarray(tkin, dtype=float))
+        new = tkin[~np.isin(tkin, self._temperatures)]
+        if len(new) == 0:
+            return
+        order = np.argsort(np.concatenate([self._temperatures, new]), kind='mergesort')
+        self._temperatures = np.concatenate([self._temperatures, new])[order]
+        for code in self.partners:
+            self._rates[code] = np.concatenate([self._rates[code], self.rate_matrices(code, new)])[order]
+
+    def collision_rates(self, tkin):
+        """
+        {partner code: (len(tkin), nlevels, nlevels) rate matrices} for a
+        batch of temperatures, looked up in the tabulated ones
+        """
+        tkin = np.asarray(tkin, dtype=float)
+        self.tabulate(tkin)
+        index = np.searchsorted(self._temperatures, tkin)
+        return dict((code,rates[index]) for code,rates in self._rates.items())
+
+def data_lines(filename):
+    """
+    The lines of a LAMDA file with the '!' comment lines left out
+    """
+    datafile = open(filename)
+    try:
+        for line in datafile:
+            if line.strip() and not line.lstrip().startswith('!'):
+                yield line
+    finally:
+        datafile.close()
+
+def read_lamda(filename):
+    """
+    Parse a LAMDA molecular data file into a Molecule
+    """
+    lines = data_lines(filename)
+    name = next(lines).strip()
+    weight = float(next(lines).split()[0])
+    nlevels = int(next(lines).split()[0])
+    energies = np.empty(nlevels)
+    weights = np.empty(nlevels)
+    levels = []
+    for ii in range(nlevels):
+        words = next(lines).split()
+        energies[ii] = float(words[1])
+        weights[ii] = float(words[2])
+        levels.append(words[3] if len(words) > 3 else words[0])
+    nlines = int(next(lines).split()[0])
+    table = np.array([[float(word) for word in next(lines).split()[:6]] for ii in range(nlines)])
+    upper = table[:,1].astype(int)-1
+    lower = table[:,2].astype(int)-1
+    partners = {}
+    npartners = int(next(lines).split()[0])
+    for ipartner in range(npartners):
+        code = int(next(lines).split()[0])
+        ntrans = int(next(lines).split()[0])
+        ntemps = int(next(lines).split()[0])
+        temperatures = np.array([float(word) for word in next(lines).split()[:ntemps]])
+        rates = np.array([[float(word) for word in next(lines).split()[:3+ntemps]] for ii in range(ntrans)])
+        partners[code] = (temperatures, rates[:,1].astype(int)-1,
+                          rates[:,2].astype(int)-1, rates[:,3:])
+    return Molecule(name, weight, energies, weights, levels, upper, lower,
+                    table[:,3], table[:,4], table[:,5], partners)
+
+def sidecar_name(filename, cachedir=None):
+    """
+    Binary sidecar of a LAMDA file, named after a hash of its contents
+    """
+    directory,basename = os.path.split(os.path.abspath(filename))
+    if cachedir is not None:
+        directory = cachedir
+    return os.path.join(directory, '%s.%s.npz' % (basename, radex_cache.file_hash(filename)))
+
+def save_sidecar(molecule, sidecar):
+    """
+    Write a Molecule's arrays to an .npz file, through a temporary file
+    renamed into place so concurrent readers never see half a file
+    """
+    arrays = dict(name=np.array(molecule.name), weight=np.array(molecule.weight),
+                  energies=molecule.energies, weights=molecule.weights,
+                  levels=np.array(molecule.levels), upper=molecule.upper,
+                  lower=molecule.lower, aeinst=molecule.aeinst,
+                  freq=molecule.freq, eup=molecule.eup,
+                  codes=np.array(sorted(molecule.partners), dtype=int))
+    for code,(temperatures,upper,lower,rates) in molecule.partners.items():
+        arrays.update([('temperatures%i' % code, temperatures), ('upper%i' % code, upper),
+                       ('lower%i' % code, lower), ('rates%i' % code, rates)])
+    fd,tmpname = tempfile.mkstemp(dir=os.path.dirname(sidecar), suffix='.npz.tmp')
+    outfile = os.fdopen(fd, 'wb')
+    try:
+        np.savez(outfile, **arrays)
+        outfile.close()
+        os.rename(tmpname, sidecar)
+    except:
+        outfile.close()
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def read_sidecar(sidecar):
+    data = np.load(sidecar)
+    try:
+        partners = dict((code,(data['temperatures%i' % code], data['upper%i' % code],
+                               data['lower%i' % code], data['rates%i' % code]))
+                        for code in data['codes'].tolist())
+        return Molecule(str(data['name']), float(data['weight']), data['energies'],
+                        data['weights'], [str(level) for level in data['levels']],
+                        data['upper'], data['lower'], data['aeinst'], data['freq'],
+                        data['eup'], partners)
+    finally:
+        data.close()
+
+def load_lamda(filename, cachedir=None):
+    """
+    read_lamda through the binary sidecar: read it if it exists, otherwise
+    parse the file and write it (silently skipped if the directory is
+    read-only)
+    """
+    sidecar = sidecar_name(filename, cachedir)
+    if os.path.exists(sidecar):
+        return read_sidecar(sidecar)
+    molecule = read_lamda(filename)
+    try:
+        if cachedir is not None and not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        save_sidecar(molecule, sidecar)
+    except (IOError, OSError):
+        pass
+    return molecule
@@ -0,0 +1,209 @@
+"""
+Line width axes from N/dv similarity.
+
+RADEX only ever uses the column density and the line width as their ratio
+N/dv: the optical depths, and with them the escape probabilities, level
+populations, Tex, tau and the radiation temperature, are the same for any
+(N, dv) with the same N/dv.  Only the integrated flux (K km/s) changes, in
+proportion to dv.  So the grids kept at dv = 0.25, 1, 5 and 10 km/s redo
+the same physics.
+
+run_linewidths groups the points that differ only in column and line width,
+computes each distinct N/dv of a group once (a node) and derives every
+point from its node: the same Tex, tau and Trot, the flux scaled by dv.
+That is exact, but only saves anything where the N/dv of different line
+widths coincide (e.g. log column axes whose step divides the ratios of the
+line widths).  With step (in dex), the nodes of a group are instead put on
+a log N/dv lattice through the N/dv values of its first point's line
+width, and points between two nodes are interpolated (log-log where the
+values are positive, Tex through 1/Tex), so a line width axis costs little
+more than the stretch of N/dv it adds.  Near a line's inversion, where
+Tex and tau change sign, the interpolated values are the least accurate.
+
+The derivation reads and writes read_radex_acts results (the default
+read_model, optionally with the line width at the end): column at 2, Tex
+at 3 and 4, tau at 5 and 6, Trot at 7 and 8, fluxes at 9 and 10.
+"""
+from __future__ import print_function
+import math
+import os
+import sys
+import radex_cache
+import radex_engine
+
+def column_line(lines):
+    """
+    Index of the column density in the lines of a radex.inp record (the
+    line width is on the next one)
+    """
+    return 6+2*int(lines[4])
+
+def split_linewidth(record):
+    """
+    (rest, column, deltav) of a radex.inp record: the canonical record (see
+    radex_cache) without column and line width, and those two
+    """
+    lines = record.split('\n')
+    icolumn = column_line(lines)
+    column,deltav = float(lines[icolumn]),float(lines[icolumn+1])
+    lines[icolumn] = lines[icolumn+1] = ''
+    return radex_cache.canonical_record('\n'.join(lines)),column,deltav
+
+class NodeInput(object):
+    """
+    write_input for the nodes: node (index, column, deltav) is grid point
+    index with its column and line width replaced (or as it is, if they are
+    None)
+    """
+    def __init__(self, points, write_input):
+        self.points = points
+        self.write_input = write_input
+
+    def __call__(self, infile, index, column=None, deltav=None):
+        record = radex_engine.input_record(self.write_input, self.points[index])
+        if column is not None:
+            lines = record.split('\n')
+            icolumn = column_line(lines)
+            lines[icolumn],lines[icolumn+1] = repr(column),repr(deltav)
+            record = '\n'.join(lines)
+        infile.write(record)
+
+def plan_nodes(points, write_input, step=None):
+    """
+    Returns (nodes, sources): the node points to compute (see NodeInput)
+    and, for each grid point, [(node index, weight), ...] (one node, or two
+    to interpolate between) with the point's column and line width
+    """
+    nodes = []
+    nodeindex = {}
+    sources = []
+    groups = {}
+    for index,point in enumerate(points):
+        rest,column,deltav = split_linewidth(radex_engine.input_record(write_input, point))
+        cddv = column/deltav
+        if rest not in groups:
+            # the group's lattice goes through this point's N/dv
+            groups[rest] = (index, deltav, math.log10(cddv))
+        first,deltav0,u0 = groups[rest]
+        if step is None:
+            keys = [(rest, "%.9e" % cddv)]
+            weights = [1.0]
+            newnodes = [(index, None, None)]
+        else:
+            k = (math.log10(cddv)-u0)/step
+            kk = int(round(k))
+            if abs(k-kk) < 1e-6:
+                keys,weights = [(rest, kk)],[1.0]
+            else:
+                kk = int(math.floor(k))
+                keys,weights = [(rest, kk), (rest, kk+1)],[kk+1-k, k-kk]
+            newnodes = []
+            for key in keys:
+                nodecddv = 10**(u0+key[1]*step)
+                if key[1] == 0:
+                    newnodes.append((first, None, None))
+                else:
+                    newnodes.append((first, nodecddv*deltav0, deltav0))
+        for key,node in zip(keys, newnodes):
+            if key not in nodeindex:
+                nodeindex[key] = len(nodes)
+                nodes.append(node)
+        sources.append(([(nodeindex[key],weight) for key,weight in zip(keys,weights)], column, deltav))
+    return nodes,sources
+
+def node_linewidth(node, points, write_input):
+    """
+    Line width of a node
+    """
+    index,column,deltav = node
+    if deltav is None:
+        deltav = split_linewidth(radex_engine.input_record(write_input, points[index]))[2]
+    return deltav
+
+def interpolate(a, b, weight):
+    """
+    a and b weighted (1-weight):weight, in log space if both are positive
+    """
+    if weight == 0:
+        return a
+    if a > 0 and b > 0:
+        return math.exp((1-weight)*math.log(a) + weight*math.log(b))
+    return (1-weight)*a + weight*b
+
+def derive_results(node_results, node_widths, source):
+    """
+    The results (one per act) of a grid point from those of its nodes
+    """
+    weighted,column,deltav = source
+    derived = []
+    for iact in range(len(node_results[weighted[0][0]])):
+        rows = [(list(node_results[inode][iact]),node_widths[inode],weight)
+                for inode,weight in weighted]
+        # the flux per km/s is what depends on N/dv only
+        for row,width,weight in rows:
+            row[9] /= width
+            row[10] /= width
+        result = rows[0][0]
+        if len(rows) == 2:
+            result = [interpolate(a, b, rows[1][2]) for a,b in zip(rows[0][0], rows[1][0])]
+            # Tex runs off to +-infinity where a line inverts; 1/Tex is smooth
+            for field in (3,4):
+                a,b = rows[0][0][field],rows[1][0][field]
+                if a != 0 and b != 0:
+                    inverse = (1-rows[1][2])/a + rows[1][2]/b
+                    result[field] = 1/inverse if inverse != 0 else float('inf')
+            # the fields that are not N/dv dependent are the group's
+            result[0:2] = rows[0][0][0:2]
+            result[11:] = rows[0][0][11:]
+        result[2] = float("%.3E" % column)
+        result[9] *= deltav
+        result[10] *= deltav
+        if len(result) > 12:
+            result[12] = deltav
+        derived.append(tuple(result))
+    return derived
+
+def run_linewidths(points, acts, write_input, output_row, header, step=None,
+                   suffix='', resume=False, log=sys.stdout, verbose=1, **options):
+    """
+    Compute a grid through N/dv similarity (see the module docstring) and
+    write its .dat files as run_grid would.  Returns the number of models
+    computed.
+
+    step - spacing (dex) of the N/dv lattice to interpolate on (no
+        coarser than the column axis, e.g. 0.1); None, or a lattice that
+        would need more models, to only reuse identical N/dv (exact)
+    Other options (executable, slots, cachedir, read_model, ...) go to
+    run_grid.
+    """
+    try:
+        from mpi4py import MPI
+        mpirank = MPI.COMM_WORLD.rank
+    except ImportError:
+        mpirank = 0
+    nodes,sources = plan_nodes(points, write_input, step=step)
+    if step is not None:
+        # a lattice finer than the column axis costs more than it saves
+        exact = plan_nodes(points, write_input)
+        if len(exact[0]) <= len(nodes):
+            if verbose > 0 and mpirank == 0: print("Line widths: the %.3g dex lattice needs %i models, exact reuse %i; reusing exactly" % (step,len(nodes),len(exact[0])), file=log)
+            nodes,sources = exact
+    ninterpolated = len([source for source in sources if len(source[0]) > 1])
+    if verbose > 0 and mpirank == 0: print("Line widths: %i points from %i models in N/dv (%i interpolated)" % (len(points),len(nodes),ninterpolated), file=log)
+    nodesuffix = suffix+"_ncddv"
+    radex_engine.run_grid(nodes, acts, NodeInput(points, write_input), output_row,
+                          header, suffix=nodesuffix, resume=resume,
+                          keep_checkpoints=True, log=log, verbose=verbose, **options)
+    if mpirank == 0:
+        cpprefix = radex_engine.checkpoint_name(nodesuffix)
+        done = radex_engine.read_checkpoints(cpprefix, nodes, len(acts))
+        widths = [node_linewidth(node, points, write_input) for node in nodes]
+        writer = radex_engine.GridWriter(radex_engine.output_filenames(acts, suffix),
+                                         header, output_row, len(points))
+        for index,source in enumerate(sources):
+            writer.add(index, derive_results(done, widths, source))
+        writer.close()
+        radex_engine.remove_checkpoints(cpprefix)
+        for gfil in radex_engine.output_filenames(acts, nodesuffix):
+            os.remove(gfil)
+    return len(nodes)
@@ -0,0 +1,345 @@
+"""
+In-process escape probability solver: RADEX's method, for many grid points
+at once.
+
+Running the radex_lvg/radex_sphere/radex_slab binaries costs every grid
+point a fork, a text round-trip and a full line table.  This module solves
+the same statistical equilibrium with numpy instead: the rate matrices of a
+whole batch of points (same molecule) are stacked into one
+(npoints, nlevels, nlevels) array and solved together with a batched
+linear solve, iterating the escape probabilities exactly as RADEX does
+(van der Tak et al. 2007): optically thin start, under-relaxation of the
+excitation temperatures, convergence when those of the lines with
+tau > 0.01 change by less than 1e-6.
+
+run_grid uses it when the executable is native_lvg, native_sphere or
+native_slab.  The grid points' radex.inp records are read back for the
+parameters, and each model is returned as radex.out-style text, so caching,
+radex.out and read_radex_acts work exactly as with the binaries.  The
+molecular data files are read from radexpath.  Only a blackbody background
+(tbg > 0) is supported.
+
+Dependencies:
+    numpy
+"""
+from __future__ import print_function
+import os
+import numpy as np
+import radex_lamda
+
+# physical constants as in RADEX (cgs)
+CLIGHT = 2.99792458e10
+HPLANCK = 6.6260963e-27
+KBOLTZ = 1.3806505e-16
+FK = HPLANCK*CLIGHT/KBOLTZ
+THC = 2*HPLANCK*CLIGHT
+FGAUS = 1.0645*8*np.pi
+
+MINITER = 10
+MAXITER = 9999
+CCRIT = 1e-6
+MINPOP = 1e-20
+MINTAU = -1.0
+# largest number of points solved together (memory goes as npoints*nlevels**2)
+BATCH = 1024
+
+EXECUTABLES = {'native_lvg':'lvg', 'native_sphere':'sphere', 'native_slab':'slab'}
+GEOMETRY_NAMES = {'lvg':'Expanding sphere (LVG)', 'sphere':'Uniform sphere',
+                  'slab':'Plane parallel slab'}
+# collider names in radex.inp -> LAMDA partner code, and as radex.out prints them
+PARTNER_CODES = dict((name,code) for code,name in radex_lamda.PARTNERS.items())
+PRINTED_NAMES = {'H2':'H2', 'p-H2':'pH2', 'o-H2':'oH2', 'e':'e', 'H':'H',
+                 'He':'He', 'H+':'H+'}
+
+def escape_probability(tau, geometry):
+    """
+    RADEX's escape probability (escprob.f) for an array of optical depths
+    """
+    tau = np.asarray(tau, dtype=float)
+    with np.errstate(all='ignore'):
+        if geometry == 'sphere':
+            # uniform sphere (Osterbrock), power laws at small and large tau
+            taur = tau/2.0
+            beta = 0.75/taur*(1.0-1.0/(2.0*taur**2)+(1.0/taur+1.0/(2.0*taur**2))*np.exp(-2.0*taur))
+            beta = np.where(np.abs(taur) < 0.1,
+                            1.0-0.75*taur+taur**2/2.5-taur**3/6.0+taur**4/17.5, beta)
+            beta = np.where(np.abs(taur) > 50.0, 0.75/taur, beta)
+        elif geometry == 'lvg':
+            # expanding sphere (de Jong, Boland & Dalgarno 1980), times 2
+            # so that beta(0) = 1
+            taur = tau/2.0
+            beta = 2.0*(1.0-np.exp(-2.34*taur))/(4.68*taur)
+            beta = np.where(np.abs(taur) >= 7.0, 2.0/(taur*4.0*np.sqrt(np.log(taur/np.sqrt(np.pi)))), beta)
+            beta = np.where(np.abs(taur) < 0.01, 1.0, beta)
+        elif geometry == 'slab':
+            # de Jong, Dalgarno & Chu 1975
+            beta = (1.0-np.exp(-3.0*tau))/(3.0*tau)
+            beta = np.where(np.abs(3.0*tau) < 0.1, 1.0-1.5*(tau+tau**2), beta)
+            beta = np.where(np.abs(3.0*tau) > 50.0, 1.0/(3.0*tau), beta)
+        else:
+            raise ValueError("Unknown geometry %r (lvg, sphere or slab)" % geometry)
+    return beta
+
+def planck_occupation(xnu, temperature):
+    """
+    Photon occupation number of a blackbody at wavenumbers xnu (cm^-1);
+    0 where RADEX's exponent cutoff (160) applies
+    """
+    with np.errstate(over='ignore', divide='ignore'):
+        exponent = FK*xnu/temperature
+        return np.where(exponent < 160, 1.0/np.expm1(np.minimum(exponent, 160)), 0.0)
+
+def partner_densities(molecule, tkin, colliders):
+    """
+    Density of every collision partner of the molecule for each point, from
+    the colliders of radex.inp ({name: array of densities}) the way RADEX
+    assigns them: a file with only o-H2 and p-H2 rates gets the total H2
+    split by the thermal ortho/para ratio, a file with H2 rates gets o-H2 +
+    p-H2 if no H2 is given.
+    """
+    zero = np.zeros_like(tkin)
+    given = dict((PARTNER_CODES[name],value) for name,value in colliders.items())
+    densities = {}
+    for code in molecule.partners:
+        density = given.get(code, zero)
+        if code == 1 and 1 not in given:
+            density = given.get(2, zero) + given.get(3, zero)
+        elif code in (2,3) and 2 not in given and 3 not in given and 1 in given:
+            opr = np.minimum(3.0, 9.0*np.exp(-170.6/tkin))
+            fortho = opr/(opr+1.0)
+            density = given[1]*(fortho if code == 3 else 1-fortho)
+        densities[code] = density
+    return densities
+
+def collision_matrix(molecule, tkin, densities):
+    """
+    Collision rates (s^-1) of each point as an (npoints, nlevels, nlevels)
+    array, element [to, from], from the molecule's tabulated rate matrices
+    (see radex_lamda.Molecule.collision_rates)
+    """
+    rates = np.zeros((len(tkin), molecule.nlevels, molecule.nlevels))
+    for code,matrices in molecule.collision_rates(tkin).items():
+        if np.any(densities[code]):
+            rates += matrices*densities[code][:,None,None]
+    return rates
+
+def solve_populations(rates):
+    """
+    Level populations (summing to 1) in statistical equilibrium for a stack
+    of rate matrices (element [to, from])
+    """
+    matrix = rates - np.eye(rates.shape[1])*rates.sum(axis=1)[:,None,:]
+    # the equations are dependent: replace the last one by the normalization
+    matrix[:,-1,:] = 1.0
+    rhs = np.zeros(rates.shape[:2])
+    rhs[:,-1] = 1.0
+    return np.linalg.solve(matrix, rhs[:,:,None])[:,:,0]
+
+class NativeSolver(object):
+    """
+    Escape probability solver for one molecule and geometry
+    """
+    def __init__(self, molecule, geometry='lvg'):
+        if geometry not in GEOMETRY_NAMES:
+            raise ValueError("Unknown geometry %r (lvg, sphere or slab)" % geometry)
+        self.molecule = molecule
+        self.geometry = geometry
+        upper,lower = molecule.upper,molecule.lower
+        # RADEX takes the line frequencies from the level energies
+        self.xnu = molecule.energies[upper]-molecule.energies[lower]
+        self.gratio = molecule.weights[upper]/molecule.weights[lower]
+
+    def optical_depth(self, pops, cddv):
+        """
+        Line centre optical depths for populations pops and column
+        density over line width cddv (cm^-2 / cm s^-1)
+        """
+        upper,lower = self.molecule.upper,self.molecule.lower
+        return (cddv[:,None]*(pops[:,lower]*self.gratio - pops[:,upper])
+                * self.molecule.aeinst/(FGAUS*self.xnu**3))
+
+    def excitation_temperature(self, pops, previous):
+        """
+        Excitation temperatures of the lines; where either level is empty
+        (population below MINPOP) the previous value is kept
+        """
+        upper,lower = self.molecule.upper,self.molecule.lower
+        with np.errstate(all='ignore'):
+            tex = FK*self.xnu/np.log(pops[:,lower]*self.gratio/pops[:,upper])
+        empty = (pops[:,lower] <= MINPOP) | (pops[:,upper] <= MINPOP)
+        return np.where(empty, previous, tex)
+
+    def radiative_rates(self, occupation):
+        """
+        Radiative rates [to, from] in a radiation field given as photon
+        occupation numbers at each line, (npoints, nlines)
+        """
+        molecule = self.molecule
+        npoints = occupation.shape[0]
+        rates = np.zeros((npoints, molecule.nlevels, molecule.nlevels))
+        down = molecule.aeinst*(1.0+occupation)
+        up = molecule.aeinst*self.gratio*occupation
+        np.add.at(rates, (slice(None), molecule.lower, molecule.upper), down)
+        np.add.at(rates, (slice(None), molecule.upper, molecule.lower), up)
+        return rates
+
+    def solve(self, tkin, colliders, column, deltav, tbg):
+        """
+        Solve a batch of points: tkin, column (cm^-2), deltav (FWHM, km/s)
+        and tbg (K) are arrays, colliders a {name: densities} dict.
+        Returns a dict of (npoints, nlines) arrays tex, tau, trad (K) and
+        flux (K km/s), popup and poplow, plus niter (npoints,).
+        """
+        tkin,column,deltav,tbg = [np.asarray(value, dtype=float) for value in (tkin,column,deltav,tbg)]
+        if np.any(tbg <= 0):
+            raise ValueError("The native solver only supports a blackbody background (tbg > 0)")
+        colliders = dict((name,np.asarray(value, dtype=float)) for name,value in colliders.items())
+        npoints = len(tkin)
+        collisions = collision_matrix(self.molecule, tkin, partner_densities(self.molecule, tkin, colliders))
+        nbg = planck_occupation(self.xnu[None,:], tbg[:,None])
+        cddv = column/(deltav*1e5)
+
+        # optically thin start: the lines only see the background
+        pops = solve_populations(collisions + self.radiative_rates(nbg))
+        tex = self.excitation_temperature(pops, tbg[:,None]*np.ones_like(nbg))
+        tau = self.optical_depth(pops, cddv)
+        niter = np.zeros(npoints, dtype=int)
+        active = np.arange(npoints)
+        for iteration in range(1, MAXITER+1):
+            # the lines see the escaping background plus their own source
+            # function at the previous excitation temperature
+            # RADEX cannot follow strong masers either (its results blow
+            # up below tau = -1); keep their escape probability finite
+            beta = escape_probability(np.maximum(tau[active], MINTAU), self.geometry)
+            occupation = beta*nbg[active] + (1.0-beta)*planck_occupation(self.xnu, tex[active])
+            try:
+                new = solve_populations(collisions[active] + self.radiative_rates(occupation))
+            except np.linalg.LinAlgError:
+                new = np.array([solve_or_nan(rates) for rates in collisions[active] + self.radiative_rates(occupation)])
+            newtex = self.excitation_temperature(new, tex[active])
+            thick = tau[active] > 0.01
+            with np.errstate(all='ignore'):
+                change = np.where(thick, np.abs((newtex-tex[active])/newtex), 0.0).sum(axis=1)
+            nthick = thick.sum(axis=1)
+            # under-relax the excitation temperatures, as RADEX does
+            tex[active] = 0.5*(newtex+tex[active])
+            tau[active] = self.optical_depth(new, cddv[active])
+            pops[active] = new
+            niter[active] = iteration
+            if iteration >= MINITER:
+                converged = (nthick == 0) | (change < CCRIT*np.maximum(nthick, 1))
+                # points that went non-finite will not recover
+                converged |= ~np.isfinite(new).all(axis=1)
+                active = active[~converged]
+            if len(active) == 0:
+                break
+
+        with np.errstate(all='ignore'):
+            ftau = np.exp(-tau)
+            # line intensity above the background, as a Rayleigh-Jeans temperature
+            trad = (nbg*ftau + planck_occupation(self.xnu, tex)*(1.0-ftau) - nbg)*FK*self.xnu
+        return {'tex':tex, 'tau':tau, 'trad':trad, 'flux':1.0645*deltav[:,None]*trad,
+                'popup':pops[:,self.molecule.upper], 'poplow':pops[:,self.molecule.lower],
+                'niter':niter}
+
+def solve_or_nan(rates):
+    """
+    solve_populations for one point, NaN if its matrix is singular
+    """
+    try:
+        return solve_populations(rates[None])[0]
+    except np.linalg.LinAlgError:
+        return np.nan*np.ones(rates.shape[0])
+
+def parse_input(record):
+    """
+    The parameters of one radex.inp record (as written by write_input)
+    """
+    words = [line.strip() for line in record.split('\n')]
+    ncoll = int(words[4])
+    fmin,fmax = [float(word) for word in words[2].split()]
+    colliders = {}
+    for name,density in zip(words[5:5+2*ncoll:2], words[6:6+2*ncoll:2]):
+        colliders[name] = colliders.get(name, 0.0) + float(density)
+    tbg,column,deltav = [float(word) for word in words[5+2*ncoll:8+2*ncoll]]
+    return {'molfile':words[0], 'fmin':fmin, 'fmax':fmax, 'tkin':float(words[3]),
+            'colliders':colliders, 'tbg':tbg, 'column':column, 'deltav':deltav}
+
+def format_model(params, molecule, geometry, result, ii, version='native'):
+    """
+    radex.out text of point ii of a NativeSolver.solve result (or of any
+    result with the same arrays, one entry per line of the molecule)
+    """
+    model = ["* Radex version        : %s" % version,
+             "* Geometry             : %s" % GEOMETRY_NAMES[geometry],
+             "* Molecular data file  : %s" % params['molfile'],
+             "* T(kin)            [K]: %8.3f" % params['tkin']]
+    for name,density in sorted(params['colliders'].items()):
+        model.append("* Density of %-4s[cm-3]: %10.3E" % (PRINTED_NAMES[name],density))
+    model += ["* T(background)     [K]: %8.3f" % params['tbg'],
+              "* Column density [cm-2]: %10.3E" % params['column'],
+              "* Line width     [km/s]: %8.3f" % params['deltav'],
+              "Calculation finished in %9i iterations" % result['niter'][ii],
+              "      LINE         E_UP       FREQ        WAVEL     T_EX      TAU        T_R       POP        POP       FLUX        FLUX",
+              "                    (K)       (GHz)       (um)       (K)                 (K)        UP        LOW     (K*km/s) (erg/cm2/s)"]
+    for iline in range(molecule.nlines):
+        freq = molecule.freq[iline]
+        if not params['fmin'] <= freq <= params['fmax']:
+            continue
+        xnu = molecule.energies[molecule.upper[iline]]-molecule.energies[molecule.lower[iline]]
+        trad = result['trad'][ii,iline]
+        ergs = FGAUS*KBOLTZ*params['deltav']*1e5*trad*xnu**3
+        model.append("%-6s -- %-6s%8.1f  %9.4f  %11.4f  %8.3f  %10.3E  %10.3E  %10.3E  %10.3E  %10.3E  %10.3E" % (
+            molecule.levels[molecule.upper[iline]], molecule.levels[molecule.lower[iline]],
+            molecule.eup[iline], freq, CLIGHT/freq/1e3, result['tex'][ii,iline],
+            result['tau'][ii,iline], trad, result['popup'][ii,iline],
+            result['poplow'][ii,iline], result['flux'][ii,iline], ergs))
+    return '\n'.join(model)+'\n'
+
+_molecules = {}
+
+def load_molecule(molfile, radexpath='.'):
+    """
+    load_lamda, remembering the molecules (and their tabulated collision
+    rates) already loaded by this process
+    """
+    filename = os.path.join(radexpath, molfile)
+    if filename not in _molecules:
+        _molecules[filename] = radex_lamda.load_lamda(filename)
+    return _molecules[filename]
+
+def run_models(chunk, write_input, executable="native_lvg", radexpath='.'):
+    """
+    Solve a chunk of grid points in batches, yielding each model's
+    radex.out text in order (the in-process counterpart of
+    radex_engine.run_models)
+    """
+    geometry = EXECUTABLES[executable]
+    from radex_engine import input_record
+    allparams = [parse_input(input_record(write_input, point)) for point in chunk]
+    # tabulate the collision rates of every temperature of the chunk (often
+    # the whole temperature axis) at once
+    for molfile in set(param['molfile'] for param in allparams):
+        load_molecule(molfile, radexpath).tabulate([param['tkin'] for param in allparams
+                                                    if param['molfile'] == molfile])
+    for first in range(0, len(chunk), BATCH):
+        params = allparams[first:first+BATCH]
+        # points of one batch normally share the molecule and colliders;
+        # solve each distinct combination together
+        groups = {}
+        for ii,param in enumerate(params):
+            groups.setdefault((param['molfile'], tuple(sorted(param['colliders']))), []).append(ii)
+        models = [None]*len(params)
+        for (molfile,names),members in groups.items():
+            molecule = load_molecule(molfile, radexpath)
+            solver = NativeSolver(molecule, geometry)
+            batch = [params[ii] for ii in members]
+            result = solver.solve([param['tkin'] for param in batch],
+                                  dict((name,[param['colliders'][name] for param in batch]) for name in names),
+                                  [param['column'] for param in batch],
+                                  [param['deltav'] for param in batch],
+                                  [param['tbg'] for param in batch])
+            for jj,ii in enumerate(members):
+                models[ii] = format_model(params[ii], molecule, geometry, result, jj)
+        for model in models:
+            yield model
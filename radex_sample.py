@@ -0,0 +1,318 @@
+"""
+Quasi-random sampling of RADEX parameter spaces.
+
+A cartesian grid gets expensive quickly once opr, dv or abundance are axes
+(51x3x21x21 points in thermom/radex_grid_para_5kms_abund.py).  run_samples
+instead draws n points over the whole parameter box, from a Sobol sequence
+(low discrepancy; best with n a power of 2) or a Latin hypercube, and runs
+them through run_grid like any other grid.
+
+The results go to radex_samples<suffix>.json: a line of metadata, then one
+line per sample [u, point, results], where u are the sample's coordinates
+in the unit cube (log axes are uniform in log) and results the read_model
+results for every act.  ScatteredInterpolator interpolates them with a
+local linear fit to the k nearest samples in the unit cube, found with a
+k-d tree.  resample_samples uses it to write ordinary .dat files on the
+regular grid of the axes, for plot_grids.gridcube(shape=...).
+
+Axes are described as in grid specs (see radex_spec): {"min", "max", "log"}
+for continuous axes, or {"values"} for a few discrete ones, which are
+sampled evenly.
+
+Dependencies:
+    numpy (for ScatteredInterpolator, i.e. resample_samples)
+"""
+from __future__ import print_function
+import heapq
+import json
+import math
+import random
+import sys
+import radex_engine
+
+# Sobol direction numbers (Joe & Kuo 2008, new-joe-kuo-6.21201) for
+# dimensions 2 and up: (s, a, m_1 .. m_s); dimension 1 is van der Corput
+SOBOL_DIRECTIONS = [
+    (1, 0, (1,)),
+    (2, 1, (1, 3)),
+    (3, 1, (1, 3, 1)),
+    (3, 2, (1, 1, 1)),
+    (4, 1, (1, 1, 3, 3)),
+    (4, 4, (1, 3, 5, 13)),
+    (5, 2, (1, 1, 5, 5, 17)),
+    (5, 4, (1, 1, 5, 5, 5)),
+    (5, 7, (1, 1, 7, 11, 19)),
+]
+SOBOL_BITS = 30
+
+def sobol_directions(dim):
+    """
+    Direction numbers (as SOBOL_BITS-bit integers) of every dimension
+    """
+    if dim > len(SOBOL_DIRECTIONS)+1:
+        raise ValueError("Sobol sampling supports up to %i dimensions" % (len(SOBOL_DIRECTIONS)+1))
+    directions = [[1 << (SOBOL_BITS-k) for k in range(1, SOBOL_BITS+1)]]
+    for s,a,m in SOBOL_DIRECTIONS[:dim-1]:
+        v = [m[k] << (SOBOL_BITS-k-1) for k in range(s)]
+        for k in range(s, SOBOL_BITS):
+            value = v[k-s] ^ (v[k-s] >> s)
+            for j in range(1, s):
+                if (a >> (s-1-j)) & 1:
+                    value ^= v[k-j]
+            v.append(value)
+        directions.append(v)
+    return directions
+
+def sobol_points(n, dim):
+    """
+    The first n points of the dim-dimensional Sobol sequence (Gray code
+    order, starting at the origin)
+    """
+    directions = sobol_directions(dim)
+    x = [0]*dim
+    points = []
+    for ii in range(n):
+        points.append([value / float(1 << SOBOL_BITS) for value in x])
+        # flip the direction of the lowest zero bit of ii
+        c = 0
+        while (ii >> c) & 1:
+            c += 1
+        for d in range(dim):
+            x[d] ^= directions[d][c]
+    return points
+
+def latin_hypercube(n, dim, seed=0):
+    """
+    n points with exactly one in each of n equal slices of every dimension
+    """
+    rng = random.Random(seed)
+    columns = []
+    for d in range(dim):
+        strata = list(range(n))
+        rng.shuffle(strata)
+        columns.append([(stratum + rng.random()) / n for stratum in strata])
+    return [list(point) for point in zip(*columns)]
+
+def unit_to_axis(u, axis):
+    """
+    (value, unit coordinate) of the axis at unit coordinate u; discrete
+    axes snap to the nearest of their values
+    """
+    if 'values' in axis:
+        values = axis['values']
+        index = min(int(u*len(values)), len(values)-1)
+        return float(values[index]), (index / float(len(values)-1) if len(values) > 1 else 0.0)
+    vmin,vmax = float(axis['min']),float(axis['max'])
+    if axis.get('log'):
+        return 10**(math.log10(vmin) + u*(math.log10(vmax)-math.log10(vmin))), u
+    return vmin + u*(vmax-vmin), u
+
+def draw(axes, n, method='sobol', seed=0):
+    """
+    Returns (unit coordinates, points) of n samples of the box of axes
+    """
+    if method == 'sobol':
+        samples = sobol_points(n, len(axes))
+    elif method == 'lhs':
+        samples = latin_hypercube(n, len(axes), seed=seed)
+    else:
+        raise ValueError("Unknown sampling method %r (sobol or lhs)" % method)
+    units = []
+    points = []
+    for sample in samples:
+        values = [unit_to_axis(u, axis) for u,axis in zip(sample, axes)]
+        points.append(tuple(value for value,unit in values))
+        units.append([unit for value,unit in values])
+    return units,points
+
+def store_name(suffix):
+    return "radex_samples%s.json" % suffix
+
+def run_samples(axes, n, acts, write_input, output_row, header, method='sobol',
+                seed=0, suffix='', resume=False, log=sys.stdout, verbose=1,
+                **options):
+    """
+    Run n samples of the box of axes (see draw) with run_grid and store the
+    results (see the module docstring).  Returns the name of the store.
+    The .dat files of the samples themselves, in sample order, are written
+    with suffix+"_samples"; other options go to run_grid.
+    """
+    units,points = draw(axes, n, method=method, seed=seed)
+    samplesuffix = suffix+"_samples"
+    radex_engine.run_grid(points, acts, write_input, output_row, header,
+                          suffix=samplesuffix, resume=resume,
+                          keep_checkpoints=True, log=log, verbose=verbose,
+                          **options)
+    try:
+        from mpi4py import MPI
+        mpirank = MPI.COMM_WORLD.rank
+    except ImportError:
+        mpirank = 0
+    storename = store_name(suffix)
+    if mpirank == 0:
+        cpprefix = radex_engine.checkpoint_name(samplesuffix)
+        done = radex_engine.read_checkpoints(cpprefix, points, len(acts))
+        storefile = open(storename,'w')
+        storefile.write(json.dumps({'axes':axes, 'method':method, 'n':n,
+                                    'acts':acts, 'header':header})+'\n')
+        for index,(unit,point) in enumerate(zip(units,points)):
+            storefile.write(json.dumps([unit, list(point), [list(result) for result in done[index]]])+'\n')
+        storefile.close()
+        radex_engine.remove_checkpoints(cpprefix)
+        if verbose > 0: print("Stored %i %s samples in %s" % (n,method,storename), file=log)
+    return storename
+
+class KDTree(object):
+    """
+    k-d tree over a list of points (sequences of floats), for nearest
+    neighbour queries
+    """
+    def __init__(self, points):
+        self.points = points
+        self.root = self._build(list(range(len(points))), 0)
+
+    def _build(self, indices, depth):
+        if not indices:
+            return None
+        axis = depth % len(self.points[indices[0]])
+        indices.sort(key=lambda index: self.points[index][axis])
+        middle = len(indices)//2
+        return (indices[middle], axis,
+                self._build(indices[:middle], depth+1),
+                self._build(indices[middle+1:], depth+1))
+
+    def nearest(self, point, k):
+        """
+        [(squared distance, index), ...] of the k points nearest to point,
+        nearest first
+        """
+        heap = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            index,axis,left,right = node
+            distance = sum([(a-b)**2 for a,b in zip(point, self.points[index])])
+            if len(heap) < k:
+                heapq.heappush(heap, (-distance, index))
+            elif distance < -heap[0][0]:
+                heapq.heapreplace(heap, (-distance, index))
+            offset = point[axis] - self.points[index][axis]
+            near,far = (left,right) if offset < 0 else (right,left)
+            # the far side can only help if the splitting plane is closer
+            # than the worst of the k found so far
+            if len(heap) < k or offset**2 < -heap[0][0]:
+                stack.append(far)
+            stack.append(near)
+        return sorted([(-distance, index) for distance,index in heap])
+
+def finite(results):
+    return all([value == value and abs(value) != float('inf')
+                for result in results for value in result])
+
+class ScatteredInterpolator(object):
+    """
+    Interpolation of scattered samples by a local linear fit: the k nearest
+    samples (in the unit cube) are fitted with a plane, weighted by inverse
+    squared distance, and the plane is evaluated at the point.  Quantities
+    that are positive at all k samples are fitted in log, since fluxes and
+    optical depths change by decades across a grid.
+
+    units - unit cube coordinates of the samples
+    values - the read_model results (one per act) of each sample; samples
+        with non-finite results (failed points) are left out
+    k - number of nearest samples used (default 2*(dim+1))
+    """
+    def __init__(self, units, values, k=None):
+        keep = [ii for ii in range(len(units)) if finite(values[ii])]
+        self.units = [units[ii] for ii in keep]
+        self.values = [values[ii] for ii in keep]
+        self.tree = KDTree(self.units)
+        self.dim = len(self.units[0])
+        self.k = min(k or 2*(self.dim+1), len(self.units))
+
+    def __call__(self, unit):
+        import numpy as np
+        neighbours = self.tree.nearest(unit, self.k)
+        if neighbours[0][0] == 0:
+            return [list(result) for result in self.values[neighbours[0][1]]]
+        indices = [index for distance,index in neighbours]
+        weights = np.array([1.0/distance for distance,index in neighbours])
+        # weighted least squares for value = c + g.(u - unit), set up once
+        # for every field; a little ridge on g (rows of its own) keeps
+        # directions the neighbours do not span (e.g. a discrete axis) flat
+        # instead of singular
+        offsets = np.array([self.units[index] for index in indices]) - np.asarray(unit, dtype=float)
+        ridge = 1e-6*np.dot(weights, offsets**2).sum()/max(self.dim,1)
+        scale = np.sqrt(weights)[:,None]
+        matrix = np.vstack([scale*np.hstack([np.ones((len(indices),1)), offsets]),
+                            np.hstack([np.zeros((self.dim,1)), np.sqrt(ridge)*np.eye(self.dim)])])
+        # one column per field of every act
+        samples = np.array([[value for result in self.values[index] for value in result]
+                            for index in indices], dtype=float)
+        logscale = (samples > 0).all(axis=0)
+        samples[:,logscale] = np.log(samples[:,logscale])
+        rhs = np.vstack([scale*samples, np.zeros((self.dim,samples.shape[1]))])
+        fit,residuals,rank,singular = np.linalg.lstsq(matrix, rhs, rcond=None)
+        if rank < self.dim+1:
+            values = np.dot(weights, samples)/weights.sum()
+        else:
+            values = fit[0]
+        values[logscale] = np.exp(values[logscale])
+        values = values.tolist()
+        model_rows = []
+        for result in self.values[0]:
+            model_rows.append(values[:len(result)])
+            values = values[len(result):]
+        return model_rows
+
+def read_store(filename):
+    """
+    Returns (metadata, unit coordinates, points, results) of a sample store
+    """
+    storefile = open(filename)
+    metadata = json.loads(storefile.readline())
+    units,points,values = [],[],[]
+    for line in storefile:
+        unit,point,results = json.loads(line)
+        units.append(unit)
+        points.append(tuple(point))
+        values.append([tuple(result) for result in results])
+    storefile.close()
+    return metadata,units,points,values
+
+def resample_samples(storename, output_row, shape=None, exact=None, k=None,
+                     suffix='', log=sys.stdout, verbose=1):
+    """
+    Write the .dat files of the regular grid of the store's axes, with
+    shape (default: the axes' "n", or their number of values) points along
+    them, interpolating the samples with ScatteredInterpolator.
+    exact(point, model_rows) may set the parameters in the interpolated
+    results (e.g. temperature and density) to the grid point's exact values.
+    Returns the shape, for plot_grids.gridcube(shape=...).
+    """
+    metadata,units,points,values = read_store(storename)
+    axes,acts,header = metadata['axes'],metadata['acts'],metadata['header']
+    if shape is None:
+        shape = [len(axis['values']) if 'values' in axis else int(axis['n']) for axis in axes]
+    interpolator = ScatteredInterpolator(units, values, k=k)
+    gridaxes = []
+    for axis,npoints in zip(axes, shape):
+        if 'values' in axis:
+            gridaxes.append([unit_to_axis((ii+0.5)/len(axis['values']), axis) for ii in range(len(axis['values']))])
+        else:
+            gridaxes.append([unit_to_axis(ii/float(npoints-1) if npoints > 1 else 0.0, axis)
+                             for ii in range(npoints)])
+    grid = radex_engine.grid_points(*gridaxes)
+    gfils = radex_engine.output_filenames(acts, suffix)
+    writer = radex_engine.GridWriter(gfils, header, output_row, len(grid))
+    for index,node in enumerate(grid):
+        point = tuple(value for value,unit in node)
+        model_rows = interpolator([unit for value,unit in node])
+        if exact is not None:
+            exact(point, model_rows)
+        writer.add(index, [tuple(result) for result in model_rows])
+    writer.close()
+    if verbose > 0: print("Resampled %i samples of %s onto %s: %s" % (len(units),storename,'x'.join([str(n) for n in shape]),', '.join(gfils)), file=log)
+    return shape
@@ -0,0 +1,462 @@
+"""
+Run a RADEX grid described by a spec file instead of a copy of radex_grid.py.
+
+    python radex_spec.py grid.json [--plan] [--resume] [--shard i/N] [--merge N]
+    mpirun -np 8 python radex_spec.py grid.json > grid.log
+
+The spec is a JSON file holding only what differs between the grid
+scripts, for example (the same grid as radex_grid.py):
+
+    {
+     "moldata": "o-h2co.dat",
+     "geometry": "lvg",
+     "frequency": [4.0, 200.0],
+     "acts": [[4.8, 14.5, "1-1_2-2.dat"], [4.8, 29.0, "1-1_3-3.dat"],
+              [14.5, 29.0, "2-2_3-3.dat"]],
+     "parameters": {"tbg": 2.73, "dv": 1.0},
+     "axes": [{"name": "temperature", "min": 5, "max": 55, "n": 11},
+              {"name": "density", "min": 1e1, "max": 1e7, "n": 11, "log": true},
+              {"name": "column", "min": 1e11, "max": 1e16, "n": 11, "log": true}],
+     "run": {"slots": 1, "timeout": null}
+    }
+
+axes - the grid axes, slowest varying first; each has either "values" or
+    "min", "max", "n" and optionally "log".  Names are temperature, density,
+    column, abundance (column = abundance*density*length), opr (the H2
+    ortho-to-para ratio; without it the collider is H2) and dv (line width,
+    km/s; the .dat files get a dv column).
+parameters - values for parameters that are not axes, plus tbg (2.73), dv
+    (1.0 km/s) and length (3.08e18 cm, for abundance grids)
+geometry - lvg, sphere or slab, i.e. the radex_<geometry> executable;
+    "executable" overrides it
+solver - "radex" (default) runs the RADEX executable; "native" solves the
+    models in-process, a batch at a time (see radex_native; needs numpy);
+    "pyradex" and "fjdu" use pyradex.Radex and pyradex.fjdu.Fjdu (see
+    radex_backend).  radex_spec.py grid.json --compare <solver> runs the
+    points with both solvers and reports their differences instead of
+    writing the .dat files.
+frequency, bandwidth (0.01) - as flow, fupp and bw in the grid scripts
+suffix - optional label put in the output names
+amr - compute the grid by adaptive mesh refinement (see radex_amr) over
+    two of temperature, density and column: {"refine": ["density",
+    "column"], "levels": 3, "tol": 0.05, "quantities": ["ratio", "tau",
+    "tex"], "shape": [201, 201]}; the axes of "refine" are the coarse grid
+    and the .dat files are resampled to "shape" (default: the finest level).
+    Cells are split in log space along axes with "log": true and linearly
+    along the others.
+    With "targets": [{"act": "303-202_321-220_5kms.dat", "ratio": 1.9,
+    "sigma": 0.2}, ...] (act name or index; ratio = FluxLow/FluxUpp), only
+    cells that can match the observed ratios within "nsigma" (3) sigma are
+    refined, up to "budget" points
+sampling - run quasi-random samples of the box of the axes instead of the
+    cartesian grid (see radex_sample): {"method": "sobol", "n": 1024} or
+    {"method": "lhs", "n": 1000, "seed": 0}, plus "neighbours" (k) for the
+    interpolation; the .dat files are resampled to the axes' grid.  Axes
+    with "values" are sampled evenly over their values.
+thin - scale the optically thin columns of each (temperature, density,
+    ...) from the lowest one instead of running them (see radex_thin):
+    {"tau": 0.01, "verify": 0.1, "tol": 0.01}
+similarity - how a dv axis is computed (see radex_linewidth): by default
+    each distinct N/dv is run once and the other line widths derived from
+    it exactly; {"step": 0.1} interpolates on a lattice of N/dv with that
+    spacing (dex) instead; false runs every point
+run - run_grid options (nprocs, slots, timeout, minchunk, stream, scratch,
+    cachedir, radexpath, verbose); they do not change the results
+
+compile_plan turns the spec into a GridPlan: the point list in axis order,
+write_input and output_row, the executable and the chunk size.  The output
+files are named <act><suffix>_<hash>.dat, where hash identifies everything
+in the spec but "run", and a copy of the spec is written to grid_<hash>.json,
+so a grid is only ever written under the name of the spec that produced it.
+"""
+from __future__ import print_function
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import radex_amr
+import radex_backend
+import radex_engine
+import radex_linewidth
+import radex_sample
+import radex_thin
+
+AXIS_NAMES = ('temperature', 'density', 'column', 'abundance', 'opr', 'dv')
+DEFAULT_PARAMETERS = {'tbg':2.73, 'dv':1.0, 'length':3.08e18}
+# positions of the axes adaptive refinement can use in read_radex_acts results
+RESULT_FIELDS = {'temperature':0, 'density':1, 'column':2}
+
+def load_spec(filename):
+    specfile = open(filename)
+    spec = json.load(specfile)
+    specfile.close()
+    return spec
+
+def spec_hash(spec):
+    """
+    Hash of everything in the spec that changes the results (not "run")
+    """
+    physics = dict((key,value) for key,value in spec.items() if key != 'run')
+    text = json.dumps(physics, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def axis_values(axis):
+    """
+    Values of one axis, computed as in the grid scripts
+    """
+    if 'values' in axis:
+        return [float(value) for value in axis['values']]
+    vmin,vmax,n = float(axis['min']),float(axis['max']),int(axis['n'])
+    if n == 1:
+        return [vmin]
+    if axis.get('log'):
+        return [ 10**( math.log10(vmin) + (ii) / float(n-1) * (math.log10(vmax)-math.log10(vmin)) )  for ii in range(n) ]
+    return [ vmin + (ii) / float(n-1) * (vmax-vmin)  for ii in range(n) ]
+
+class GridPlan(object):
+    """
+    A compiled grid spec: everything run_grid needs.
+
+    names, axes, shape - axis names and values, slowest varying first
+    points - list of parameter tuples in grid order
+    executable, minchunk - RADEX executable and smallest chunk of points
+    suffix - output name suffix, ending in the spec hash
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.hash = spec_hash(spec)
+        for key in ('moldata','acts','axes'):
+            if key not in spec:
+                raise ValueError("Grid spec has no %r" % key)
+        self.names = [axis['name'] for axis in spec['axes']]
+        self.axes = [axis_values(axis) for axis in spec['axes']]
+        self.shape = tuple(len(values) for values in self.axes)
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.parameters.update(spec.get('parameters',{}))
+        for name in self.names:
+            if name not in AXIS_NAMES:
+                raise ValueError("Unknown grid axis %r (known: %s)" % (name,', '.join(AXIS_NAMES)))
+            if name in spec.get('parameters',{}):
+                raise ValueError("%r is both an axis and a parameter" % name)
+        known = set(self.names) | set(self.parameters)
+        for name in ('temperature','density'):
+            if name not in known:
+                raise ValueError("Grid spec has no %s (axis or parameter)" % name)
+        if ('column' in known) == ('abundance' in known):
+            raise ValueError("Grid spec needs either a column or an abundance")
+        self.has_opr = 'opr' in known
+        self.has_dv = 'dv' in self.names
+        self.has_abundance = 'abundance' in known
+
+        self.geometry = spec.get('geometry','lvg')
+        if self.geometry not in radex_backend.GEOMETRIES:
+            raise ValueError("Unknown geometry %r (known: %s)" % (self.geometry,', '.join(radex_backend.GEOMETRIES)))
+        solver = spec.get('solver','radex')
+        if solver not in radex_backend.SOLVERS:
+            raise ValueError("Unknown solver %r (known: %s)" % (solver,', '.join(radex_backend.SOLVERS)))
+        self.executable = spec.get('executable', radex_backend.executable_name(solver, self.geometry))
+        self.flow,self.fupp = spec.get('frequency', (4.0,200.0))
+        self.bw = spec.get('bandwidth', 0.01)
+        self.acts = spec['acts']
+        label = spec.get('suffix','')
+        self.suffix = "%s_%s" % (label, self.hash[:8])
+
+        self.run_options = dict(spec.get('run',{}))
+        self.points = radex_engine.grid_points(*self.axes)
+        # a chunk of at least one sweep of the fastest axis keeps the tail
+        # of the grid from being handed out a few points per RADEX start
+        self.minchunk = self.run_options.pop('minchunk', len(self.axes[-1]) if self.axes else 1)
+
+        self.header = ["Temperature","log10(dens)","log10(col)"]
+        if self.has_abundance:
+            self.header.append("log10(X)")
+        if self.has_opr:
+            self.header.append("opr")
+        if self.has_dv:
+            self.header.append("dv")
+        self.header += ["Tex_low","Tex_hi","TauLow","TauUpp","TrotLow","TrotUpp","FluxLow","FluxUpp"]
+        self.header = tuple(self.header)
+
+        self.amr = None
+        if 'amr' in spec:
+            self.amr = dict(spec['amr'])
+            refine = self.amr.pop('refine', ['density','column'])
+            for name in refine:
+                if name not in RESULT_FIELDS or name not in self.names:
+                    raise ValueError("Cannot refine %r: refine needs two axes out of %s" % (name,', '.join(sorted(RESULT_FIELDS))))
+            if len(refine) != 2:
+                raise ValueError("amr needs two axes to refine, not %i" % len(refine))
+            refine = sorted(refine, key=self.names.index)
+            self.amr['refine'] = [self.names.index(name) for name in refine]
+            self.amr['fields'] = [RESULT_FIELDS[name] for name in refine]
+            # cells of a linear axis (temperature, as a rule) split linearly
+            self.amr['logscale'] = [bool(spec['axes'][position].get('log')) for position in self.amr['refine']]
+            if 'targets' in self.amr:
+                actnames = [act[2] for act in self.acts]
+                targets = []
+                for target in self.amr['targets']:
+                    iact = target['act']
+                    if not isinstance(iact, int):
+                        if iact not in actnames:
+                            raise ValueError("Target act %r is not one of %s" % (iact,', '.join(actnames)))
+                        iact = actnames.index(iact)
+                    targets.append((iact, float(target['ratio']), float(target['sigma'])))
+                self.amr['targets'] = targets
+            levels = self.amr.setdefault('levels', 3)
+            shape = self.amr.pop('shape', None)
+            if shape is None:
+                shape = [(len(self.axes[position])-1)*2**levels+1 for position in self.amr['refine']]
+            self.amr_shape = shape
+            self.shape = tuple(n if ii not in self.amr['refine'] else shape[self.amr['refine'].index(ii)]
+                               for ii,n in enumerate(self.shape))
+
+        self.sampling = None
+        if 'sampling' in spec:
+            if self.amr is not None:
+                raise ValueError("A grid spec cannot have both amr and sampling")
+            self.sampling = dict(spec['sampling'])
+            if 'n' not in self.sampling:
+                raise ValueError("sampling needs the number of samples, n")
+            self.sampling.setdefault('method', 'sobol')
+            self.points = radex_sample.draw(spec['axes'], self.sampling['n'],
+                                            method=self.sampling['method'],
+                                            seed=self.sampling.get('seed',0))[1]
+            # samples are scattered, so the fastest axis says nothing about chunks
+            self.minchunk = spec.get('run',{}).get('minchunk', 1)
+
+        self.thin = None
+        if 'thin' in spec:
+            if self.amr is not None or self.sampling is not None:
+                raise ValueError("A grid spec cannot have thin with amr or sampling")
+            self.thin = dict(spec['thin'])
+
+        self.similarity = None
+        if spec.get('similarity'):
+            if not self.has_dv:
+                raise ValueError("similarity needs a dv axis")
+            if self.amr is not None or self.sampling is not None or self.thin is not None:
+                raise ValueError("A grid spec cannot have similarity with amr, sampling or thin")
+        if (self.has_dv and spec.get('similarity', True) is not False and self.amr is None
+                and self.sampling is None and self.thin is None):
+            self.similarity = dict(spec.get('similarity') or {})
+
+    def point_parameters(self, point):
+        """
+        The physical parameters of one grid point as a dictionary
+        """
+        params = dict(self.parameters)
+        params.update(zip(self.names, point))
+        if self.has_abundance:
+            params['column'] = params['abundance']*params['density']*params['length']
+        return params
+
+    def write_input(self, infile, *point):
+        """
+        Write radex.inp file parameters
+        """
+        params = self.point_parameters(point)
+        nh2 = params['density']
+        infile.write(self.spec['moldata']+'\n')
+        infile.write('radex.out\n')
+        infile.write(str(self.flow*(1-self.bw))+' '+str(self.fupp/(1-self.bw))+'\n')
+        infile.write(str(params['temperature'])+'\n')
+        if not self.has_opr:
+            infile.write('1\n')
+            infile.write('H2\n')
+            infile.write(str(nh2)+'\n')
+        elif params['opr'] == 0:
+            infile.write('1\n')
+            infile.write('p-H2\n')
+            infile.write(str(nh2)+'\n')
+        else:
+            opr = params['opr']
+            infile.write('2\n')
+            infile.write('o-H2\n')
+            infile.write(str(nh2/(opr+1.0)*opr)+'\n')
+            infile.write('p-H2\n')
+            infile.write(str(nh2/(opr+1.0))+'\n')
+        infile.write(str(params['tbg'])+'\n')
+        infile.write(str(params['column'])+'\n')
+        infile.write(str(params['dv'])+'\n')
+
+    def output_row(self, radex_out):
+        """
+        Convert a radex_engine.read_radex_acts result into a row of the .dat file
+        """
+        temp,dens,col,tlow,tupp,taulow,tauupp,trotlow,trotupp,fluxlow,fluxupp,opr = radex_out[:12]
+        row = [temp, math.log10(dens), math.log10(col)]
+        if self.has_abundance:
+            row.append(math.log10(col/(dens*self.parameters['length'])))
+        if self.has_opr:
+            row.append(opr)
+        if self.has_dv:
+            row.append(radex_out[12])
+        return tuple(row + [tlow, tupp, taulow, tauupp, trotlow,trotupp,fluxlow,fluxupp])
+
+    def read_model(self, model, acts):
+        """
+        read_radex_acts with the line width, for grids with a dv axis
+        """
+        return radex_engine.read_radex_acts(model, acts, bw=self.bw, deltav=True)
+
+    def exact_parameters(self, point, model_rows):
+        """
+        Put the parameters of point into interpolated read_radex_acts results
+        """
+        params = self.point_parameters(point)
+        for result in model_rows:
+            result[0:3] = [params['temperature'], params['density'], params['column']]
+            if self.has_opr:
+                result[11] = params['opr']
+            if self.has_dv:
+                result[12] = params['dv']
+
+    def output_files(self):
+        return [act[2].replace(".dat",self.suffix+".dat") for act in self.acts]
+
+    def describe(self, log=sys.stdout):
+        if self.sampling is not None:
+            print("Sampling %i %s points of the box of %s" % (len(self.points),
+                  self.sampling['method'], ', '.join(self.names)), file=log)
+        print("Grid %s: %i points, shape %s (%s)" % (self.hash[:8], len(self.points),
+              'x'.join(str(n) for n in self.shape), ', '.join(self.names)), file=log)
+        print("Running %s on %s, chunks of at least %i points" % (self.executable,
+              self.spec['moldata'], self.minchunk), file=log)
+        print("Output: %s (plot_grids.py --shape=%s)" % (', '.join(self.output_files()),
+              ','.join(str(n) for n in self.shape)), file=log)
+
+    def save_spec(self):
+        """
+        Write the spec next to the outputs as grid_<hash>.json
+        """
+        filename = "grid_%s.json" % self.hash[:8]
+        fd,tmpname = tempfile.mkstemp(dir='.')
+        tmpfile = os.fdopen(fd,'w')
+        json.dump(self.spec, tmpfile, indent=1, sort_keys=True)
+        tmpfile.close()
+        os.rename(tmpname, filename)
+        return filename
+
+    def run(self, resume=False, shard=None, merge=None, log=sys.stdout):
+        options = dict(self.run_options)
+        verbose = options.pop('verbose', 1)
+        if self.has_dv:
+            options['read_model'] = self.read_model
+        if self.amr is not None:
+            if shard or merge:
+                raise ValueError("Adaptive grids cannot be run as shards")
+            self.save_spec()
+            storename = radex_amr.run_amr(self.axes, self.amr['refine'], self.acts,
+                                          self.write_input, self.output_row, self.header,
+                                          bw=self.bw, executable=self.executable,
+                                          minchunk=self.minchunk, suffix=self.suffix,
+                                          resume=resume, log=log, verbose=verbose,
+                                          **dict(options, **dict((key,value) for key,value in self.amr.items() if key != 'refine')))
+            try:
+                from mpi4py import MPI
+                mpirank = MPI.COMM_WORLD.rank
+            except ImportError:
+                mpirank = 0
+            if mpirank == 0:
+                radex_amr.resample_amr(storename, self.output_row, shape=self.amr_shape,
+                                       suffix=self.suffix, log=log, verbose=verbose)
+            return
+        if self.sampling is not None:
+            if shard or merge:
+                raise ValueError("Sampled grids cannot be run as shards")
+            self.save_spec()
+            storename = radex_sample.run_samples(self.spec['axes'], self.sampling['n'],
+                                                 self.acts, self.write_input,
+                                                 self.output_row, self.header,
+                                                 method=self.sampling['method'],
+                                                 seed=self.sampling.get('seed',0),
+                                                 bw=self.bw, executable=self.executable,
+                                                 minchunk=self.minchunk, suffix=self.suffix,
+                                                 resume=resume, log=log, verbose=verbose,
+                                                 **options)
+            try:
+                from mpi4py import MPI
+                mpirank = MPI.COMM_WORLD.rank
+            except ImportError:
+                mpirank = 0
+            if mpirank == 0:
+                radex_sample.resample_samples(storename, self.output_row, shape=self.shape,
+                                              exact=self.exact_parameters,
+                                              k=self.sampling.get('neighbours'),
+                                              suffix=self.suffix, log=log, verbose=verbose)
+            return
+        if self.thin is not None:
+            if shard or merge:
+                raise ValueError("Grids on the thin path cannot be run as shards")
+            self.save_spec()
+            radex_thin.run_thin(self.points, self.acts, self.write_input,
+                                self.output_row, self.header, bw=self.bw,
+                                suffix=self.suffix, executable=self.executable,
+                                minchunk=self.minchunk, resume=resume, log=log,
+                                verbose=verbose, **dict(options, **self.thin))
+            return
+        if self.similarity is not None:
+            if shard or merge:
+                raise ValueError("Grids computed through N/dv similarity cannot be run as shards")
+            self.save_spec()
+            radex_linewidth.run_linewidths(self.points, self.acts, self.write_input,
+                                           self.output_row, self.header, bw=self.bw,
+                                           suffix=self.suffix, executable=self.executable,
+                                           minchunk=self.minchunk, resume=resume, log=log,
+                                           verbose=verbose, **dict(options, **self.similarity))
+            return
+        if merge:
+            radex_engine.merge_shards(self.points, self.acts, self.output_row,
+                                      self.header, merge, suffix=self.suffix,
+                                      log=log, verbose=verbose)
+            return
+        self.save_spec()
+        radex_engine.run_grid(self.points, self.acts, self.write_input,
+                              self.output_row, self.header, bw=self.bw,
+                              suffix=self.suffix, executable=self.executable,
+                              minchunk=self.minchunk, resume=resume,
+                              shard=shard, log=log, verbose=verbose, **options)
+
+    def compare(self, solver, log=sys.stdout):
+        """
+        Run the grid points with solver too and report how its results
+        differ from those of the spec's executable (see
+        radex_backend.compare); no output files are written
+        """
+        if solver not in radex_backend.SOLVERS:
+            raise ValueError("Unknown solver %r (known: %s)" % (solver,', '.join(radex_backend.SOLVERS)))
+        options = self.run_options
+        return radex_backend.compare(self.points, self.acts, self.write_input,
+                                     (self.executable, radex_backend.executable_name(solver, self.geometry)),
+                                     read_model=self.read_model if self.has_dv else None,
+                                     bw=self.bw, nprocs=options.get('nprocs'),
+                                     minchunk=self.minchunk, timeout=options.get('timeout'),
+                                     radexpath=options.get('radexpath','.'), log=log,
+                                     verbose=options.get('verbose',1))
+
+def compile_plan(spec):
+    """
+    Compile a grid spec (a dictionary, or the name of a JSON file) into a GridPlan
+    """
+    if not isinstance(spec, dict):
+        spec = load_spec(spec)
+    return GridPlan(spec)
+
+if __name__ == "__main__":
+    options,args = radex_engine.parse_args(sys.argv[1:])
+    compare = None
+    if '--compare' in args[:-1]:
+        compare = args.pop(args.index('--compare')+1)
+        args.remove('--compare')
+    if len([arg for arg in args if arg != '--plan']) != 1:
+        sys.exit("Usage: %s grid.json [--plan] [--compare solver] [--resume] [--shard i/N] [--merge N]" % sys.argv[0])
+    plan = compile_plan([arg for arg in args if arg != '--plan'][0])
+    plan.describe()
+    if '--plan' in args:
+        pass
+    elif compare is not None:
+        plan.compare(compare)
+    else:
+        plan.run(resume=options['resume'], shard=options['shard'], merge=options['merge'])
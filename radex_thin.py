@@ -0,0 +1,229 @@
+"""
+Optically thin fast path along the column axis.
+
+While every line is optically thin the level populations do not depend on
+the column density, which is why grid_thin_dec2010 is a 1-column grid:
+Tex stays put, tau grows as N and the radiation temperature and flux as
+(1-exp(-tau)).  run_thin groups the grid points that differ only in column
+and computes the lowest column of each group first (the anchor).  Every
+column of the group at which all the acts' lines would still have
+|tau| < tau is then scaled from the anchor instead of computed; the rest
+are run as usual.
+
+To bound the error of the scaling, a fraction (verify) of the groups also
+have their highest scaled column computed; if any of those differs from
+its scaled values by more than tol (relative, in tau, Trot or flux), the
+scaling is not trusted and every point is computed.  The .dat files are
+the same as run_grid's, in grid order; the radex.out of every stage is
+collected in radex.out.thin, which becomes radex.out at the end.
+
+The scaling reads and writes read_radex_acts results (the default
+read_model): column at 2, Tex at 3 and 4, tau at 5 and 6, Trot at 7 and 8,
+fluxes at 9 and 10.
+"""
+from __future__ import print_function
+import math
+import os
+import sys
+import radex_cache
+import radex_engine
+
+def split_column(record):
+    """
+    (rest, column) of a radex.inp record: the canonical record (see
+    radex_cache) without the column density, and the column density
+    """
+    lines = record.split('\n')
+    icolumn = 6+2*int(lines[4])
+    column = float(lines[icolumn])
+    lines[icolumn] = ''
+    return radex_cache.canonical_record('\n'.join(lines)),column
+
+def column_groups(points, write_input):
+    """
+    Lists of (column, point index), lowest column first, of the points that
+    differ only in column density
+    """
+    groups = {}
+    for index,point in enumerate(points):
+        rest,column = split_column(radex_engine.input_record(write_input, point))
+        groups.setdefault(rest, []).append((column,index))
+    return [sorted(group) for key,group in sorted(groups.items())]
+
+def is_thin(anchor, factor, tau):
+    """
+    Whether every line of the anchor's results would have |tau| < tau at
+    factor times its column
+    """
+    for result in anchor:
+        for taufield in (5,6):
+            if not abs(result[taufield])*factor < tau:
+                # (NaN, a missing line, is never thin)
+                return False
+    return True
+
+def growth(tau0, factor):
+    """
+    (1-exp(-factor*tau0)) / (1-exp(-tau0)): how Trot and the flux scale
+    with the column at fixed excitation temperature
+    """
+    if tau0 == 0:
+        return factor
+    return math.expm1(-factor*tau0)/math.expm1(-tau0)
+
+def scale_results(anchor, column, factor):
+    """
+    The anchor's results (one per act) moved to factor times its column;
+    column is written as RADEX prints it
+    """
+    scaled = []
+    for result in anchor:
+        result = list(result)
+        result[2] = float("%.3E" % column)
+        for ii in (0,1):
+            tau0 = result[5+ii]
+            result[5+ii] = tau0*factor
+            result[7+ii] *= growth(tau0, factor)
+            result[9+ii] *= growth(tau0, factor)
+        scaled.append(tuple(result))
+    return scaled
+
+def scaling_error(scaled, computed):
+    """
+    Largest relative difference between scaled and computed results in
+    tau, Trot and flux
+    """
+    error = 0.0
+    for a,b in zip(scaled, computed):
+        for field in (5,6,7,8,9,10):
+            scale = max(abs(a[field]), abs(b[field]))
+            if scale > 0:
+                error = max(error, abs(a[field]-b[field])/scale)
+            elif a[field] != b[field]:
+                # NaN on one side
+                error = float('inf')
+    return error
+
+def compute(points, indices, acts, write_input, output_row, header, suffix, resume,
+            log, verbose, options):
+    """
+    run_grid over points[indices]; returns {index: results} on rank 0.
+    On resume, a stage whose checkpoints are complete is not run again, so
+    that only the interrupted stage prunes the leftover RADEX logs (to its
+    own points; see radex_engine.prune_radex_logs).
+    """
+    try:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    except ImportError:
+        comm = None
+    mpirank = comm.rank if comm is not None else 0
+    if not indices:
+        return {}
+    subset = [points[index] for index in indices]
+    cpprefix = radex_engine.checkpoint_name(suffix)
+    complete = False
+    if resume and mpirank == 0:
+        complete = len(radex_engine.read_checkpoints(cpprefix, subset, len(acts))) == len(subset)
+    if comm is not None and comm.size > 1:
+        complete = comm.bcast(complete, root=0)
+    if not complete:
+        radex_engine.run_grid(subset, acts, write_input, output_row, header,
+                              suffix=suffix, resume=resume, keep_checkpoints=True,
+                              log=log, verbose=verbose, **options)
+    if mpirank != 0:
+        return {}
+    radex_engine.collect_radex_out("radex.out.thin")
+    done = radex_engine.read_checkpoints(cpprefix, subset, len(acts))
+    return dict((index,done[ii]) for ii,index in enumerate(indices))
+
+def cleanup(suffix, acts):
+    radex_engine.remove_checkpoints(radex_engine.checkpoint_name(suffix))
+    for gfil in radex_engine.output_filenames(acts, suffix):
+        if os.path.exists(gfil):
+            os.remove(gfil)
+
+def run_thin(points, acts, write_input, output_row, header, tau=0.01, verify=0.1,
+             tol=0.01, suffix='', resume=False, log=sys.stdout, verbose=1, **options):
+    """
+    Compute a grid with the optically thin fast path (see the module
+    docstring) and write its .dat files as run_grid would.  Returns
+    (number of points computed, number scaled, largest verification error).
+
+    tau - largest |tau| of any act's line up to which a column is scaled
+    verify - fraction of the groups with scaled points whose highest scaled
+        point is computed too (at least one)
+    tol - largest relative verification error that keeps the scaled points
+    Other options (executable, slots, cachedir, ...) go to run_grid.
+    """
+    try:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    except ImportError:
+        comm = None
+    mpirank = comm.rank if comm is not None else 0
+
+    def bcast(value):
+        if comm is not None and comm.size > 1:
+            return comm.bcast(value, root=0)
+        return value
+
+    if mpirank == 0 and not (resume and os.path.exists("radex.out.thin")):
+        open("radex.out.thin",'w').close()
+    groups = column_groups(points, write_input)
+    anchors = [group[0][1] for group in groups]
+    if verbose > 0 and mpirank == 0: print("Thin path: %i groups of columns; computing their lowest columns" % len(groups), file=log)
+    done = compute(points, anchors, acts, write_input, output_row, header,
+                   suffix+"_thin0", resume, log, verbose, options)
+
+    # scale what is thin, verify a sample of it, compute the rest
+    scaled = {}
+    rest = []
+    checks = []
+    if mpirank == 0:
+        thin_groups = []
+        for group in groups:
+            column0,anchor = group[0]
+            thin = []
+            for column,index in group[1:]:
+                if is_thin(done[anchor], column/column0, tau):
+                    scaled[index] = scale_results(done[anchor], column, column/column0)
+                    thin.append(index)
+                else:
+                    rest.append(index)
+            if thin:
+                thin_groups.append(thin)
+        if thin_groups:
+            nverify = max(1, int(math.ceil(verify*len(thin_groups))))
+            step = len(thin_groups)/float(nverify)
+            checks = [thin_groups[int(ii*step)][-1] for ii in range(nverify)]
+        if verbose > 0: print("Thin path: scaling %i points, computing %i more (%i of them to verify the scaling)" % (len(scaled)-len(checks),len(rest)+len(checks),len(checks)), file=log)
+    rest,checks = bcast((rest,checks))
+    done.update(compute(points, sorted(rest+checks), acts, write_input, output_row,
+                        header, suffix+"_thin1", resume, log, verbose, options))
+
+    error = 0.0
+    if mpirank == 0:
+        for index in checks:
+            error = max(error, scaling_error(scaled.pop(index), done[index]))
+        if verbose > 0: print("Thin path: largest verification error %.2e (tol %.2e)" % (error,tol), file=log)
+    error = bcast(error)
+    if error > tol:
+        if verbose > 0 and mpirank == 0: print("Thin path: scaling not accurate enough; computing every point", file=log)
+        done.update(compute(points, sorted(set(range(len(points)))-set(anchors)-set(rest)-set(checks)),
+                            acts, write_input, output_row, header, suffix+"_thin2",
+                            resume, log, verbose, options))
+        scaled = {}
+
+    if mpirank == 0:
+        done.update(scaled)
+        writer = radex_engine.GridWriter(radex_engine.output_filenames(acts, suffix),
+                                         header, output_row, len(points))
+        for index in range(len(points)):
+            writer.add(index, done[index])
+        writer.close()
+        for stage in range(3):
+            cleanup("%s_thin%i" % (suffix,stage), acts)
+        radex_engine.restore_radex_out("radex.out.thin")
+        if verbose > 0: print("Thin path: computed %i of %i points, scaled %i" % (len(points)-len(scaled),len(points),len(scaled)), file=log)
+    return len(points)-len(scaled),len(scaled),error
@@ -0,0 +1,69 @@
+"""
+Write tests/data/radex_reference.out, the RADEX results test_native.py
+compares radex_native with.
+
+The models are computed by the RADEX Fortran code as wrapped by
+SpectralRadex (radexwrap, from "pip install spectralradex"), which returns
+RADEX's line table instead of writing radex.out; they are written here in
+radex.out's layout and print precision.  Only run this to change the
+points; the file it writes is committed.
+
+    python tests/make_radex_reference.py
+
+Dependencies:
+    numpy, spectralradex
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+import radexwrap
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTDIR))
+import radex_lamda
+import radex_native
+
+DATADIR = os.path.join(TESTDIR, 'data')
+# thin to very thick lines, one and two collision partners
+POINTS = [('hco+.dat', 20.0, [('H2',1e4)], 1e13, 1.0),
+          ('hco+.dat', 50.0, [('H2',1e5)], 1e14, 0.5),
+          ('hco+.dat', 100.0, [('H2',1e3)], 1e12, 2.0),
+          ('hco+.dat', 30.0, [('H2',1e6)], 1e15, 1.0),
+          ('catom.dat', 50.0, [('H2',1e3)], 1e17, 1.0),
+          ('catom.dat', 100.0, [('H2',1e4),('e',10.0)], 1e16, 1.0)]
+GEOMETRIES = {'sphere':1, 'lvg':2, 'slab':3}
+# radexwrap's density array
+PARTNER_INDEX = {'H2':0, 'p-H2':1, 'o-H2':2, 'e':3, 'H':4, 'He':5, 'H+':6}
+TBG = 2.73
+FMIN,FMAX = 0.0,5000.0
+
+def reference_model(point, geometry):
+    molfile,tkin,colliders,column,deltav = point
+    molecule = radex_lamda.read_lamda(os.path.join(DATADIR, molfile))
+    densities = np.zeros(7)
+    for name,density in colliders:
+        densities[PARTNER_INDEX[name]] = density
+    # radexwrap takes the line width in cm/s
+    success,nlines,qup,qlow,table = radexwrap.from_params(
+        os.path.join(DATADIR, molfile), tkin, TBG, column, densities,
+        deltav*1e5, FMIN, FMAX, GEOMETRIES[geometry])
+    if success != 1 or nlines != molecule.nlines:
+        raise RuntimeError("RADEX failed on %s in %s" % (point,geometry))
+    # E_UP FREQ WAVEL T_EX TAU T_R POP_UP POP_LOW FLUX(K km/s) FLUX(erg)
+    result = {'tex':table[3:4,:nlines], 'tau':table[4:5,:nlines],
+              'trad':table[5:6,:nlines], 'popup':table[6:7,:nlines],
+              'poplow':table[7:8,:nlines], 'flux':table[8:9,:nlines],
+              'niter':np.array([0])}
+    params = {'molfile':molfile, 'fmin':FMIN, 'fmax':FMAX, 'tkin':tkin,
+              'colliders':dict(colliders), 'tbg':TBG, 'column':column,
+              'deltav':deltav}
+    return radex_native.format_model(params, molecule, geometry, result, 0,
+                                     version='radexwrap (SpectralRadex)')
+
+if __name__ == "__main__":
+    outfile = open(os.path.join(DATADIR, 'radex_reference.out'), 'w')
+    for geometry in sorted(GEOMETRIES):
+        for point in POINTS:
+            outfile.write(reference_model(point, geometry))
+    outfile.close()
@@ -0,0 +1,174 @@
+"""
+The pyradex and fjdu backends of radex_backend, run against stand-in
+pyradex.Radex and pyradex.fjdu.Fjdu classes: pyradex needs a Fortran build
+these tests do not assume, so the stand-ins only check that the backend
+drives the objects the way pyradex wants and turns what they return into
+radex.out text.
+
+Like pyradex, the stand-ins keep their molecular data in module-global
+state: only the object made last can run, and it reports the lines of the
+data file it was made for.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import types
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTDIR))
+import radex_engine
+
+try:
+    import numpy as np
+    import radex_lamda
+    import radex_backend
+    import radex_native
+except ImportError:
+    radex_backend = None
+
+DATADIR = os.path.join(TESTDIR, 'data')
+TBG = 2.73
+
+class FakeRadex(object):
+    """
+    pyradex.Radex as the backend uses it.  The line values are simple
+    functions of the parameters, so they can be checked in the output:
+        tex = tkin + index of the line
+        tau = column/deltav*1e-13*(index+1)
+        T_B = tbg + total density*1e-4
+    """
+    # the object holding the "Fortran" state
+    current = None
+    made = []
+
+    def __init__(self, species, datapath, escapeProbGeom, collider_densities,
+                 temperature, column, deltav, **kwargs):
+        self.molecule = radex_lamda.read_lamda(os.path.join(datapath, species+'.dat'))
+        self.geometry = escapeProbGeom
+        self.temperature = temperature
+        self.density = collider_densities
+        self.column_per_bin = column
+        self.deltav = deltav
+        self.tbg = kwargs.get('tbackground', kwargs.get('tbg'))
+        FakeRadex.current = self
+        FakeRadex.made.append((self.__class__.__name__, species, escapeProbGeom))
+
+    def run_radex(self):
+        if FakeRadex.current is not self:
+            raise RuntimeError("the Fortran state belongs to another object")
+        index = np.arange(self.molecule.nlines)
+        self.tex = self.temperature+index
+        self.tau = self.column_per_bin/self.deltav*1e-13*(index+1)
+        self.T_B = np.zeros(self.molecule.nlines)+self.tbg+sum(self.density.values())*1e-4
+        self.level_population = np.ones(self.molecule.nlevels)/self.molecule.nlevels
+        return 12
+
+class FakeFjdu(FakeRadex):
+    """
+    pyradex.fjdu.Fjdu: takes tbg, and run_radex returns nothing
+    """
+    def __init__(self, tbg, **kwargs):
+        FakeRadex.__init__(self, tbg=tbg, **kwargs)
+
+    def run_radex(self):
+        FakeRadex.run_radex(self)
+
+def write_input(infile, molfile, tkin, densities, column, deltav):
+    infile.write(molfile+'\n')
+    infile.write('radex.out\n')
+    infile.write('0 5000\n')
+    infile.write('%r\n' % tkin)
+    infile.write('%i\n' % len(densities))
+    for name,density in densities:
+        infile.write('%s\n%r\n' % (name,density))
+    infile.write('%r\n%r\n%r\n' % (TBG,column,deltav))
+
+# two data files in turn, so the backend has to change objects
+CHUNK = [('hco+.dat', 20.0, [('H2',1e4)], 1e13, 1.0),
+         ('hco+.dat', 50.0, [('H2',1e5)], 1e14, 0.5),
+         ('catom.dat', 100.0, [('H2',1e4),('e',10.0)], 1e16, 1.0),
+         ('hco+.dat', 30.0, [('H2',1e6)], 1e15, 2.0)]
+
+@unittest.skipIf(radex_backend is None, "the pyradex backends need numpy")
+class TestPyradexBackend(unittest.TestCase):
+
+    def setUp(self):
+        pyradex = types.ModuleType('pyradex')
+        pyradex.Radex = FakeRadex
+        pyradex.fjdu = types.ModuleType('pyradex.fjdu')
+        pyradex.fjdu.Fjdu = FakeFjdu
+        self.modules = dict((name,sys.modules.get(name)) for name in ('pyradex', 'pyradex.fjdu'))
+        sys.modules['pyradex'] = pyradex
+        sys.modules['pyradex.fjdu'] = pyradex.fjdu
+        radex_backend._pyradex.clear()
+        FakeRadex.current = None
+        FakeRadex.made = []
+
+    def tearDown(self):
+        for name,module in self.modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        radex_backend._pyradex.clear()
+
+    def check_models(self, models, geometry, niter):
+        self.assertEqual(len(models), len(CHUNK))
+        for model,point in zip(models, CHUNK):
+            molfile,tkin,densities,column,deltav = point
+            molecule = radex_lamda.read_lamda(os.path.join(DATADIR, molfile))
+            self.assertTrue(model.startswith(radex_engine.RADEX_HEADER))
+            self.assertTrue("Geometry             : %s\n" % radex_native.GEOMETRY_NAMES[geometry] in model)
+            self.assertTrue("Molecular data file  : %s\n" % molfile in model)
+            self.assertTrue("finished in %9i iterations" % niter in model)
+            params,lines = radex_engine.parse_radex_model(model)
+            self.assertEqual(params['tkin'], tkin)
+            self.assertEqual(params['tbg'], TBG)
+            self.assertAlmostEqual(params['column']/column, 1, places=3)
+            self.assertEqual(params['deltav'], deltav)
+            printed = dict((name.replace('-',''),density) for name,density in densities)
+            self.assertEqual(params['density'], printed)
+            self.assertEqual(len(lines), molecule.nlines)
+            trad = TBG+sum(printed.values())*1e-4
+            for index,(freq,tex,tau,trot,flux) in enumerate(lines):
+                self.assertAlmostEqual(freq, molecule.freq[index], places=3)
+                self.assertAlmostEqual(tex, tkin+index, places=3)
+                self.assertAlmostEqual(tau/(column/deltav*1e-13*(index+1)), 1, places=3)
+                self.assertAlmostEqual(flux/(1.0645*deltav*trad), 1, places=3)
+
+    def test_pyradex(self):
+        models = list(radex_backend.run_models(CHUNK, write_input, 'pyradex_lvg',
+                                               radexpath=DATADIR))
+        self.check_models(models, 'lvg', 12)
+        # a new object each time the data file changes, never two at once
+        self.assertEqual(FakeRadex.made, [('FakeRadex', 'hco+', 'lvg'),
+                                          ('FakeRadex', 'catom', 'lvg'),
+                                          ('FakeRadex', 'hco+', 'lvg')])
+
+    def test_fjdu(self):
+        models = list(radex_backend.run_models(CHUNK, write_input, 'fjdu_slab',
+                                               radexpath=DATADIR))
+        self.check_models(models, 'slab', 0)
+        self.assertEqual([made[0] for made in FakeRadex.made], ['FakeFjdu']*3)
+
+    def test_geometry_change(self):
+        list(radex_backend.run_models(CHUNK[:1], write_input, 'pyradex_lvg', radexpath=DATADIR))
+        list(radex_backend.run_models(CHUNK[:1], write_input, 'pyradex_sphere', radexpath=DATADIR))
+        list(radex_backend.run_models(CHUNK[:1], write_input, 'pyradex_sphere', radexpath=DATADIR))
+        self.assertEqual(FakeRadex.made, [('FakeRadex', 'hco+', 'lvg'),
+                                          ('FakeRadex', 'hco+', 'sphere')])
+
+    def test_failure(self):
+        run_radex = FakeRadex.run_radex
+        FakeRadex.run_radex = lambda self: 1/0
+        try:
+            models = radex_backend.run_models(CHUNK, write_input, 'pyradex_lvg',
+                                              radexpath=DATADIR)
+            self.assertRaises(radex_engine.RadexError, list, models)
+        finally:
+            FakeRadex.run_radex = run_radex
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,370 @@
+"""
+radex_engine's grid runs, with tests/fakeradex/radex_lvg standing in for
+RADEX: serial, pool and sharded runs write the same .dat files, --resume
+finishes an interrupted run, and a point RADEX fails on comes out as NaN.
+Also the radex.out parser, the cache key, the Sobol sequence and the
+interpolation of samples.
+
+These need neither RADEX nor (but for the interpolation) numpy, and run
+under python 2 too.
+
+    python -m pytest tests
+"""
+import math
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTDIR))
+import radex_amr
+import radex_cache
+import radex_engine
+import radex_sample
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ACTS = [[4.8,14.5,'1-1_2-2.dat'], [4.8,29.0,'1-1_3-3.dat'], [14.5,218.2,'2-2_303.dat']]
+HEADER = ("Temperature","log10(dens)","log10(col)","Tex_low","Tex_hi",
+          "TauLow","TauUpp","TrotLow","TrotUpp","FluxLow","FluxUpp")
+POINTS = radex_engine.grid_points([10.0, 20.0, 40.0, 80.0], [1e3, 1e4, 1e5], [1e12, 1e14])
+
+def write_input(infile, tkin, nh2, column):
+    infile.write('o-h2co.dat\n')
+    infile.write('radex.out\n')
+    infile.write('3.96 220.0\n')
+    infile.write(str(tkin)+'\n')
+    infile.write('1\n')
+    infile.write('H2\n')
+    infile.write(str(nh2)+'\n')
+    infile.write('2.73\n')
+    infile.write(str(column)+'\n')
+    infile.write('1.0\n')
+
+def output_row(radex_out):
+    temp,dens,col,tlow,tupp,taulow,tauupp,trotlow,trotupp,fluxlow,fluxupp,opr = radex_out
+    return (temp, math.log10(dens), math.log10(col),
+            tlow, tupp, taulow, tauupp, trotlow,trotupp,fluxlow,fluxupp)
+
+class Interrupted(Exception):
+    pass
+
+def interrupting(after):
+    """
+    read_radex_acts, interrupting the run after that many models
+    """
+    count = [0]
+    def read_model(model, acts):
+        count[0] += 1
+        if count[0] > after:
+            raise Interrupted()
+        return radex_engine.read_radex_acts(model, acts)
+    return read_model
+
+class GridTest(unittest.TestCase):
+    """
+    Runs grids in a scratch directory, with a copy of the fake RADEX
+    """
+
+    def setUp(self):
+        self.pwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp(prefix='test_engine_')
+        self.executable = os.path.join(self.tmpdir, 'radex_lvg')
+        infile = open(os.path.join(TESTDIR, 'fakeradex', 'radex_lvg'))
+        script = infile.read().split('\n', 1)[1]
+        infile.close()
+        outfile = open(self.executable, 'w')
+        outfile.write('#!%s\n' % sys.executable)
+        outfile.write(script)
+        outfile.close()
+        os.chmod(self.executable, os.stat(self.executable).st_mode | stat.S_IXUSR)
+        self.environ = dict(os.environ)
+        os.environ['FAKERADEX_LOG'] = os.path.join(self.tmpdir, 'models.log')
+        self.log = open(os.devnull, 'w')
+
+    def tearDown(self):
+        os.chdir(self.pwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.log.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def run_grid(self, name, points=POINTS, **options):
+        """
+        run_grid in a new subdirectory; returns the text of each .dat file
+        (None for a shard, which only leaves checkpoints)
+        """
+        rundir = os.path.join(self.tmpdir, name)
+        if not os.path.exists(rundir):
+            os.mkdir(rundir)
+        os.chdir(rundir)
+        try:
+            options.setdefault('nprocs', 1)
+            radex_engine.run_grid(points, ACTS, write_input, output_row, HEADER,
+                                  executable=self.executable, cachedir=None,
+                                  log=self.log, verbose=0, **options)
+        finally:
+            os.chdir(self.pwd)
+        if 'shard' in options:
+            return None
+        return self.dat_files(rundir)
+
+    def dat_files(self, rundir):
+        texts = []
+        for act in ACTS:
+            infile = open(os.path.join(rundir, act[2]))
+            texts.append(infile.read())
+            infile.close()
+        return texts
+
+    def models(self, rundir):
+        """
+        model_key of every computed model in a run's radex.out, sorted
+        """
+        infile = open(os.path.join(self.tmpdir, rundir, 'radex.out'))
+        models = [model for model in radex_engine.split_models(infile)
+                  if model.startswith(radex_engine.RADEX_HEADER)]
+        infile.close()
+        return sorted(radex_engine.model_key(radex_engine.parse_radex_model(model)[0])
+                      for model in models)
+
+    def computed(self):
+        """
+        Lines of the fake RADEX's log: one per model it computed
+        """
+        logname = os.environ['FAKERADEX_LOG']
+        if not os.path.exists(logname):
+            return []
+        infile = open(logname)
+        lines = infile.read().splitlines()
+        infile.close()
+        os.remove(logname)
+        return lines
+
+class TestRunGrid(GridTest):
+
+    def test_serial_pool_shards(self):
+        serial = self.run_grid('serial')
+        self.assertEqual(len(self.computed()), len(POINTS))
+        rows = serial[0].splitlines()
+        self.assertEqual(len(rows), len(POINTS)+1)
+        self.assertTrue('nan' not in serial[0])
+        self.assertEqual(self.run_grid('follow', stream=False), serial)
+        self.assertEqual(self.run_grid('pool', nprocs=3, minchunk=2), serial)
+        self.assertEqual(self.models('pool'), self.models('serial'))
+        for ishard in range(3):
+            self.run_grid('shards', shard=(ishard,3))
+        self.assertEqual(len(self.computed()), 3*len(POINTS))
+        os.chdir(os.path.join(self.tmpdir, 'shards'))
+        try:
+            merged = radex_engine.merge_shards(POINTS, ACTS, output_row, HEADER, 3,
+                                               log=self.log, verbose=0)
+        finally:
+            os.chdir(self.pwd)
+        self.assertTrue(merged)
+        self.assertEqual(self.dat_files(os.path.join(self.tmpdir, 'shards')), serial)
+        self.assertEqual(self.models('shards'), self.models('serial'))
+
+    def test_resume(self):
+        serial = self.run_grid('serial')
+        self.computed()
+        read_model = interrupting(len(POINTS)//2)
+        self.assertRaises(Interrupted, self.run_grid, 'resumed', read_model=read_model)
+        self.computed()
+        # only the points not checkpointed are run again
+        resumed = self.run_grid('resumed', resume=True)
+        self.assertEqual(len(self.computed()), len(POINTS)-len(POINTS)//2)
+        self.assertEqual(resumed, serial)
+        self.assertEqual(self.models('resumed'), self.models('serial'))
+
+    def test_resume_other_mode(self):
+        serial = self.run_grid('serial')
+        # a serial run resumed on a pool
+        self.assertRaises(Interrupted, self.run_grid, 'pool',
+                          read_model=interrupting(len(POINTS)//2))
+        self.assertEqual(self.run_grid('pool', nprocs=3, resume=True), serial)
+        self.assertEqual(self.models('pool'), self.models('serial'))
+        # and a pool run resumed serially: an interrupted pool run leaves its
+        # models in radex_temp_XX (set up by hand, since a pool stopped by
+        # an exception in a worker can hang in Pool.terminate)
+        self.assertRaises(Interrupted, self.run_grid, 'again',
+                          read_model=interrupting(len(POINTS)//2))
+        tempdir = os.path.join(self.tmpdir, 'again', 'radex_temp_01')
+        os.mkdir(tempdir)
+        os.rename(os.path.join(self.tmpdir, 'again', 'radex.out.all'),
+                  os.path.join(tempdir, 'radex.out.all'))
+        self.assertEqual(self.run_grid('again', resume=True), serial)
+        self.assertEqual(self.models('again'), self.models('serial'))
+        self.assertFalse(os.path.exists(tempdir))
+
+    def run_amr(self, name, **options):
+        """
+        run_amr over density and column in a new subdirectory; returns the
+        store's points, by lattice position
+        """
+        rundir = os.path.join(self.tmpdir, name)
+        if not os.path.exists(rundir):
+            os.mkdir(rundir)
+        os.chdir(rundir)
+        try:
+            axes = [[20.0], [1e3, 1e5], [1e12, 1e16]]
+            storename = radex_amr.run_amr(axes, (1,2), ACTS, write_input, output_row, HEADER,
+                                          levels=2, tol=0.2, executable=self.executable,
+                                          cachedir=None, nprocs=1, log=self.log, verbose=0,
+                                          **options)
+            return radex_amr.read_store(storename)[1]
+        finally:
+            os.chdir(self.pwd)
+
+    def test_amr_resume(self):
+        amr = self.run_amr('amr')
+        ncomputed = len(self.computed())
+        self.assertEqual(ncomputed, len(amr))
+        # levels 0 and 1 have 4+5 points, level 2 the rest
+        self.assertTrue(len(amr) > 12)
+        self.assertRaises(Interrupted, self.run_amr, 'resumed', read_model=interrupting(12))
+        self.computed()
+        resumed = self.run_amr('resumed', resume=True)
+        # the points level 2 had checkpointed are not run again
+        self.assertEqual(len(self.computed()), ncomputed-12)
+        self.assertEqual(resumed, amr)
+        self.assertEqual(self.models('resumed'), self.models('amr'))
+
+    def test_failed_point(self):
+        os.environ['FAKERADEX_FAIL_TKIN'] = '20.0'
+        for name,options in (('stream', {}), ('follow', {'stream':False})):
+            texts = self.run_grid(name, **options)
+            for text in texts:
+                for row in text.splitlines()[1:]:
+                    failed = float(row.split()[0]) == 20.0
+                    self.assertEqual('nan' in row.lower(), failed, row)
+            # the other points are all computed, and only they are in radex.out
+            self.assertEqual(len(self.models(name)), len(POINTS)-6)
+            infile = open(os.path.join(self.tmpdir, name, 'radex.out'))
+            self.assertFalse(radex_engine.FAILED_MARKER in infile.read())
+            infile.close()
+
+    def test_hung_point(self):
+        os.environ['FAKERADEX_HANG_TKIN'] = '40.0'
+        texts = self.run_grid('hung', timeout=1)
+        failed = [row for row in texts[0].splitlines()[1:] if 'nan' in row.lower()]
+        self.assertEqual([float(row.split()[0]) for row in failed], [40.0]*6)
+
+    def test_duplicates(self):
+        # 1e4 and 10000.0 are the same RADEX input
+        points = POINTS + [(20.0, 10000.0, 1e12), (80.0, 100000, 1e14)]
+        texts = self.run_grid('duplicates', points=points)
+        self.assertEqual(len(self.computed()), len(POINTS))
+        rows = texts[0].splitlines()
+        self.assertEqual(rows[-2].split()[3:], rows[1+POINTS.index((20.0, 1e4, 1e12))].split()[3:])
+        self.assertEqual(rows[-1].split()[3:], rows[1+POINTS.index((80.0, 1e5, 1e14))].split()[3:])
+
+class TestParsing(unittest.TestCase):
+
+    MODEL = """* Radex version        : 20nov08
+* Geometry             : Expanding sphere (LVG)
+* Molecular data file  : o-h2co.dat
+* T(kin)            [K]:   10.000
+* Density of H2  [cm-3]:  1.000E+04
+* T(background)     [K]:    2.730
+* Column density [cm-2]:  1.000E+14
+* Line width     [km/s]:    1.000
+Calculation finished in  12 iterations
+      LINE         E_UP       FREQ        WAVEL     T_EX      TAU        T_R       POP        POP       FLUX        FLUX
+                    (K)       (GHz)       (um)       (K)                 (K)        UP        LOW     (K*km/s) (erg/cm2/s)
+1_1_0  -- 1_1_1     15.0     4.8297   62072.9131    -1.404  1.404+106  -1.263E+00  1.000E-01  2.000E-01  -1.344E+00  -1.263E-08
+2_1_1  -- 2_1_2     22.6    14.4884   20691.8436     5.000  1.000E-02   2.000E-02  1.000E-01  2.000E-01   2.129E-02   2.000E-10
+"""
+
+    def test_radex_float(self):
+        self.assertEqual(radex_engine.radex_float('1.404+106'), 1.404e106)
+        self.assertEqual(radex_engine.radex_float('1.404-106'), 1.404e-106)
+        self.assertEqual(radex_engine.radex_float('-1.263E+00'), -1.263)
+
+    def test_parse_radex_model(self):
+        params,lines = radex_engine.parse_radex_model(self.MODEL)
+        self.assertEqual(params, {'tkin':10.0, 'tbg':2.73, 'column':1e14, 'deltav':1.0,
+                                  'density':{'H2':1e4}})
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], (4.8297, -1.404, 1.404e106, -1.263, -1.344))
+        results = radex_engine.read_radex_acts(self.MODEL, ACTS[:1])
+        self.assertEqual(results[0][:7], (10.0, 1e4, 1e14, -1.404, 5.0, 1.404e106, 0.01))
+
+class TestCanonicalRecord(unittest.TestCase):
+
+    def record(self, *point):
+        return radex_engine.input_record(write_input, point)
+
+    def test_same_input(self):
+        canonical = radex_cache.canonical_record(self.record(20.0, 1e4, 1e12))
+        for point in ((20, 10000, 1e12), (20.0, 10000.0, 1000000000000.0), (2e1, 1.0e4, 1e+12)):
+            self.assertEqual(radex_cache.canonical_record(self.record(*point)), canonical)
+        self.assertNotEqual(radex_cache.canonical_record(self.record(20.0, 1.0001e4, 1e12)), canonical)
+        # the output file name does not change the result
+        other = self.record(20.0, 1e4, 1e12).replace('radex.out', 'other.out')
+        self.assertEqual(radex_cache.canonical_record(other), canonical)
+
+    def test_deduplicate(self):
+        points = [(20.0, 1e4, 1e12), (20.0, 1e5, 1e12), (20, 10000, 1e12),
+                  (20.0, 100000.0, 1e12), (20.0, 1e4, 1e12), (40.0, 1e4, 1e12)]
+        done = {}
+        todo,copies = radex_engine.deduplicate(points, list(range(len(points))), done, write_input)
+        self.assertEqual(todo, [0, 1, 5])
+        self.assertEqual(copies, {0:[2, 4], 1:[3]})
+        # points that repeat one done earlier take its results straight away
+        done = {1:['rows']}
+        todo,copies = radex_engine.deduplicate(points, [0, 2, 3, 4, 5], done, write_input)
+        self.assertEqual(todo, [0, 5])
+        self.assertEqual(copies, {0:[2, 4]})
+        self.assertEqual(done[3], ['rows'])
+
+class TestSobol(unittest.TestCase):
+
+    def test_first_points(self):
+        # the unscrambled Sobol sequence with Joe & Kuo's direction numbers
+        expected = [[0.0, 0.0, 0.0, 0.0],
+                    [0.5, 0.5, 0.5, 0.5],
+                    [0.75, 0.25, 0.25, 0.25],
+                    [0.25, 0.75, 0.75, 0.75],
+                    [0.375, 0.375, 0.625, 0.875],
+                    [0.875, 0.875, 0.125, 0.375],
+                    [0.625, 0.125, 0.875, 0.625],
+                    [0.125, 0.625, 0.375, 0.125]]
+        self.assertEqual(radex_sample.sobol_points(8, 4), expected)
+        self.assertEqual(radex_sample.sobol_points(8, 1), [point[:1] for point in expected])
+
+    def test_stratified(self):
+        # each of the first 2^k points falls in its own 1/2^k slice of every axis
+        points = radex_sample.sobol_points(64, 10)
+        for axis in range(10):
+            self.assertEqual(sorted(int(point[axis]*64) for point in points), list(range(64)))
+
+@unittest.skipIf(numpy is None, "ScatteredInterpolator needs numpy")
+class TestScatteredInterpolator(unittest.TestCase):
+
+    def test_plane(self):
+        # planes (negative, so fitted as they are), and a quantity that is a
+        # plane in log
+        units = radex_sample.sobol_points(65, 3)[1:]
+        def results(u):
+            return [(-1-u[0]-2*u[1]+0.5*u[2], 10**(1+2*u[0])), (-3.0+u[2],)]
+        values = [results(u) for u in units]
+        # a failed sample is left out
+        values[10] = [(float('nan'), 1.0), (0.0,)]
+        interpolator = radex_sample.ScatteredInterpolator(units, values)
+        for u in ([0.3, 0.6, 0.2], [0.9, 0.1, 0.55], units[20]):
+            expected = results(u)
+            computed = interpolator(u)
+            self.assertEqual([len(result) for result in computed], [2, 1])
+            for result,exact in zip(computed, expected):
+                for value,reference in zip(result, exact):
+                    self.assertAlmostEqual(value/reference, 1, places=5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+radex_native against RADEX: the models of tests/data/radex_reference.out
+(see make_radex_reference.py) are solved again with radex_native and the
+line tables compared within RADEX's print precision.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTDIR))
+import radex_engine
+
+try:
+    import numpy
+    import radex_native
+except ImportError:
+    radex_native = None
+
+DATADIR = os.path.join(TESTDIR, 'data')
+# four printed digits on both sides, plus RADEX's convergence criterion
+RTOL = 2e-3
+# the excitation temperature of a line between (almost) empty levels is
+# not determined by anything, so those lines are not compared
+MINPOP = 1e-4
+# RADEX computes 1-exp(-tau) directly, which loses T_R below this tau
+MINTAU = 1e-10
+
+def line_table(model):
+    """
+    [(freq, tex, tau, trad, popup, poplow, flux), ...] of a radex.out model
+    """
+    table = []
+    for line in model.splitlines():
+        if ' -- ' in line:
+            numbers = [radex_engine.radex_float(word) for word in line.split()[-10:]]
+            table.append((numbers[1],)+tuple(numbers[3:9]))
+    return table
+
+def model_input(model):
+    """
+    (executable, write_input, point) that reproduce a radex.out model
+    """
+    geometries = dict((name,geometry) for geometry,name in radex_native.GEOMETRY_NAMES.items())
+    colliders = dict((printed,name) for name,printed in radex_native.PRINTED_NAMES.items())
+    params,lines = radex_engine.parse_radex_model(model)
+    for line in model.splitlines():
+        if line.startswith('* Geometry'):
+            geometry = geometries[line.split(':',1)[1].strip()]
+        elif line.startswith('* Molecular data file'):
+            molfile = line.split(':',1)[1].strip()
+    def write_input(infile, tkin, densities, tbg, column, deltav):
+        infile.write(molfile+'\n')
+        infile.write('radex.out\n')
+        infile.write('0 5000\n')
+        infile.write('%r\n' % tkin)
+        infile.write('%i\n' % len(densities))
+        for name,density in densities:
+            infile.write('%s\n%r\n' % (name,density))
+        infile.write('%r\n%r\n%r\n' % (tbg,column,deltav))
+    densities = tuple(sorted((colliders[name],density) for name,density in params['density'].items()))
+    point = (params['tkin'], densities, params['tbg'], params['column'], params['deltav'])
+    return 'native_'+geometry,write_input,point
+
+def relative(a, b):
+    return abs(a-b)/max(abs(a), abs(b), 1e-30)
+
+@unittest.skipIf(radex_native is None, "radex_native needs numpy")
+class TestNativeAgainstRadex(unittest.TestCase):
+
+    def test_reference_models(self):
+        infile = open(os.path.join(DATADIR, 'radex_reference.out'))
+        models = [model for model in radex_engine.split_models(infile)
+                  if model.startswith(radex_engine.RADEX_HEADER)]
+        infile.close()
+        self.assertEqual(len(models), 18)
+        for reference in models:
+            executable,write_input,point = model_input(reference)
+            native = list(radex_native.run_models([point], write_input, executable,
+                                                  radexpath=DATADIR))[0]
+            expected = line_table(reference)
+            computed = line_table(native)
+            self.assertEqual(len(computed), len(expected))
+            for ref,nat in zip(expected, computed):
+                freq,tex,tau,trad,popup,poplow,flux = ref
+                where = "%s %s at %.4f GHz" % (executable,point,freq)
+                self.assertAlmostEqual(nat[0], freq, places=3, msg=where)
+                if min(popup, poplow) < MINPOP:
+                    continue
+                for name,field in (('Tex',1), ('tau',2), ('pop up',4), ('pop low',5)):
+                    self.assertTrue(relative(nat[field], ref[field]) < RTOL,
+                                    "%s: %s %g instead of %g" % (where,name,nat[field],ref[field]))
+                if abs(tau) > MINTAU:
+                    for name,field in (('T_R',3), ('flux',6)):
+                        self.assertTrue(relative(nat[field], ref[field]) < RTOL,
+                                        "%s: %s %g instead of %g" % (where,name,nat[field],ref[field]))
+
+if __name__ == "__main__":
+    unittest.main()
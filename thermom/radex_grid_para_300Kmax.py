@@ -6,6 +6,8 @@ import os
 import time
 import sys
 import re
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from radex_engine import RadexError
 
 # Sometimes, fortran outputs things like "1.404+106" instead of "1.404E+106"
 bad_exp = re.compile("([0-9])\+")
@@ -233,8 +235,7 @@ for iact,act in enumerate(acts):
         if verbose > 0: print "Processor %i: Starting radex code." % mpirank
         status = os.system('%s < radex.inp > /dev/null' % executable)
         if status != 0:
-            print "Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status)
-            import pdb; pdb.set_trace()
+            raise RadexError("Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status))
         
         if verbose > 0: print "Processor %i: Finished Radex." % mpirank
 
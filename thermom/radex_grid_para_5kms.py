@@ -5,6 +5,8 @@ import math
 import os
 import time
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from radex_engine import RadexError
 #
 # Run a series of Radex models to estimate temperature & density
 # from observed ratios of H2CO 1-1/2-2, 1-1/3-3, and 2-2/3-3 lines
@@ -248,7 +250,7 @@ for iact,act in enumerate(acts):
             print "Can see the output from radex in radex.log"
             with open('radex.log') as f:
                 print f.readlines()[-1]
-            import pdb; pdb.set_trace()
+            raise RadexError("Command %s failed with exit status %i" % ('%s < radex.inp > /dev/null' % executable,status))
         
         if verbose > 0: print >>out, "Processor %i: Finished Radex." % mpirank
 
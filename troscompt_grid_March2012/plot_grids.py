@@ -169,7 +169,7 @@ def gridcube(filename,outfilename,var1="density",var2="column",var3="temperature
         nw = len(warr)
         newarr = zeros([nw,nz,ny,nx])
         if nw != 11:
-            import pdb; pdb.set_trace()
+            raise ValueError("Expected 11 values of %s, found %i" % (var4,nw))
     else:
         newarr = zeros([nz,ny,nx])
 